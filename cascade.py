@@ -0,0 +1,129 @@
+import os
+import json
+import math
+import time
+import torch
+from transformers import AutoTokenizer
+
+from models import LogisticRegression
+from checkpoints import empty_model, load_checkpoint
+from train_linear import CDDataset, collate_fn_cd
+
+
+################################################################################
+# Linear-model cascade: the train_linear LogisticRegression scores every (utterance,
+# candidate) pair of a file from the cheap train_linear features (last_spoke,
+# next_same, words in common, distance, same turn / speaker ...), and only the
+# candidates it keeps go to the BERT scorer: Bert_v7 slots through candidate_lists
+# (inference_4DD), models.py pairs through CDDataset (inference_baseline).
+#
+# A candidate is kept when its probability is >= a threshold, calibrated on dev for
+# a target recall of the gold parents (cascade_4DD.py, saved next to the linear
+# model), and / or when it is among the top_k of its utterance. The utterance
+# itself (new thread) is always kept. The features are train_linear's own
+# (CDDataset.produce_candidates), so the scores are those the model was trained on.
+
+class LinearCandidates(CDDataset):
+    '''
+    train_linear's candidate pool of a file (previous `max_candidates` lines of the scene), every line tokenized once
+    '''
+    def __init__(self, *args, **kwargs):
+        self.tokenized_lines={}
+        super().__init__(*args, **kwargs)
+
+    def tokenize_line(self, sequence):
+        if sequence not in self.tokenized_lines:
+            self.tokenized_lines[sequence]=super().tokenize_line(sequence)
+        return self.tokenized_lines[sequence]
+
+def linear_tokenizer(model_name):
+    '''
+    as in train_linear: c_words_in_common counts its token ids
+    '''
+    tokenizer=AutoTokenizer.from_pretrained(model_name, do_lower_case=False, do_basic_tokenize=False)
+    tokenizer.add_tokens(['[LINE]', '[SELF]'], special_tokens=True)
+    return tokenizer
+
+def load_linear_model(path):
+    return load_checkpoint(empty_model(lambda: LogisticRegression({})), path).eval()
+
+def linear_scores(linear_model, tokenizer, window, mode, lines, filename_to_filename_id, scene_id2line_ids, line_id2line_text, line_id2turn_n, line_id2speaker, speaker2line_ids,
+                  batch_size=4096):
+    '''
+    the line dicts in train_linear's layout (train_baseline.read_line_dicts), texts as "speaker [SEP] line [LINE]"
+    -> {(filename, utterance_id): [(candidate_id, probability, is_gold_parent), ...]} over the previous
+    `window` D lines of the utterance's scene, and the seconds taken, features included
+    '''
+    start=time.perf_counter()
+    reversed_filename_to_filename_id={v: k for k, v in filename_to_filename_id.items()}
+    dataset=LinearCandidates(lines, filename_to_filename_id, scene_id2line_ids, line_id2line_text, line_id2turn_n, line_id2speaker, speaker2line_ids,
+                             tokenizer, mode, tokenizer.model_max_length, max_candidates=window)
+    device=next(linear_model.parameters()).device
+    scores={}
+    with torch.no_grad():
+        for idx in range(0, len(dataset), batch_size):
+            chunk=dataset.pool[idx:idx+batch_size]
+            probabilities=torch.sigmoid(linear_model(collate_fn_cd(chunk)['x'].to(device))['logits'].view(-1)).tolist()
+            for item, probability in zip(chunk, probabilities):
+                key=(reversed_filename_to_filename_id[item['filename_id']], item['utterance_of_interest_id'])
+                scores.setdefault(key, []).append((item['candidate_line_id'], probability, item['label']))
+    return scores, time.perf_counter() - start
+
+def calibrate_threshold(scores, recall):
+    '''
+    the highest threshold that keeps `recall` of the gold parents scored (those in the window)
+    '''
+    parents=sorted((p for candidates in scores.values() for _, p, is_parent in candidates if is_parent), reverse=True)
+    if not parents:
+        return 0.
+    return parents[max(math.ceil(recall*len(parents)) - 1, 0)]
+
+def select_candidates(scores, threshold=0., top_k=0):
+    '''
+    -> {(filename, utterance_id): [kept candidate ids, nearest first]}
+    '''
+    kept={}
+    for key, candidates in scores.items():
+        ranked=sorted(candidates, key=lambda c: c[1], reverse=True)
+        if top_k:
+            ranked=ranked[:top_k]
+        kept[key]=sorted([c for c, p, _ in ranked if p >= threshold], key=lambda c: int(c[1:]), reverse=True)
+    return kept
+
+def cascade_recall(scores, kept):
+    '''
+    -> share of the gold parents in the window that are kept, mean candidates kept per utterance
+    '''
+    parents=[(key, c) for key, candidates in scores.items() for c, _, is_parent in candidates if is_parent]
+    hits=sum(c in kept.get(key, []) for key, c in parents)
+    return hits/max(len(parents), 1), sum(len(c) for c in kept.values())/max(len(kept), 1)
+
+def candidate_lists(kept, lines_dict, mode, reversed_filename_to_filename_id, num_slots=0):
+    '''
+    retrieve_candidates' format, {(filename_id, utterance_id): [utterance_id, candidate ids ...]}, for the
+    utterances of lines_dict[mode]; num_slots caps the list (Bert_v7's max_previous_utterance)
+    '''
+    lists={}
+    for filename_id, uoi_id in lines_dict[mode]:
+        candidates=kept.get((reversed_filename_to_filename_id[filename_id], uoi_id), [])
+        lists[(filename_id, uoi_id)]=[uoi_id]+(candidates[:num_slots-1] if num_slots else candidates)
+    return lists
+
+def thresholds_path(linear_model_path):
+    return f"{linear_model_path}.cascade.json"
+
+def save_thresholds(thresholds, linear_model_path):
+    '''
+    thresholds: {recall: threshold} calibrated on dev
+    '''
+    with open(thresholds_path(linear_model_path), 'w') as f:
+        json.dump({str(recall): threshold for recall, threshold in thresholds.items()}, f)
+
+def load_threshold(linear_model_path, recall):
+    if not recall:
+        return 0.
+    assert os.path.exists(thresholds_path(linear_model_path)), f"no calibrated thresholds, run cascade_4DD.py on dev for {linear_model_path}"
+    with open(thresholds_path(linear_model_path)) as f:
+        thresholds={float(r): t for r, t in json.load(f).items()}
+    assert recall in thresholds, f"recall {recall} not calibrated, one of {sorted(thresholds)}"
+    return thresholds[recall]
@@ -0,0 +1,183 @@
+########
+# Linear-model cascade (cascade.py) on a dev file: the train_linear LogisticRegression scores every
+# (utterance, candidate) pair, and only the candidates it keeps are scored by the BERT model, Bert_v7
+# (train_4DD output) or a models.py encoder (--encoder_name, train_baseline output). For every
+# threshold (calibrated for each of --recalls) and every --top_ks cap: the recall of the gold parents,
+# candidates kept, dev metrics and the speedup over scoring every candidate of the window. The
+# thresholds are saved next to the linear model, inference_4DD / inference_baseline --cascade_recall
+# read them
+########
+import time
+import logging
+import argparse
+import pathlib
+import torch
+from torch.utils.data import (DataLoader, SequentialSampler, TensorDataset)
+from transformers import BertConfig, BertTokenizer
+
+import models
+from models import head_rank_from_state_dict
+from pruning import load_pruning_plan, prune_encoder
+from checkpoints import checkpoint_config, read_state_dict, empty_model, load_checkpoint
+from cascade import (linear_tokenizer, load_linear_model, linear_scores, calibrate_threshold, select_candidates, cascade_recall,
+                     candidate_lists, save_thresholds)
+from train_4DD import Bert_v7, DCDProcessor, convert_examples_to_features, prep_tensor_data
+from train_baseline import CDDataset, collate_fn_cd, read_line_dicts
+from parity_4DD import read_4DD_file, predict, dev_scores
+
+
+def predict_pairs(model, data_loader, lines, reversed_filename_to_filename_id, mode='dev'):
+    '''
+    inference_baseline's pass over a CDDataset -> dev lines, pairwise hits, seconds
+    '''
+    model.eval()
+    device=next(model.parameters()).device
+    scores={}
+    seconds=0.
+    for d in data_loader:
+        d={key: val.to(device) for key, val in d.items()}
+        start=time.perf_counter()
+        with torch.no_grad():
+            outputs=model(d)
+        seconds += time.perf_counter() - start
+        for filename_id, utterance_of_interest_id, candidate_line_id, logit in \
+                zip(outputs['filename_id'].tolist(), outputs['utterance_of_interest_id'].tolist(), outputs['candidate_line_id'].tolist(), outputs['logits'].view(-1).tolist()):
+            scores.setdefault((filename_id, utterance_of_interest_id), []).append((candidate_line_id, logit))
+
+    pred_lines, threads_predicted=[], {}
+    correct, total=0, 0
+    for (filename_id, utterance_of_interest_id), candidates in sorted(scores.items()):
+        filename=reversed_filename_to_filename_id[filename_id]
+        best_parent_id=max(candidates, key=lambda tup: tup[1])[0]
+        if best_parent_id == utterance_of_interest_id:
+            final_pred=f"T{threads_predicted.get(filename, 0)}"
+            threads_predicted[filename]=threads_predicted.get(filename, 0) + 1
+        else:
+            final_pred=f"D{best_parent_id}"
+        pred_lines.append((filename, f"D{utterance_of_interest_id}", final_pred))
+
+        gold_parent=lines[mode][(filename_id, f"D{utterance_of_interest_id}")]['reply_to_id']
+        if gold_parent:
+            correct += int(final_pred == gold_parent or (final_pred.startswith('T') and gold_parent.startswith('T')))
+            total += 1
+    return pred_lines, correct/max(total, 1), seconds
+
+if __name__=='__main__':
+
+    arg_parser=argparse.ArgumentParser()
+    arg_parser.add_argument('--linear_model_path', help='train_linear checkpoint')
+    arg_parser.add_argument('--linear_model_name', default='bert-base-cased', help='train_linear --model_name')
+    arg_parser.add_argument('--model_path', help='Bert_v7 checkpoint (train_4DD output), or models.py checkpoint with --encoder_name')
+    arg_parser.add_argument('--model_name', default='bert-base-cased', help='specify model_name')
+    arg_parser.add_argument('--encoder_name', default='', help='models.py class of model_path, empty for Bert_v7')
+    arg_parser.add_argument('--dev_file', help='dev tsv, in the train_4DD format')
+    arg_parser.add_argument("--max_previous_utterance",
+                        default=50,
+                        type=int,
+                        help="as given to train_4DD")
+    arg_parser.add_argument("--context_lines",
+                        default=0,
+                        type=int,
+                        help="as given to train_baseline")
+    arg_parser.add_argument("--late_interaction",
+                        default=0,
+                        type=int,
+                        help="as given to train_baseline")
+    arg_parser.add_argument("--batch_size",
+                        default=4,
+                        type=int,
+                        help="specific batch_size.")
+    arg_parser.add_argument('--recalls', default='0.9,0.95,0.98,0.99,1.0', help='comma separated dev recalls to calibrate a threshold for')
+    arg_parser.add_argument('--top_ks', default='', help='comma separated top-k caps to report, without a threshold')
+    arg_parser.add_argument("--threads",
+                        default=0,
+                        type=int,
+                        help="torch CPU threads, 0 keeps the default")
+
+    args=vars(arg_parser.parse_args())
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s', datefmt='%m-%d %H:%M')
+    logger=logging.getLogger(__name__)
+
+    if args['threads']:
+        torch.set_num_threads(args['threads'])
+
+    max_previous_utterance=args['max_previous_utterance']
+    dev_file=pathlib.Path(args['dev_file'])
+    window=max_previous_utterance-1 if not args['encoder_name'] else 10 # train_baseline.CDDataset.max_candidates
+
+    linear_dicts=read_line_dicts({'dev': dev_file})
+    linear_model=load_linear_model(args['linear_model_path'])
+    scores, linear_seconds=linear_scores(linear_model, linear_tokenizer(args['linear_model_name']), window, 'dev', *linear_dicts)
+    num_pairs=sum(len(candidates) for candidates in scores.values())
+    logger.info(f"{dev_file}: {len(scores)} utterances, {num_pairs} candidate pairs in a window of {window}; linear scores in {linear_seconds:.2f}s ({num_pairs/linear_seconds:.0f} pairs/s)")
+
+    settings=[]
+    thresholds={}
+    for recall in [float(r) for r in args['recalls'].split(',') if r]:
+        thresholds[recall]=calibrate_threshold(scores, recall)
+        settings.append((f"recall {recall}", select_candidates(scores, thresholds[recall])))
+    for top_k in [int(k) for k in args['top_ks'].split(',') if k]:
+        settings.append((f"top {top_k}", select_candidates(scores, top_k=top_k)))
+    save_thresholds(thresholds, args['linear_model_path'])
+
+    if not args['encoder_name']:
+        tokenizer=BertTokenizer.from_pretrained(args['model_name'], do_lower_case=False, do_basic_tokenize=False)
+        processor=DCDProcessor()
+        label_list=processor.get_labels(max_previous_utterance)
+        lines, line_id2line_text, line_id2scene_id, line_id2speaker_n, scene_id2line_ids, reversed_filename_to_filename_id, gold=read_4DD_file(dev_file)
+
+        config=checkpoint_config(args['model_path'], BertConfig) or BertConfig.from_pretrained(args['model_name'], num_labels=len(label_list))
+        model=empty_model(lambda: Bert_v7(config))
+        plan=load_pruning_plan(args['model_path'])
+        if plan is not None:
+            prune_encoder(model.bert, plan)
+        load_checkpoint(model, args['model_path'])
+        model.unique_choices=True # padding and pruned slots are encoded once per utterance
+        model.eval()
+
+        def evaluate(kept):
+            cascade=candidate_lists(kept, lines, 'dev', reversed_filename_to_filename_id, max_previous_utterance)
+            dev_examples, _=processor.get_examples(tokenizer, 'dev', reversed_filename_to_filename_id, line_id2line_text, line_id2speaker_n,
+                                                   scene_id2line_ids, line_id2scene_id, max_previous_utterance, lines, cascade)
+            dev_data=TensorDataset(*prep_tensor_data(convert_examples_to_features(dev_examples, label_list, tokenizer.model_max_length, max_previous_utterance, tokenizer)))
+            _, pred_lines, pairwise_accuracy, seconds, _=predict(model, DataLoader(dev_data, sampler=SequentialSampler(dev_data), batch_size=args['batch_size']),
+                                                                 reversed_filename_to_filename_id, mask_padding=True)
+            return dev_scores(gold, pred_lines, pairwise_accuracy), seconds
+    else:
+        gold=read_4DD_file(dev_file)[-1]
+        lines, filename_to_filename_id=linear_dicts[0], linear_dicts[1]
+        reversed_filename_to_filename_id={v: k for k, v in filename_to_filename_id.items()}
+
+        state_dict=read_state_dict(args['model_path'])
+        model_args={'model_name': args['model_name'],
+                    'fix_encoder': 0,
+                    'from_checkpoint': 1,
+                    'context_lines': args['context_lines'],
+                    'late_interaction': args['late_interaction'],
+                    'distance_embedding_dim': state_dict['distance_embeddings.weight'].shape[0],
+                    'distance_embedding_size': state_dict['distance_embeddings.weight'].shape[1],
+                    'head_rank': head_rank_from_state_dict(state_dict)}
+        model=empty_model(lambda: getattr(models, args['encoder_name'])(model_args))
+        plan=load_pruning_plan(args['model_path'])
+        if plan is not None:
+            prune_encoder(model.utterance_encoder, plan)
+        load_checkpoint(model, state_dict)
+        model.eval()
+
+        def evaluate(kept):
+            cascade=candidate_lists(kept, lines, 'dev', reversed_filename_to_filename_id)
+            dev_dataset=CDDataset(*linear_dicts, model.utterance_encoder_tokenizer, 'dev', model.SEQUENCE_MAX_LEN, context_lines=args['context_lines'], candidate_lists=cascade)
+            pred_lines, pairwise_accuracy, seconds=predict_pairs(model, DataLoader(dev_dataset, batch_size=args['batch_size'], collate_fn=collate_fn_cd),
+                                                                 lines, reversed_filename_to_filename_id)
+            return dev_scores(gold, pred_lines, pairwise_accuracy), seconds
+
+    full_scores, full_seconds=evaluate(select_candidates(scores)) # every candidate of the window, nothing pruned
+    logger.info(f"{'window':>12}: " + '; '.join(f"{k}: {v:.2f}" for k, v in full_scores.items()) + f"; {num_pairs/len(scores):.1f} candidates per utterance; {full_seconds:.2f}s")
+    for name, kept in settings:
+        recall, candidates_kept=cascade_recall(scores, kept)
+        cascade_scores, seconds=evaluate(kept)
+        threshold=f"threshold {thresholds[float(name.split()[1])]:.4f}; " if name.startswith('recall') else ''
+        logger.info(f"{name:>12}: {threshold}gold parents kept: {recall*100:.2f}%; {candidates_kept:.1f} candidates per utterance; " +
+                    '; '.join(f"{k}: {v:.2f} ({v-full_scores[k]:+.2f})" for k, v in cascade_scores.items()) +
+                    f"; {linear_seconds:.2f}s + {seconds:.2f}s, speedup {full_seconds/(linear_seconds+seconds):.2f}x")
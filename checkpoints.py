@@ -0,0 +1,84 @@
+import json
+import torch
+from accelerate import init_empty_weights
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+from models import drop_legacy_keys
+from lora import adapter_state_dict, merge_adapter
+
+
+################################################################################
+# Checkpoints as .safetensors, with the model config in the file's metadata (the
+# trainers also write the tokenizer next to them, in the output folder). Loading
+# builds the model with its parameters on the meta device (no random init, no
+# pretrained weights read just to be overwritten) and assigns the checkpoint
+# tensors in place of them: .safetensors and .bin files are memory-mapped, so the
+# weights are read once, straight from the page cache, and not copied again.
+#
+# .bin checkpoints from before keep loading; without a config in the file the
+# scripts fall back to the --model_name config. LoRA checkpoints (lora.py) only
+# hold the adapter, read_state_dict merges it into the pretrained encoder.
+
+def save_checkpoint(model, path, config=None, args=None, lora=None):
+    '''
+    config: the model's PretrainedConfig (Bert_v7) or encoder config (models.py), args: the models.py args
+    lora: lora.lora_settings of a model trained with attach_lora, saves the adapter only
+    '''
+    metadata={'format': 'pt'}
+    if config is not None:
+        metadata['config']=config.to_json_string()
+    if args is not None:
+        metadata['args']=json.dumps({k: v for k, v in args.items() if isinstance(v, (str, int, float, bool, type(None)))})
+    if lora is not None:
+        metadata['lora']=json.dumps(lora)
+    state_dict={k: v.detach().contiguous() for k, v in (adapter_state_dict(model, lora) if lora is not None else model.state_dict()).items()}
+    save_file(state_dict, str(path), metadata=metadata)
+
+def checkpoint_metadata(path):
+    if not str(path).endswith('.safetensors'):
+        return {}
+    with safe_open(str(path), framework='pt') as f:
+        return f.metadata() or {}
+
+def checkpoint_config(path, config_class):
+    '''
+    config_class instance saved with the checkpoint, None for .bin checkpoints
+    '''
+    metadata=checkpoint_metadata(path)
+    if 'config' not in metadata:
+        return None
+    return config_class.from_dict(json.loads(metadata['config']))
+
+def checkpoint_args(path):
+    return json.loads(checkpoint_metadata(path).get('args', '{}'))
+
+def read_state_dict(path):
+    '''
+    memory-mapped, on CPU; LoRA adapters come back merged, as a dense state dict
+    '''
+    if str(path).endswith('.safetensors'):
+        state_dict={}
+        with safe_open(str(path), framework='pt', device='cpu') as f:
+            for k in f.keys():
+                state_dict[k]=f.get_tensor(k)
+            metadata=f.metadata() or {}
+        if 'lora' in metadata:
+            return merge_adapter(state_dict, json.loads(metadata['lora']))
+        return state_dict
+    return torch.load(str(path), map_location='cpu', mmap=True, weights_only=True)
+
+def empty_model(build):
+    '''
+    build(): the model constructor call; parameters on the meta device, buffers (position ids) real
+    '''
+    with init_empty_weights(include_buffers=False):
+        return build()
+
+def load_checkpoint(model, path_or_state_dict):
+    '''
+    assigns the checkpoint tensors to the (empty) model, strict: every parameter has to come from the checkpoint
+    '''
+    state_dict=read_state_dict(path_or_state_dict) if not isinstance(path_or_state_dict, dict) else path_or_state_dict
+    model.load_state_dict(drop_legacy_keys(state_dict, model), assign=True)
+    return model
@@ -0,0 +1,278 @@
+########
+# Knowledge distillation of a trained Bert_v7 (teacher) into a Bert_v7 on a smaller BERT (student):
+# same MHA / MyLSTM / pooler / classifier, hidden sizes follow the student config.
+# The teacher's per-choice logits over the train and any unlabeled screenplays are computed
+# once and cached; the student learns from them (soft targets, temperature T) and, where there is
+# an annotation, from the gold parent. The dev file stays out of training, it only picks the best epoch.
+#
+# The output folder is a --model_name for inference_4DD (config and tokenizer) and holds
+# the best dev checkpoint as a --model_path
+########
+import os
+import logging
+import argparse
+import pathlib
+import datetime
+import datasets
+import transformers
+import torch
+import torch.nn.functional as F
+from tqdm import tqdm
+from torch import optim
+from torch.utils.data import (DataLoader, RandomSampler, SequentialSampler, TensorDataset)
+from transformers import BertConfig, BertTokenizer
+from accelerate import Accelerator, DistributedDataParallelKwargs
+from accelerate.logging import get_logger
+
+from embedding_cache import fingerprint_state_dict
+from train_4DD import Bert_v7, DCDProcessor, convert_examples_to_features, prep_tensor_data
+from parity_4DD import read_4DD_file, predict, dev_scores
+from shape_buckets import attach_compiled_encoder, compile_report
+from checkpoints import save_checkpoint, checkpoint_config, read_state_dict, empty_model, load_checkpoint
+
+
+def main_log(msg):
+    global logger
+    return logger.info(msg, main_process_only=True)
+
+def read_examples(paths, tokenizer, processor, max_previous_utterance, labeled):
+    examples=[]
+    for path in paths:
+        lines, line_id2line_text, line_id2scene_id, line_id2speaker_n, scene_id2line_ids, reversed_filename_to_filename_id, _=\
+            read_4DD_file(path, 'train', labeled)
+        file_examples, _=processor.get_examples(tokenizer, 'train',
+                                                reversed_filename_to_filename_id,
+                                                line_id2line_text,
+                                                line_id2speaker_n,
+                                                scene_id2line_ids,
+                                                line_id2scene_id,
+                                                max_previous_utterance,
+                                                lines)
+        examples.extend(file_examples)
+    return examples
+
+def teacher_logits(teacher, features, batch_size, device, use_tqdm=False):
+    '''
+    num_examples * num_choices, float32 on CPU
+    '''
+    data=TensorDataset(*prep_tensor_data(features))
+    data_loader=DataLoader(data, sampler=SequentialSampler(data), batch_size=batch_size)
+    teacher.to(device).eval()
+    logits=[]
+    for batch in (tqdm(data_loader) if use_tqdm else data_loader):
+        d={
+            'input_ids': batch[0],
+            'attention_mask': batch[1],
+            'token_type_ids': batch[2],
+            'adj_matrix_speaker': batch[3],
+            'adj_matrix_scene': batch[4]
+        }
+        d={key: val.to(device) for key, val in d.items()}
+        with torch.no_grad():
+            logits.append(teacher(**d)['logits'].float().cpu())
+    return torch.cat(logits)
+
+def distillation_loss(student_logits, teacher_logits, labels, labeled, temperature, alpha):
+    '''
+    alpha * T^2 * KL(teacher || student) at temperature T, plus (1-alpha) * cross entropy on the labeled examples
+    '''
+    soft=F.kl_div(F.log_softmax(student_logits/temperature, dim=-1), F.softmax(teacher_logits/temperature, dim=-1),
+                  reduction='batchmean') * temperature**2
+    if alpha == 1. or not labeled.any():
+        return soft
+    hard=F.cross_entropy(student_logits[labeled], labels[labeled])
+    return alpha*soft + (1-alpha)*hard
+
+if __name__=='__main__':
+
+    arg_parser=argparse.ArgumentParser()
+    arg_parser.add_argument('--teacher_path', help='Bert_v7 checkpoint (train_4DD output)')
+    arg_parser.add_argument('--teacher_model_name', default='bert-base-cased', help='pretrained encoder of the teacher')
+    arg_parser.add_argument('--student_model_name', help='smaller BERT the student starts from, e.g. a 4 or 6 layer checkpoint')
+    arg_parser.add_argument('--train_file', help='specify train_file')
+    arg_parser.add_argument('--dev_file', help='specify dev_file')
+    arg_parser.add_argument('--unlabeled_folder', default=None, help='*.tsv screenplays in the train_4DD format, the anno column may be empty')
+    arg_parser.add_argument('--model_output', help='folder for the student')
+    arg_parser.add_argument('--logits_cache', default='teacher_logits.pt', help='teacher logits, reused while teacher and data are the same')
+    arg_parser.add_argument('--epochs', help='specify epochs', default=8)
+    arg_parser.add_argument("--max_previous_utterance",
+                        default=50,
+                        type=int,
+                        help="The maximum of previous utterances considerated.")
+    arg_parser.add_argument("--batch_size",
+                        default=4,
+                        type=int,
+                        help="specific batch_size.")
+    arg_parser.add_argument("--learning_rate",
+                        default=5e-5,
+                        type=float,
+                        help="student learning rate")
+    arg_parser.add_argument("--temperature",
+                        default=2.,
+                        type=float,
+                        help="softmax temperature of the soft targets")
+    arg_parser.add_argument("--alpha",
+                        default=0.9,
+                        type=float,
+                        help="weight of the soft targets, 1-alpha goes to the gold parent")
+    arg_parser.add_argument("--compile",
+                        default=0,
+                        type=int,
+                        help="torch.compile the encoder, one graph per shape bucket (shape_buckets.py)")
+    arg_parser.add_argument('--compile_cache', default='compile_cache', help='folder for the compiled graphs, reused across runs')
+    arg_parser.add_argument("--use_tqdm",
+                        default=False,
+                        type=bool,
+                        help="Use tqdm?")
+
+    args=vars(arg_parser.parse_args())
+
+    args['epochs']=int(args['epochs'])
+    OUTPUT_PATH=pathlib.Path(args['model_output'])
+    OUTPUT_PATH.mkdir(exist_ok=True)
+    use_tqdm=args['use_tqdm']
+    BATCH_SIZE=args['batch_size']
+    max_previous_utterance=args['max_previous_utterance']
+
+    ddp_kwargs=DistributedDataParallelKwargs(find_unused_parameters=False, static_graph=True)
+    accelerator=Accelerator(kwargs_handlers=[ddp_kwargs])
+
+    timestamp=datetime.datetime.now().strftime("%m%d%Y-%H%M%S")
+    logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s %(message)s',
+                    datefmt='%m-%d %H:%M',
+                    filename=os.path.join(str(OUTPUT_PATH), f"distill_{timestamp}.log"),
+                    filemode='w')
+    console=logging.StreamHandler()
+    console.setLevel(logging.INFO)
+    formatter=logging.Formatter('%(message)s')
+    console.setFormatter(formatter)
+    logging.getLogger('').addHandler(console)
+
+    datasets.utils.logging.set_verbosity_error()
+    transformers.utils.logging.set_verbosity_error()
+
+    logger=get_logger(__name__)
+
+    transformers.set_seed(2022)
+    accelerator.wait_for_everyone()
+
+    processor=DCDProcessor()
+    label_list=processor.get_labels(max_previous_utterance)
+
+    train_paths=[pathlib.Path(args['train_file'])]
+    dev_path=pathlib.Path(args['dev_file'])
+    unlabeled_paths=sorted(pathlib.Path(args['unlabeled_folder']).glob('*.tsv')) if args['unlabeled_folder'] else []
+
+    ######
+    # teacher
+    teacher_tokenizer=BertTokenizer.from_pretrained(args['teacher_model_name'], do_lower_case=False, do_basic_tokenize=False)
+    teacher_examples=read_examples(train_paths, teacher_tokenizer, processor, max_previous_utterance, True)+\
+                     read_examples(unlabeled_paths, teacher_tokenizer, processor, max_previous_utterance, False)
+    main_log(f"{len(teacher_examples)} utterances, {len(unlabeled_paths)} unlabeled screenplays")
+
+    teacher_state_dict=read_state_dict(args['teacher_path'])
+    cache_key=f"{fingerprint_state_dict(teacher_state_dict)}:{max_previous_utterance}:"+\
+              ','.join(f"{p.name}:{os.path.getsize(p)}" for p in train_paths+unlabeled_paths)
+    cached=torch.load(args['logits_cache']) if os.path.exists(args['logits_cache']) else None
+    if cached is not None and cached['key'] == cache_key:
+        all_teacher_logits=cached['logits']
+        main_log(f"Teacher logits from {args['logits_cache']}")
+    else:
+        if accelerator.is_main_process:
+            teacher_config=checkpoint_config(args['teacher_path'], BertConfig) or BertConfig.from_pretrained(args['teacher_model_name'], num_labels=len(label_list))
+            teacher=load_checkpoint(empty_model(lambda: Bert_v7(teacher_config)), teacher_state_dict)
+            main_log('Running the teacher ...')
+            teacher_features=convert_examples_to_features(teacher_examples, label_list, teacher_tokenizer.model_max_length, max_previous_utterance, teacher_tokenizer)
+            torch.save({'key': cache_key, 'logits': teacher_logits(teacher, teacher_features, BATCH_SIZE, accelerator.device, use_tqdm)}, args['logits_cache'])
+            del teacher, teacher_features
+        accelerator.wait_for_everyone()
+        all_teacher_logits=torch.load(args['logits_cache'])['logits']
+    del teacher_state_dict
+
+    ######
+    # student: same examples (in the same order), its own tokenizer
+    tokenizer=BertTokenizer.from_pretrained(args['student_model_name'], do_lower_case=False, do_basic_tokenize=False)
+    labeled_examples=read_examples(train_paths, tokenizer, processor, max_previous_utterance, True)
+    unlabeled_examples=read_examples(unlabeled_paths, tokenizer, processor, max_previous_utterance, False)
+    assert len(labeled_examples)+len(unlabeled_examples) == len(all_teacher_logits)
+    labeled=torch.tensor([True]*len(labeled_examples) + [False]*len(unlabeled_examples))
+
+    config=BertConfig.from_pretrained(args['student_model_name'], num_labels=len(label_list))
+    model=Bert_v7.from_pretrained(args['student_model_name'], config=config)
+    if accelerator.is_main_process: # the output folder also works as --model_name for inference
+        config.save_pretrained(str(OUTPUT_PATH))
+        tokenizer.save_pretrained(str(OUTPUT_PATH))
+    SEQUENCE_MAX_LEN=tokenizer.model_max_length
+    main_log(f"Student: {args['student_model_name']}, {config.num_hidden_layers} layers, hidden {config.hidden_size}")
+
+    train_tensors=prep_tensor_data(convert_examples_to_features(labeled_examples+unlabeled_examples, label_list, SEQUENCE_MAX_LEN, max_previous_utterance, tokenizer))
+    train_data=TensorDataset(*train_tensors, all_teacher_logits, labeled)
+    data_loader=DataLoader(train_data, sampler=RandomSampler(train_data), batch_size=BATCH_SIZE)
+
+    lines, line_id2line_text, line_id2scene_id, line_id2speaker_n, scene_id2line_ids, reversed_dev_filename_to_filename_id, gold=\
+        read_4DD_file(dev_path, 'dev')
+    dev_examples=read_examples([dev_path], tokenizer, processor, max_previous_utterance, True)
+    dev_data=TensorDataset(*prep_tensor_data(convert_examples_to_features(dev_examples, label_list, SEQUENCE_MAX_LEN, max_previous_utterance, tokenizer)))
+    dev_data_loader=DataLoader(dev_data, sampler=SequentialSampler(dev_data), batch_size=BATCH_SIZE)
+
+    ### OPTIMIZER
+    param_optimizer=list(model.named_parameters())
+    no_decay=['bias', 'LayerNorm.bias', 'LayerNorm.weight']
+    optimizer_grouped_parameters = [
+        {'params': [p for n, p in param_optimizer if not any(nd in n for nd in no_decay)], 'weight_decay': 0.01},
+        {'params': [p for n, p in param_optimizer if any(nd in n for nd in no_decay)], 'weight_decay': 0.0}
+    ]
+    optimizer=optim.AdamW(optimizer_grouped_parameters, lr=args["learning_rate"])
+
+    if args['compile']:
+        attach_compiled_encoder(model.bert, [SEQUENCE_MAX_LEN], [BATCH_SIZE*len(label_list)], args['compile_cache'])
+        main_log(f"Compiled student encoder, cache: {args['compile_cache']}")
+
+    model, optimizer, data_loader=accelerator.prepare(model, optimizer, data_loader)
+
+    if use_tqdm:
+        progress_bar=tqdm(total=args["epochs"]*len(data_loader))
+
+    best_eval_metric=0.
+    main_log('Distillation starts ...')
+    for epoch in range(args["epochs"]):
+        main_log("Epoch:{}".format(epoch+1))
+        model.train()
+        train_loss=0
+        for i, batch in enumerate(data_loader):
+            d={
+                'input_ids': batch[0],
+                'attention_mask': batch[1],
+                'token_type_ids': batch[2],
+                'adj_matrix_speaker': batch[3],
+                'adj_matrix_scene': batch[4]
+            }
+            outputs=model(**d)
+            loss=distillation_loss(outputs['logits'], batch[11], batch[9], batch[12], args['temperature'], args['alpha'])
+            train_loss += loss.detach().item()
+            accelerator.backward(loss)
+            optimizer.step()
+            optimizer.zero_grad()
+
+            if use_tqdm:
+                progress_bar.update(1)
+                progress_bar.set_description("distillation Loss: {:.4f}".format(train_loss/(i+1)))
+
+        accelerator.wait_for_everyone()
+        if accelerator.is_main_process:
+            unwrapped_model=accelerator.unwrap_model(model)
+            _, pred_lines, pairwise_accuracy, _, _=predict(unwrapped_model, dev_data_loader, reversed_dev_filename_to_filename_id)
+            scores=dev_scores(gold, pred_lines, pairwise_accuracy)
+            main_log('; '.join(f"{k}: {v:.2f}" for k, v in scores.items()))
+            eval_metric=0.2*scores['pairwise']/100+0.8*(scores['ari']+scores['1-vi']+scores['shen']+scores['em-f'])/4
+            if eval_metric>best_eval_metric:
+                best_eval_metric=eval_metric
+                best_model_path=f"pytorch_model-{timestamp}-epoch{epoch}.safetensors"
+                main_log(f"^ New best -- Model saved: {best_model_path}")
+                save_checkpoint(unwrapped_model, OUTPUT_PATH.joinpath(best_model_path), unwrapped_model.config)
+        accelerator.wait_for_everyone()
+
+    if args['compile']:
+        for line in compile_report(accelerator.unwrap_model(model).bert):
+            main_log(f"Compile: {line}")
@@ -0,0 +1,97 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from frozen_layers import extended_attention_mask
+
+
+################################################################################
+# Early exit for pair scoring: after some encoder layers a linear head reads the
+# CLS vector of each (candidate, utterance) sequence and predicts whether the
+# candidate is the parent. In eval mode a sequence whose probability falls below
+# the threshold stops there. Most candidates (other scene, far away, padding) are
+# easy negatives. An exited choice's CLS is only as of its exit layer, so Bert_v7
+# leaves it out of the choice graph (the SASelfMHA keys and the LSTM steps) and
+# ranks it last: the other choices score as if it was not there. The first choice,
+# the utterance itself, never exits, every choice is compared against it.
+#
+# The heads read detached hidden states, so training them alongside the model
+# (exit_loss added to the loss) does not change what the rest of it learns.
+
+class ExitHeads(nn.Module):
+    def __init__(self, hidden_size, layers):
+        super().__init__()
+        self.layers=sorted(layers)
+        self.heads=nn.ModuleList([nn.Linear(hidden_size, 1) for _ in self.layers])
+
+    def forward(self, hidden_states):
+        '''
+        hidden_states: BertModel(output_hidden_states=True) hidden_states, embeddings first
+        -> num_sequences * num_exits logits
+        '''
+        return torch.cat([head(hidden_states[layer][:, 0].detach()) for layer, head in zip(self.layers, self.heads)], 1)
+
+def attach_exit_heads(model, encoder, layers, threshold=0.):
+    '''
+    layers: 1-based, exit after encoder.encoder.layer[k-1]; call before the checkpoint is loaded
+    threshold: 0 runs every layer (training, and the dev pass while training)
+    '''
+    assert all(0 < k < len(encoder.encoder.layer) for k in layers)
+    model.exit_heads=ExitHeads(encoder.config.hidden_size, layers)
+    model.exit_threshold=threshold
+    return model
+
+def exit_loss(exit_logits, labels, num_choices):
+    '''
+    exit_logits: (batch_size * num_choice) * num_exits, labels: index of the parent choice
+    '''
+    targets=F.one_hot(labels, num_choices).view(-1, 1).to(exit_logits.dtype).expand_as(exit_logits)
+    return F.binary_cross_entropy_with_logits(exit_logits, targets)
+
+def encode_with_early_exit(encoder, exit_heads, input_ids, attention_mask, token_type_ids, threshold, never_exit=None):
+    '''
+    CLS of every sequence after the last layer, or after the first exit layer where
+    sigmoid(exit logit) < threshold; sequences are right padded
+    never_exit: bool per sequence, those run every layer
+
+    -> cls (num_sequences * hidden), exit logit (0 if the sequence ran every layer),
+       exited (bool), number of layers run
+    '''
+    num_sequences, num_layers=input_ids.size(0), len(encoder.encoder.layer)
+    max_len=max(int(attention_mask.sum(1).max()), 1)
+    input_ids, attention_mask=input_ids[:, :max_len], attention_mask[:, :max_len]
+    token_type_ids=None if token_type_ids is None else token_type_ids[:, :max_len]
+
+    hidden=encoder.embeddings(input_ids=input_ids, token_type_ids=token_type_ids)
+    extended_mask=extended_attention_mask(attention_mask, hidden.dtype)
+
+    cls=hidden.new_zeros(num_sequences, hidden.size(-1))
+    exit_logits=hidden.new_zeros(num_sequences)
+    exited=torch.zeros(num_sequences, dtype=torch.bool, device=input_ids.device)
+    layers_run=torch.full((num_sequences,), num_layers, dtype=torch.long, device=input_ids.device)
+    active=torch.arange(num_sequences, device=input_ids.device)
+    exits=dict(zip(exit_heads.layers, exit_heads.heads))
+
+    for k, layer in enumerate(encoder.encoder.layer, 1):
+        hidden=layer(hidden, attention_mask=extended_mask)
+        hidden=hidden[0] if isinstance(hidden, tuple) else hidden
+        if k not in exits:
+            continue
+        logits=exits[k](hidden[:, 0]).squeeze(-1)
+        stop=torch.sigmoid(logits) < threshold
+        if never_exit is not None:
+            stop=stop & ~never_exit[active]
+        if not stop.any():
+            continue
+        rows=active[stop]
+        cls[rows]=hidden[stop, 0]
+        exit_logits[rows]=logits[stop]
+        exited[rows]=True
+        layers_run[rows]=k
+        active, hidden, extended_mask=active[~stop], hidden[~stop], extended_mask[~stop]
+        if active.numel() == 0:
+            break
+
+    if active.numel():
+        cls[active]=hidden[:, 0]
+    return cls, exit_logits, exited, layers_run
@@ -0,0 +1,84 @@
+import os
+import time
+import sqlite3
+import hashlib
+import numpy as np
+
+
+class EmbeddingCache(object):
+    '''
+    Disk-backed LRU cache of encoder outputs (sqlite, float16).
+
+    keys are built by the caller, e.g. (encoder checkpoint hash, max_length, token ids hash);
+    values are numpy arrays of any shape, stored as float16 and returned as float32.
+    '''
+    def __init__(self, path, max_entries=1000000):
+        self.path=str(path)
+        self.max_entries=max_entries
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        self.conn=sqlite3.connect(self.path, timeout=60)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, shape TEXT, data BLOB, last_used INTEGER)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)')
+        self.conn.commit()
+
+        self.hits, self.misses=0, 0
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+
+    def get_many(self, keys):
+        found={}
+        unique_keys=list(set(keys))
+        for start in range(0, len(unique_keys), 500): # sqlite caps the number of bound variables
+            chunk=unique_keys[start:start+500]
+            rows=self.conn.execute(
+                f"SELECT key, shape, data FROM embeddings WHERE key IN ({','.join('?'*len(chunk))})", chunk
+            ).fetchall()
+            for key, shape, data in rows:
+                shape=tuple(int(s) for s in shape.split(',') if s)
+                found[key]=np.frombuffer(data, dtype=np.float16).reshape(shape).astype(np.float32)
+
+        if found:
+            now=time.time_ns()
+            self.conn.executemany('UPDATE embeddings SET last_used=? WHERE key=?', [(now, key) for key in found])
+            self.conn.commit()
+
+        self.hits+=sum(1 for key in keys if key in found)
+        self.misses+=sum(1 for key in keys if key not in found)
+        return found
+
+    def put_many(self, items):
+        now=time.time_ns()
+        rows=[]
+        for key, value in items.items():
+            value=np.asarray(value, dtype=np.float16)
+            rows.append((key, ','.join(str(s) for s in value.shape), value.tobytes(), now))
+        self.conn.executemany('INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)', rows)
+        self.conn.commit()
+        self.evict()
+
+    def evict(self):
+        overflow=len(self) - self.max_entries
+        if overflow > 0:
+            self.conn.execute('DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used ASC LIMIT ?)', (overflow,))
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def fingerprint_state_dict(state_dict):
+    sha=hashlib.sha1()
+    for name in sorted(state_dict.keys()):
+        sha.update(name.encode())
+        sha.update(state_dict[name].detach().cpu().contiguous().numpy().tobytes())
+    return sha.hexdigest()[:16]
+
+def hash_token_ids(token_ids):
+    '''
+    token_ids: 1-d LongTensor, padding (0) is stripped so the key does not depend on the batch
+    '''
+    token_ids=token_ids[token_ids > 0].cpu().long().numpy()
+    return hashlib.sha1(token_ids.tobytes()).hexdigest()
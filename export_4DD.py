@@ -0,0 +1,78 @@
+########
+# Export of a trained Bert_v7 (exported.py) to TorchScript (.pt) and / or ONNX (.onnx), with
+# dynamic batch and sequence axes; inference_4DD --exported runs the result. The traced graph is
+# checked against the eager model on a second, differently shaped batch
+########
+import logging
+import argparse
+import pathlib
+import torch
+from transformers import BertConfig, BertTokenizer
+
+from pruning import load_pruning_plan, prune_encoder
+from exported import export_torchscript, export_onnx, ExportedBert_v7
+from checkpoints import checkpoint_config, empty_model, load_checkpoint
+from train_4DD import Bert_v7, DCDProcessor
+
+
+def example_inputs(batch_size, num_labels, seq_len, vocab_size):
+    '''
+    random ids, a padded tail and full adjacency: only the shapes and dtypes matter to the trace
+    '''
+    input_ids=torch.randint(1, vocab_size, (batch_size, num_labels, seq_len))
+    attention_mask=torch.ones_like(input_ids)
+    attention_mask[:, :, seq_len*3//4:]=0
+    token_type_ids=torch.zeros_like(input_ids)
+    token_type_ids[:, :, seq_len//2:]=1
+    adj=torch.ones((batch_size, num_labels, num_labels), dtype=torch.long)
+    return input_ids, attention_mask, token_type_ids, adj, adj.clone()
+
+if __name__=='__main__':
+
+    arg_parser=argparse.ArgumentParser()
+    arg_parser.add_argument('--model_path', help='Bert_v7 checkpoint (train_4DD output)')
+    arg_parser.add_argument('--model_name', default='bert-base-cased', help='specify model_name')
+    arg_parser.add_argument('--output', help='path without extension, .pt / .onnx are added')
+    arg_parser.add_argument('--formats', default='torchscript,onnx', help='comma separated, of torchscript, onnx')
+    arg_parser.add_argument("--max_previous_utterance",
+                        default=50,
+                        type=int,
+                        help="as given to train_4DD, fixed in the exported graph")
+    arg_parser.add_argument("--opset",
+                        default=17,
+                        type=int,
+                        help="ONNX opset version")
+
+    args=vars(arg_parser.parse_args())
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s', datefmt='%m-%d %H:%M')
+    logger=logging.getLogger(__name__)
+
+    tokenizer=BertTokenizer.from_pretrained(args['model_name'], do_lower_case=False, do_basic_tokenize=False)
+    label_list=DCDProcessor().get_labels(args['max_previous_utterance'])
+    num_labels=len(label_list)
+
+    config=checkpoint_config(args['model_path'], BertConfig) or BertConfig.from_pretrained(args['model_name'], num_labels=num_labels)
+    config._attn_implementation='eager' # no data dependent mask shortcuts in the trace
+    model=empty_model(lambda: Bert_v7(config))
+    plan=load_pruning_plan(args['model_path'])
+    if plan is not None:
+        prune_encoder(model.bert, plan)
+    load_checkpoint(model, args['model_path'])
+    model.eval()
+
+    example=example_inputs(2, num_labels, min(64, tokenizer.model_max_length), config.vocab_size)
+    check=example_inputs(3, num_labels, min(96, tokenizer.model_max_length), config.vocab_size)
+    with torch.no_grad():
+        expected=model(**dict(zip(['input_ids', 'attention_mask', 'token_type_ids', 'adj_matrix_speaker', 'adj_matrix_scene'], check)))['logits']
+
+    for name in args['formats'].split(','):
+        path=pathlib.Path(f"{args['output']}.{'pt' if name == 'torchscript' else 'onnx'}")
+        if name == 'torchscript':
+            export_torchscript(model, example, path)
+        else:
+            export_onnx(model, example, path, args['opset'])
+        exported=ExportedBert_v7(path)
+        with torch.no_grad():
+            logits=exported(*check)['logits']
+        logger.info(f"{name}: {path}; max |logit - eager| on a batch of {check[0].shape}: {(logits - expected).abs().max().item():.2e}")
@@ -0,0 +1,90 @@
+import inspect
+import torch
+import torch.nn as nn
+
+
+################################################################################
+# Bert_v7 as a traced graph (export_4DD.py), TorchScript or ONNX, for CPU inference
+# without the eager Python of forward(). Tracing unrolls the MyLSTM steps and the
+# SASelfMHA layers, so the number of choices (max_previous_utterance) is fixed per
+# export; batch and sequence length stay dynamic. Logits only: exit heads (data
+# dependent) and PackedBert_v7 are not exported.
+
+INPUT_NAMES=['input_ids', 'attention_mask', 'token_type_ids', 'adj_matrix_speaker', 'adj_matrix_scene']
+DYNAMIC_AXES={
+    'input_ids': {0: 'batch', 2: 'sequence'},
+    'attention_mask': {0: 'batch', 2: 'sequence'},
+    'token_type_ids': {0: 'batch', 2: 'sequence'},
+    'adj_matrix_speaker': {0: 'batch'},
+    'adj_matrix_scene': {0: 'batch'},
+    'logits': {0: 'batch'},
+}
+
+class LogitsOnly(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model=model
+
+    def forward(self, input_ids, attention_mask, token_type_ids, adj_matrix_speaker, adj_matrix_scene):
+        return self.model(input_ids=input_ids,
+                          attention_mask=attention_mask,
+                          token_type_ids=token_type_ids,
+                          adj_matrix_speaker=adj_matrix_speaker,
+                          adj_matrix_scene=adj_matrix_scene)['logits']
+
+def export_torchscript(model, example, path):
+    '''
+    example: tuple of INPUT_NAMES tensors
+    '''
+    with torch.no_grad():
+        traced=torch.jit.trace(LogitsOnly(model).eval(), example)
+        traced=torch.jit.freeze(traced)
+    traced.save(str(path))
+    return traced
+
+def export_onnx(model, example, path, opset_version=17):
+    '''
+    the TorchScript-based exporter; torch >= 2.5 defaults to the dynamo one, which does not take dynamic_axes the same way
+    '''
+    kwargs={'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    with torch.no_grad():
+        torch.onnx.export(LogitsOnly(model).eval(), example, str(path),
+                          input_names=INPUT_NAMES,
+                          output_names=['logits'],
+                          dynamic_axes=DYNAMIC_AXES,
+                          opset_version=opset_version,
+                          **kwargs)
+
+class ExportedBert_v7(nn.Module):
+    '''
+    an exported graph (.pt TorchScript, .onnx through onnxruntime) behind Bert_v7's call convention,
+    model(**batch) -> outputs dict; CPU, threads=0 keeps the torch / onnxruntime default
+    '''
+    def __init__(self, path, threads=0):
+        super().__init__()
+        self.session, self.graph=None, None
+        if str(path).endswith('.onnx'):
+            import onnxruntime
+            options=onnxruntime.SessionOptions()
+            options.graph_optimization_level=onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+            if threads:
+                options.intra_op_num_threads=threads
+            self.session=onnxruntime.InferenceSession(str(path), options, providers=['CPUExecutionProvider'])
+        else:
+            if threads:
+                torch.set_num_threads(threads)
+            self.graph=torch.jit.load(str(path), map_location='cpu')
+
+    def forward(self, input_ids=None, attention_mask=None, token_type_ids=None, adj_matrix_speaker=None, adj_matrix_scene=None,
+                filename_ids=None, utterance_of_interest_ids=None, candidate_ids_nested=None, **kwargs):
+        inputs=(input_ids, attention_mask, token_type_ids, adj_matrix_speaker, adj_matrix_scene)
+        if self.session is not None:
+            logits=torch.from_numpy(self.session.run(['logits'], {name: x.cpu().numpy() for name, x in zip(INPUT_NAMES, inputs)})[0])
+        else:
+            logits=self.graph(*inputs)
+        return {
+            "filename_ids": filename_ids,
+            "logits": logits,
+            "utterance_of_interest_ids": utterance_of_interest_ids,
+            "candidate_ids_nested": candidate_ids_nested,
+        }
@@ -0,0 +1,33 @@
+import argparse
+import torch
+from safetensors.torch import save_file
+
+from models import factorize_head_state_dict
+from checkpoints import read_state_dict, checkpoint_metadata
+
+
+if __name__=='__main__':
+
+    arg_parser=argparse.ArgumentParser()
+    arg_parser.add_argument('--checkpoint', help='dense models.py checkpoint (pytorch_model-*.safetensors / .bin)')
+    arg_parser.add_argument('--output', help='where to write the factorized checkpoint')
+    arg_parser.add_argument("--head_rank",
+                        default=256,
+                        type=int,
+                        help="rank of the factorized fc")
+
+    args=vars(arg_parser.parse_args())
+
+    state_dict=dict(read_state_dict(args['checkpoint']))
+    dense=state_dict['fc.weight'].float()
+
+    state_dict=factorize_head_state_dict(state_dict, args['head_rank'])
+    approx=state_dict['fc.up.weight'] @ state_dict['fc.down.weight']
+    error=(torch.linalg.norm(dense - approx) / torch.linalg.norm(dense)).item()
+
+    print(f"fc {tuple(dense.shape)} -> rank {args['head_rank']}: {dense.numel():,} -> {approx.shape[0]*args['head_rank'] + approx.shape[1]*args['head_rank']:,} parameters, relative error {error:.4f}")
+    if args['output'].endswith('.safetensors'):
+        save_file({k: v.contiguous() for k, v in state_dict.items()}, args['output'], metadata=checkpoint_metadata(args['checkpoint']) or {'format': 'pt'})
+    else:
+        torch.save(state_dict, args['output'])
+    print(f"Saved {args['output']} (load it with --head_rank {args['head_rank']})")
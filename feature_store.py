@@ -0,0 +1,107 @@
+import os
+import json
+import torch
+import numpy as np
+from tqdm import tqdm
+
+from embedding_cache import fingerprint_state_dict, hash_token_ids
+
+
+FEATURE_KEYS=['context', 'parent_utterance', 'utterance_of_interest']
+
+
+class FeatureStore(object):
+    '''
+    Precomputed CLS vectors of a frozen utterance_encoder.
+
+    <path>/cls.npy    num_sequences * hidden, float32, opened memory-mapped
+    <path>/index.json token ids hash -> row
+    <path>/meta.json  encoder fingerprint the vectors were computed with
+    '''
+    def __init__(self, path):
+        self.path=str(path)
+        with open(os.path.join(self.path, 'meta.json')) as f:
+            self.meta=json.load(f)
+        with open(os.path.join(self.path, 'index.json')) as f:
+            self.index=json.load(f)
+        self.vectors=np.load(os.path.join(self.path, 'cls.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.index)
+
+    def lookup(self, sequences):
+        rows=[self.index[hash_token_ids(seq)] for seq in sequences]
+        return torch.from_numpy(np.ascontiguousarray(self.vectors[rows]))
+
+
+class FeatureStoreCollate(object):
+    '''
+    wraps a collate_fn_cd and adds <key>_cls for every FEATURE_KEYS entry, which encode_cls returns as is;
+    the encoder never reads the token ids then, so the wrapped collate gets empty sequences for them and
+    the batch carries a batch_size * 1 placeholder instead of padded tokens
+    '''
+    def __init__(self, store, collate_fn):
+        self.store=store
+        self.collate_fn=collate_fn
+
+    def __call__(self, data):
+        features={key: self.store.lookup([d[key] for d in data]) for key in FEATURE_KEYS}
+        empty=torch.Tensor([])
+        batch=self.collate_fn([{**d, **{key: empty for key in FEATURE_KEYS}} for d in data])
+        for key in FEATURE_KEYS:
+            batch[f"{key}_cls"]=features[key]
+        return batch
+
+
+def build_feature_store(model, datasets, path, batch_size=64, use_tqdm=False):
+    '''
+    encodes every distinct context / candidate / utterance sequence in the datasets' pools once;
+    an existing store is reused when it has the same encoder weights and covers every sequence
+
+    the encoder runs in eval mode, so the stored vectors are dropout-free
+    '''
+    sequences={}
+    for dataset in datasets:
+        for item in dataset.pool:
+            for key in FEATURE_KEYS:
+                h=hash_token_ids(item[key])
+                if h not in sequences:
+                    sequences[h]=item[key]
+
+    fingerprint=f"{fingerprint_state_dict(model.utterance_encoder.state_dict())}:{model.SEQUENCE_MAX_LEN}"
+    meta_path=os.path.join(str(path), 'meta.json')
+    if os.path.exists(meta_path):
+        store=FeatureStore(path)
+        if store.meta['fingerprint'] == fingerprint and all(h in store.index for h in sequences):
+            return store
+        del store
+        os.remove(meta_path)
+
+    os.makedirs(str(path), exist_ok=True)
+
+    # length-sorted so each encoder batch carries little padding
+    hashes=sorted(sequences, key=lambda h: len(sequences[h]))
+    index={h: row for row, h in enumerate(hashes)}
+    vectors=np.lib.format.open_memmap(os.path.join(str(path), 'cls.npy'), mode='w+', dtype=np.float32,
+                                      shape=(len(hashes), model.BERT_HIDDEN_DIM))
+
+    was_training=model.training
+    model.eval()
+    device=next(model.parameters()).device
+    starts=range(0, len(hashes), batch_size)
+    for start in (tqdm(starts) if use_tqdm else starts):
+        chunk=[sequences[h].long() for h in hashes[start:start+batch_size]]
+        input_ids=torch.nn.utils.rnn.pad_sequence(chunk, batch_first=True, padding_value=0).to(device)
+        with torch.no_grad():
+            cls=model.utterance_encoder(input_ids=input_ids, attention_mask=(input_ids > 0).long())['last_hidden_state'][:, 0, :]
+        vectors[start:start+len(chunk)]=cls.float().cpu().numpy()
+    vectors.flush()
+    del vectors
+    model.train(was_training)
+
+    with open(os.path.join(str(path), 'index.json'), 'w') as f:
+        json.dump(index, f)
+    with open(meta_path, 'w') as f:
+        json.dump({'fingerprint': fingerprint, 'num_sequences': len(index), 'hidden_size': model.BERT_HIDDEN_DIM}, f)
+
+    return FeatureStore(path)
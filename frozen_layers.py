@@ -0,0 +1,100 @@
+import hashlib
+import torch
+import numpy as np
+
+from embedding_cache import fingerprint_state_dict
+
+
+################################################################################
+# Partially frozen BERT: the embeddings and the bottom k layers are frozen and
+# their output is cached per sequence (EmbeddingCache, float16), so training
+# only runs layers k..N-1 forward and backward.
+
+def freeze_bottom_layers(encoder, num_layers):
+    for p in encoder.embeddings.parameters():
+        p.requires_grad=False
+    for layer in encoder.encoder.layer[:num_layers]:
+        for p in layer.parameters():
+            p.requires_grad=False
+
+def frozen_state_dict(encoder, num_layers):
+    state_dict={f"embeddings.{k}": v for k, v in encoder.embeddings.state_dict().items()}
+    for i, layer in enumerate(encoder.encoder.layer[:num_layers]):
+        state_dict.update({f"layer.{i}.{k}": v for k, v in layer.state_dict().items()})
+    return state_dict
+
+def attach_layer_cache(model, encoder, cache, num_layers):
+    '''
+    model: the module whose forward calls encode_with_frozen_bottom (DialogueLineEncoder*, Bert_v7)
+    encoder: its BertModel (model.utterance_encoder / model.bert)
+    call after the checkpoint is loaded, the key prefix fingerprints the frozen weights only
+    '''
+    freeze_bottom_layers(encoder, num_layers)
+    model.frozen_layers=num_layers
+    model.layer_cache=cache
+    model.layer_cache_prefix=f"{fingerprint_state_dict(frozen_state_dict(encoder, num_layers))}:{num_layers}"
+    return model
+
+def hash_sequence(input_ids, token_type_ids, length):
+    sha=hashlib.sha1(input_ids[:length].cpu().long().numpy().tobytes())
+    if token_type_ids is not None:
+        sha.update(token_type_ids[:length].cpu().long().numpy().tobytes())
+    return sha.hexdigest()
+
+def extended_attention_mask(attention_mask, dtype):
+    '''
+    batch * seq_len 0/1 mask -> additive batch * 1 * 1 * seq_len mask, as BertModel builds it
+    '''
+    return (1.0 - attention_mask[:, None, None, :].to(dtype)) * torch.finfo(dtype).min
+
+def bottom_hidden_states(encoder, input_ids, attention_mask, token_type_ids, num_layers):
+    '''
+    output of layer num_layers-1, dropout off so it can be reused across epochs
+    '''
+    modules=[encoder.embeddings]+list(encoder.encoder.layer[:num_layers])
+    was_training=[m.training for m in modules]
+    for m in modules:
+        m.eval()
+    with torch.no_grad():
+        hidden=encoder.embeddings(input_ids=input_ids, token_type_ids=token_type_ids)
+        extended_mask=extended_attention_mask(attention_mask, hidden.dtype)
+        for layer in encoder.encoder.layer[:num_layers]:
+            hidden=layer(hidden, attention_mask=extended_mask)
+            hidden=hidden[0] if isinstance(hidden, tuple) else hidden
+    for m, training in zip(modules, was_training):
+        m.train(training)
+    return hidden
+
+def encode_with_frozen_bottom(encoder, input_ids, attention_mask, token_type_ids, num_layers, cache, prefix):
+    '''
+    same as encoder(input_ids, attention_mask, token_type_ids)[0] (up to float16 rounding of the
+    cached states), sequences are right padded
+    '''
+    lengths=[max(int(l), 1) for l in attention_mask.sum(1)]
+    keys=[f"{prefix}:{hash_sequence(input_ids[i], None if token_type_ids is None else token_type_ids[i], lengths[i])}"
+          for i in range(input_ids.size(0))]
+    found=cache.get_many(keys)
+
+    missing=sorted(set(keys) - set(found.keys()))
+    if missing:
+        rows=[keys.index(k) for k in missing]
+        max_len=max(lengths[i] for i in rows)
+        hidden=bottom_hidden_states(encoder,
+                                    input_ids[rows, :max_len],
+                                    attention_mask[rows, :max_len],
+                                    None if token_type_ids is None else token_type_ids[rows, :max_len],
+                                    num_layers)
+        fresh={k: hidden[j, :lengths[i]].half().float().cpu().numpy() for j, (k, i) in enumerate(zip(missing, rows))}
+        cache.put_many(fresh)
+        found.update(fresh)
+
+    hidden=np.zeros((input_ids.size(0), input_ids.size(1), encoder.config.hidden_size), dtype=np.float32)
+    for i, k in enumerate(keys):
+        hidden[i, :len(found[k])]=found[k]
+    hidden=torch.from_numpy(hidden).to(device=input_ids.device, dtype=next(encoder.parameters()).dtype)
+
+    extended_mask=extended_attention_mask(attention_mask, hidden.dtype)
+    for layer in encoder.encoder.layer[num_layers:]:
+        hidden=layer(hidden, attention_mask=extended_mask)
+        hidden=hidden[0] if isinstance(hidden, tuple) else hidden
+    return hidden
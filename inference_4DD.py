@@ -42,6 +42,12 @@ from accelerate.logging import get_logger
 
 from models import *
 from eval import *
+from early_exit import attach_exit_heads, encode_with_early_exit
+from pruning import load_pruning_plan, prune_encoder
+from exported import ExportedBert_v7
+from shape_buckets import attach_compiled_encoder, compile_report
+from checkpoints import checkpoint_config, read_state_dict, empty_model, load_checkpoint
+from cascade import linear_tokenizer, load_linear_model, linear_scores, select_candidates, candidate_lists as cascade_candidate_lists, load_threshold
 
 # from datasets import disable_caching
 
@@ -101,16 +107,7 @@ class MHA(nn.Module):
         context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
         # (batch_size * num_choice, num_attention_heads, seq_len, attention_head_size) -> (batch_size * num_choice, seq_len, num_attention_heads, attention_head_size)
 
-        # Should find a better way to do this
-        w = (
-            self.dense.weight.t()
-            .view(self.num_attention_heads, self.attention_head_size, self.hidden_size)
-            .to(context_layer.dtype)
-        )
-        b = self.dense.bias.to(context_layer.dtype)
-
-        
-        projected_context_layer = torch.einsum("bfnd,ndh->bfh", context_layer, w) + b
+        projected_context_layer = self.dense(context_layer.view(context_layer.size(0), context_layer.size(1), self.all_head_size))
         projected_context_layer_dropout = self.dropout(projected_context_layer)
         layernormed_context_layer = self.LayerNorm(input_ids_a + projected_context_layer_dropout)
         return (layernormed_context_layer, attention_probs) if output_attentions else (layernormed_context_layer,)
@@ -158,10 +155,12 @@ class MyLSTM(nn.Module):
 
         return ht, Ct_x, Ct_m 
 
-    def forward(self, x, m, init_stat=None):
+    def forward(self, x, m, init_stat=None, skip=None):
+        '''
+        skip: (batch_size, seq_len) bool, those steps carry the state over as if they were not in the sequence
+        '''
         batch_sz, seq_sz, _ = x.size()
         hidden_seq = []
-        cell_seq = []
         if init_stat is None:
             ht = torch.zeros((batch_sz, self.hidden_sz)).to(x.device)
             Ct_x = torch.zeros((batch_sz, self.hidden_sz)).to(x.device)
@@ -171,15 +170,13 @@ class MyLSTM(nn.Module):
         for t in range(seq_sz):  # iterate over the time steps
             xt = x[:, t, :]
             mt = m[:, t, :]
-            ht, Ct_x, Ct_m= self.node_forward(xt, ht, Ct_x, mt, Ct_m)
-            hidden_seq.append(ht)
-            cell_seq.append(Ct_x)
-            if t == 0:
-                mht = ht
-                mct = Ct_x
+            if skip is None:
+                ht, Ct_x, Ct_m= self.node_forward(xt, ht, Ct_x, mt, Ct_m)
             else:
-                mht = torch.max(torch.stack(hidden_seq), dim=0)[0]
-                mct = torch.max(torch.stack(cell_seq), dim=0)[0]
+                keep = ~skip[:, t, None]
+                ht_t, Ct_x_t, Ct_m_t = self.node_forward(xt, ht, Ct_x, mt, Ct_m)
+                ht, Ct_x, Ct_m = torch.where(keep, ht_t, ht), torch.where(keep, Ct_x_t, Ct_x), torch.where(keep, Ct_m_t, Ct_m)
+            hidden_seq.append(ht)
         hidden_seq = torch.stack(hidden_seq).permute(1, 0, 2) ##batch_size x max_len x hidden
         return hidden_seq
 
@@ -194,8 +191,7 @@ class Bert_v7(BertPreTrainedModel):
         self.gcn_layer = gcn_layer
         self.mylstm_hidden_size = mylstm_hidden_size
 
-        self.bert = BertModel(config)
-        self.BiLSTM = nn.LSTM(config.hidden_size, self.lstm_hidden_size, self.lstm_num_layers, bias=True, batch_first=True, bidirectional=True)
+        self.bert = BertModel(config, add_pooling_layer=False) # only sequence_output is used
         self.graph_dim = config.hidden_size
         self.lstm_f = MyLSTM(config.hidden_size, self.mylstm_hidden_size, self.graph_dim) 
         self.lstm_b = MyLSTM(config.hidden_size, self.mylstm_hidden_size, self.graph_dim)
@@ -207,12 +203,62 @@ class Bert_v7(BertPreTrainedModel):
         self.classifier = nn.Linear(4*self.mylstm_hidden_size, 1)
         self.SASelfMHA = nn.ModuleList([MHA(config) for _ in range(num_decoupling)])
         self.linear = nn.Linear(2*config.hidden_size, config.hidden_size)
-        self.W = nn.ModuleList()
-        for layer in range(self.gcn_layer):
-            self.W.append(nn.Linear(self.graph_dim, self.graph_dim))
 
         self.init_weights()
 
+    def choice_representations(self, num_labels, input_ids, token_type_ids, attention_mask, position_ids, turn_ids, head_mask, inputs_embeds, output_attentions, output_hidden_states):
+        '''
+        (batch_size, num_choice, hidden_size) CLS of every "[CLS] candidate [SEP] utterance [SEP]" choice, and the encoder outputs
+        '''
+        input_ids = input_ids.view(-1, input_ids.size(-1)) if input_ids is not None else None 
+        attention_mask = attention_mask.view(-1, attention_mask.size(-1)) if attention_mask is not None else None
+        orig_attention_mask = attention_mask
+        token_type_ids = token_type_ids.view(-1, token_type_ids.size(-1)) if token_type_ids is not None else None
+    
+        position_ids = position_ids.view(-1, position_ids.size(-1)) if position_ids is not None else None
+        inputs_embeds = (
+            inputs_embeds.view(-1, inputs_embeds.size(-2), inputs_embeds.size(-1))
+            if inputs_embeds is not None
+            else None
+        )
+
+        if getattr(self, 'unique_choices', False): # the slots a cascade (cascade.py) prunes are the same row, encode each row once
+            rows, inverse = torch.unique(torch.cat((input_ids, orig_attention_mask, token_type_ids), 1), dim=0, return_inverse=True)
+            seq_len = input_ids.size(1)
+            outputs = (self.bert(rows[:, :seq_len], attention_mask=rows[:, seq_len:2*seq_len], token_type_ids=rows[:, 2*seq_len:])[0][inverse],)
+        else:
+            outputs = self.bert(
+                input_ids,
+                attention_mask=orig_attention_mask,
+                token_type_ids=token_type_ids,
+                position_ids=position_ids,
+                head_mask=head_mask,
+                inputs_embeds=inputs_embeds,
+                output_attentions=output_attentions,
+                output_hidden_states=output_hidden_states,
+            )
+
+        sequence_output = outputs[0] # (batch_size * num_choice, seq_len, hidden_size)
+        cls_rep = sequence_output[:,0,:] #(batch_size*num_chioce, hidden_size)
+    
+        hidden_size = sequence_output.size(-1)
+        cls_rep = cls_rep.view(-1, num_labels, hidden_size) #(batch_size, num_chioce, hidden_size)
+        return cls_rep, outputs
+
+    def early_exit_representations(self, num_labels, input_ids, token_type_ids, attention_mask):
+        '''
+        eval mode with exit heads attached (early_exit.py): a choice stops at the first exit layer whose
+        head is confident the candidate is not the parent; the first choice (the utterance itself) runs every layer
+        '''
+        first_choice = torch.arange(input_ids.size(0)*num_labels, device=input_ids.device) % num_labels == 0
+        cls, exit_logits, exited, layers_run = encode_with_early_exit(
+            self.bert, self.exit_heads,
+            input_ids.view(-1, input_ids.size(-1)),
+            attention_mask.view(-1, attention_mask.size(-1)),
+            token_type_ids.view(-1, token_type_ids.size(-1)) if token_type_ids is not None else None,
+            self.exit_threshold, never_exit=first_choice)
+        return cls.view(-1, num_labels, cls.size(-1)), exit_logits.view(-1, num_labels), exited.view(-1, num_labels), layers_run.view(-1, num_labels)
+
     def forward(
         self,
         input_ids=None,
@@ -231,72 +277,54 @@ class Bert_v7(BertPreTrainedModel):
         filename_ids=None,
         utterance_of_interest_ids=None,
         candidate_ids_nested=None,
-        true_parent_ids=None
+        true_parent_ids=None,
+        exited_choices=None
     ):
+        '''
+        exited_choices: (batch_size, num_choice) bool, choices left out of the choice graph and ranked last;
+        the early exit sets it, given explicitly it takes full depth CLS vectors (parity_4DD)
+        '''
 
         num_labels = input_ids.shape[1] if input_ids is not None else inputs_embeds.shape[1]
-        input_ids = input_ids.view(-1, input_ids.size(-1)) if input_ids is not None else None 
-        attention_mask = attention_mask.view(-1, attention_mask.size(-1)) if attention_mask is not None else None
-        orig_attention_mask = attention_mask
-        token_type_ids = token_type_ids.view(-1, token_type_ids.size(-1)) if token_type_ids is not None else None
-        
-        position_ids = position_ids.view(-1, position_ids.size(-1)) if position_ids is not None else None
-        inputs_embeds = (
-            inputs_embeds.view(-1, inputs_embeds.size(-2), inputs_embeds.size(-1))
-            if inputs_embeds is not None
-            else None
-        )
-
-        outputs = self.bert(
-            input_ids,
-            attention_mask=orig_attention_mask,
-            token_type_ids=token_type_ids,
-            position_ids=position_ids,
-            head_mask=head_mask,
-            inputs_embeds=inputs_embeds,
-            output_attentions=output_attentions,
-            output_hidden_states=output_hidden_states,
-        )
+        if getattr(self, 'exit_heads', None) is not None and self.exit_threshold > 0:
+            cls_rep, _, exited, layers_run = self.early_exit_representations(num_labels, input_ids, token_type_ids, attention_mask)
+            outputs = (cls_rep,)
+        else:
+            exited, layers_run = exited_choices, None
+            cls_rep, outputs = self.choice_representations(num_labels, input_ids, token_type_ids, attention_mask, position_ids, turn_ids,
+                                                           head_mask, inputs_embeds, output_attentions, output_hidden_states)
 
-        sequence_output = outputs[0] # (batch_size * num_choice, seq_len, hidden_size)
-        cls_rep = sequence_output[:,0,:] #(batch_size*num_chioce, hidden_size)
-        
-        hidden_size = sequence_output.size(-1)
-        cls_rep = cls_rep.view(-1, num_labels, hidden_size) #(batch_size, num_chioce, hidden_size)
-        
         adj_matrix_speaker = adj_matrix_speaker.unsqueeze(1)
         sa_self_mask = (1.0 - adj_matrix_speaker) * -10000.0
+        if exited is not None: # no choice attends to an exited one
+            exited_keys = exited[:, None, None, :]
+            sa_self_mask = sa_self_mask.masked_fill(exited_keys, torch.finfo(sa_self_mask.dtype).min)
         sa_self_ = self.SASelfMHA[0](cls_rep, cls_rep, attention_mask = sa_self_mask)[0]
         for t in range(1, self.num_decoupling):
             sa_self_ = self.SASelfMHA[t](sa_self_, sa_self_, attention_mask = sa_self_mask)[0]
 
         adj_matrix_scene = adj_matrix_scene.unsqueeze(1)
         sa_self_mask = (1.0 - adj_matrix_scene) * -10000.0
+        if exited is not None:
+            sa_self_mask = sa_self_mask.masked_fill(exited_keys, torch.finfo(sa_self_mask.dtype).min)
         for t in range(1, self.num_decoupling):
             sa_self_ = self.SASelfMHA[t](sa_self_, sa_self_, attention_mask = sa_self_mask)[0]
         with_sa_self = self.linear(torch.cat((cls_rep,sa_self_),2))
         batch_size, sent_len, input_dim = cls_rep.size()#(batch_size, num_chioce, 2*lstm_hidden_size)
         graph_input = with_sa_self[:, :, :self.graph_dim]#(batch_size, num_chioce, 2*lstm_hidden_size)
         # forward LSTM
-        lstm_out_f = self.lstm_f(cls_rep, graph_input)#(batch_size, num_chioce, mylstm_hidden_size)
+        lstm_out_f = self.lstm_f(cls_rep, graph_input, skip=exited)#(batch_size, num_chioce, mylstm_hidden_size)
         # backward LSTM
         cls_rep_b = torch.flip(cls_rep, [1])
         graph_input_b = torch.flip(graph_input, [1])
-        lstm_out_b = self.lstm_b(cls_rep_b, graph_input_b)#(batch_size, num_chioce, mylstm_hidden_size)
+        lstm_out_b = self.lstm_b(cls_rep_b, graph_input_b, skip=torch.flip(exited, [1]) if exited is not None else None)#(batch_size, num_chioce, mylstm_hidden_size)
         lstm_out_b = torch.flip(lstm_out_b, [1])
 
         lstm_output = torch.cat((lstm_out_f, lstm_out_b), dim=2)#(batch_size, num_chioce, 2*mylstm_hidden_size)
         lstm_output = self.drop_lstm(lstm_output)
 
-        target = lstm_output[:,0,:] #(batch_size, 2*mylstm_hidden_size)
-        final_lstm_output = lstm_output.repeat(1,1,4) #(batch_size, num_chioce, 2*mylstm_hidden_size *4)
-        for i in range(final_lstm_output.size(0)):
-            for j in range(final_lstm_output.size(1)):
-                a = lstm_output[i,j,:]
-                b = target[i,:]
-                c = a * b
-                d = a - b
-                final_lstm_output[i,j,:] = torch.cat((a,b,c,d)) #(2*mylstm_hidden_size *4)
+        target = lstm_output[:,:1,:].expand_as(lstm_output) #(batch_size, num_chioce, 2*mylstm_hidden_size)
+        final_lstm_output = torch.cat((lstm_output, target, lstm_output * target, lstm_output - target), dim=2) #(batch_size, num_chioce, 2*mylstm_hidden_size *4)
 
         pooled_output = self.pooler_activation(self.pooler(final_lstm_output)) #(batch_size, num_chioce, 4*mylstm_hidden_size )
         pooled_output = self.dropout(pooled_output)
@@ -312,6 +340,10 @@ class Bert_v7(BertPreTrainedModel):
             "utterance_of_interest_ids": utterance_of_interest_ids,
             "candidate_ids_nested": candidate_ids_nested,
         }
+        if exited is not None: # exited choices rank below every other one
+            outputs["logits"] = reshaped_logits.masked_fill(exited, torch.finfo(reshaped_logits.dtype).min)
+        if layers_run is not None:
+            outputs["exit_layers"] = layers_run
         if labels is not None:
             loss_fct=CrossEntropyLoss()
             loss=loss_fct(reshaped_logits, labels)        
@@ -319,6 +351,43 @@ class Bert_v7(BertPreTrainedModel):
             
         return outputs
 
+class PackedBert_v7(Bert_v7):
+    '''
+    Bert_v7 with one encoder pass per utterance instead of one per (utterance, candidate) choice:
+    "[CLS] utterance [SEP] cand_0 [SEP] cand_1 [SEP] ... cand_N-1 [SEP]" (convert_examples_to_packed_features),
+    candidate j is the mean of the tokens with turn_ids == j+1. Same parameters as Bert_v7, so either
+    checkpoint loads into the other
+    '''
+    def choice_representations(self, num_labels, input_ids, token_type_ids, attention_mask, position_ids, turn_ids, head_mask, inputs_embeds, output_attentions, output_hidden_states):
+        num_labels = self.config.num_labels # the packed features carry a single choice
+        input_ids = input_ids.view(-1, input_ids.size(-1)) if input_ids is not None else None
+        attention_mask = attention_mask.view(-1, attention_mask.size(-1)) if attention_mask is not None else None
+        token_type_ids = token_type_ids.view(-1, token_type_ids.size(-1)) if token_type_ids is not None else None
+        position_ids = position_ids.view(-1, position_ids.size(-1)) if position_ids is not None else None
+        turn_ids = turn_ids.view(-1, turn_ids.size(-1))
+        inputs_embeds = (
+            inputs_embeds.view(-1, inputs_embeds.size(-2), inputs_embeds.size(-1))
+            if inputs_embeds is not None
+            else None
+        )
+        outputs = self.bert(
+            input_ids,
+            attention_mask=attention_mask,
+            token_type_ids=token_type_ids,
+            position_ids=position_ids,
+            head_mask=head_mask,
+            inputs_embeds=inputs_embeds,
+            output_attentions=output_attentions,
+            output_hidden_states=output_hidden_states,
+        )
+        sequence_output = outputs[0] # (batch_size, seq_len, hidden_size)
+        slots = F.one_hot(turn_ids, num_labels + 1)[:, :, 1:].to(sequence_output.dtype) #(batch_size, seq_len, num_choice)
+        if attention_mask is not None:
+            slots = slots * attention_mask.unsqueeze(-1).to(sequence_output.dtype)
+        cls_rep = torch.bmm(slots.transpose(1, 2), sequence_output) #(batch_size, num_choice, hidden_size)
+        cls_rep = cls_rep / slots.sum(1).clamp(min=1).unsqueeze(-1)
+        return cls_rep, outputs
+
 def merge(sequences, ignore_idx=None):
     '''
     merge from batch * sent_len to batch * max_len 
@@ -461,7 +530,11 @@ class DCDProcessor(DataProcessor):
     
     def get_examples(self, tokenizer, mode, 
                      reversed_filename_to_filename_id, line_id2line_text, line_id2speaker_n, scene_id2line_ids, line_id2scene_id, 
-                     max_previous_utterance, lines_dict):        
+                     max_previous_utterance, lines_dict, candidate_lists=None):        
+        '''
+        candidate_lists: {(filename_id, utterance_id): [utterance_id, candidate ids ...]} from
+        retrieve_candidates; slot j then holds the j-th listed line instead of the j-th previous one
+        '''
         
         start_token=tokenizer.cls_token  
         sep_token=tokenizer.sep_token
@@ -478,6 +551,8 @@ class DCDProcessor(DataProcessor):
             if filename not in filenames:
                 filenames.append(filename)
                         
+            info_tuple_index={info_tuple[1]: idx for idx, info_tuple in enumerate(info_tuples)}
+
             for info_tuple_idx, info_tuple in enumerate(info_tuples):
                 seen_cands=[]
                 _, utterance_id=info_tuple
@@ -496,6 +571,9 @@ class DCDProcessor(DataProcessor):
                 for j in range(0, max_previous_utterance):
                     i=info_tuple_idx % max_previous_utterance
                     diff=info_tuple_idx - j
+                    if candidate_lists is not None:
+                        selected=candidate_lists[(filename_id, uoi_id)]
+                        diff=info_tuple_index[selected[j]] if j < len(selected) else -1
 
                     # print(f"file: {filename_id}; i: {i}: j: {j}: diff: {diff}, len_info_tuples: {len(info_tuples)}; tuple_idx: {tuple_idx}")
 
@@ -666,6 +744,76 @@ def convert_examples_to_features(examples, label_list, max_seq_length, max_utter
 
     return features
             
+def _fair_budget(lengths, total):
+    """Largest per-sequence lengths that fit total, short sequences keep all of their tokens."""
+    budget = [0] * len(lengths)
+    spent = 0
+    for n, i in enumerate(sorted(range(len(lengths)), key=lambda i: lengths[i])):
+        budget[i] = max(min(lengths[i], (total - spent) // (len(lengths) - n)), 0)
+        spent += budget[i]
+    return budget
+
+def convert_examples_to_packed_features(examples, label_list, max_seq_length, max_utterance_num,
+                                        tokenizer):
+    """
+    PackedBert_v7 input, one sequence per example: "[CLS] utterance [SEP] cand_0 [SEP] ... cand_N-1 [SEP]"
+    segment 0 for the utterance, 1 for the candidates, turn_ids j+1 on candidate j (and its [SEP]), 0 elsewhere;
+    the utterance keeps at most max_seq_length//4 tokens, the candidates share the rest
+    and lose tokens from the front, as _truncate_seq_pair does
+    """
+    label_map={label: i for i, label in enumerate(label_list)}
+    cls_token=tokenizer.cls_token
+    sep_token=tokenizer.sep_token
+
+    features=[]
+
+    for (ex_index, example) in enumerate(examples):
+        tokens_a = tokenizer.tokenize(example.text_a[0])[:max_seq_length // 4]
+        candidates = [tokenizer.tokenize(text_b) for text_b in example.text_b]
+        budget = _fair_budget([len(toks) for toks in candidates], max_seq_length - len(tokens_a) - 2 - len(candidates))
+
+        tokens = [cls_token] + tokens_a + [sep_token]
+        segment_ids = [0] * len(tokens)
+        turn_ids = [0] * len(tokens)
+        for j, toks in enumerate(candidates):
+            toks = toks[len(toks) - budget[j]:] + [sep_token]
+            tokens += toks
+            segment_ids += [1] * len(toks)
+            turn_ids += [j + 1] * len(toks)
+
+        input_ids = tokenizer.convert_tokens_to_ids(tokens)
+        input_mask = [1] * len(input_ids)
+
+        padding = [0] * (max_seq_length - len(input_ids))
+        input_ids += padding
+        input_mask += padding
+        segment_ids += padding
+        turn_ids += padding
+        sep_pos = [0] * (max_utterance_num + 1)
+
+        assert len(input_ids) == max_seq_length
+        assert len(turn_ids) == max_seq_length
+
+        if example.label!=None:
+            label_id=label_map[example.label]
+        else:
+            label_id=None
+
+        features.append(
+            InputFeatures(
+                example_id = example.guid,
+                choices_features = [(input_ids, input_mask, segment_ids, sep_pos, turn_ids)],
+                utterance_id=example.utterance_id,
+                candidate_ids=example.candidate_ids,
+                true_parent_id=None, #example.true_parent_id
+                label=label_id,
+                adj_matrix_speaker=example.adj_matrix_speaker,
+                adj_matrix_scene=example.adj_matrix_scene
+                )
+        )
+
+    return features
+
 def _truncate_seq_pair(tokens_a, tokens_b, max_length):
     """Truncates a sequence pair in place to the maximum length."""
     # This is a simple heuristic which will always truncate the longer sequence
@@ -690,14 +838,104 @@ def prep_tensor_data(features):
     all_guid=torch.tensor([f.example_id for f in features], dtype=torch.long)
     all_utterance_ids=torch.tensor([f.utterance_id for f in features], dtype=torch.long)
     all_candidate_ids_nested=torch.tensor([f.candidate_ids for f in features], dtype=torch.long)
+    all_turn_ids=torch.tensor(select_field(features, 'turn_ids'), dtype=torch.long)
 
     try:
         all_true_parent_ids=torch.tensor([f.true_parent_id for f in features], dtype=torch.long)
         all_label_ids=torch.tensor([f.label for f in features], dtype=torch.long)
-        return all_input_ids, all_input_mask, all_segment_ids, all_adj_speaker, all_adj_matrix_scene, all_guid, all_utterance_ids, all_candidate_ids_nested, all_true_parent_ids, all_label_ids
+        return all_input_ids, all_input_mask, all_segment_ids, all_adj_speaker, all_adj_matrix_scene, all_guid, all_utterance_ids, all_candidate_ids_nested, all_true_parent_ids, all_label_ids, all_turn_ids
     except:
-        return all_input_ids, all_input_mask, all_segment_ids, all_adj_speaker, all_adj_matrix_scene, all_guid, all_utterance_ids, all_candidate_ids_nested
+        return all_input_ids, all_input_mask, all_segment_ids, all_adj_speaker, all_adj_matrix_scene, all_guid, all_utterance_ids, all_candidate_ids_nested, all_turn_ids
+
+
+
+################################################################################
+# Two-stage candidates (--retrieval_model_path): a models.py encoder (DialogueLineEncoder family)
+# scores every previous D line of the scene within --retrieval_window with score_all_pairs, from
+# one CLS vector per line and one context CLS vector per line, and only the best go to Bert_v7
+
+def retrieval_line_text(speaker_label, line_text):
+    '''
+    same format as train_baseline.read_line_dicts, which the retrieval encoders are trained on
+    '''
+    if speaker_label:
+        speaker_label=speaker_label.lower() + ' [SEP] '
+    return f"{speaker_label}{line_text} [LINE]"
+
+def retrieval_context(tokenizer, max_length, texts, line_ids, line_id):
+    '''
+    same as train_baseline.CDDataset.get_concat_context
+    '''
+    context_ids=line_ids[:line_ids.index(line_id)]
+    if not context_ids:
+        return ''
+    context_tokens=[]
+    for context_id in reversed(context_ids):
+        tokens=tokenizer.tokenize(texts[context_id])
+        if len(context_tokens)<=max_length:
+            context_tokens.extend(tokens)
+    return f"{tokenizer.cls_token} {tokenizer.convert_tokens_to_string(context_tokens)}"
+
+def retrieve_candidates(retriever, lines_dict, file_lines, reversed_filename_to_filename_id, line_id2turn_n, line_id2speaker_n, scene_id2line_ids, 
+                        window, num_slots, batch_size=64):
+    '''
+    returns {(filename_id, utterance_id): [utterance_id, candidate ids ...]}: the utterance itself (new
+    thread) and the num_slots-1 best scored of its previous `window` D lines in the scene, nearest first
+    as in the one-stage slots
+    '''
+    mode='test'
+    tokenizer=retriever.utterance_encoder_tokenizer
+    max_length=retriever.SEQUENCE_MAX_LEN
+    device=next(retriever.parameters()).device
+
+    sequences={}
+    def sequence_row(plain):
+        tokens=tokenizer.tokenize(plain)[-max_length+1:]
+        return sequences.setdefault(plain, (len(sequences), torch.LongTensor(tokenizer.convert_tokens_to_ids(tokens))))[0]
+
+    self_row=sequence_row(f"{tokenizer.cls_token} [SELF]")
+    line_row, context_row={}, {}
+    for filename_id, scenes in scene_id2line_ids[mode].items():
+        filename=reversed_filename_to_filename_id[filename_id]
+        for scene_id, line_ids in scenes.items():
+            texts={line_id: retrieval_line_text(file_lines[filename][line_id][5], file_lines[filename][line_id][6]) for line_id in line_ids}
+            for line_id in line_ids:
+                if line_id.startswith('D'):
+                    line_row[(filename_id, line_id)]=sequence_row(f"{tokenizer.cls_token} {texts[line_id]}")
+                    context_row[(filename_id, line_id)]=sequence_row(retrieval_context(tokenizer, max_length, texts, line_ids, line_id))
+
+    # every distinct line / context is encoded once, length-sorted to keep the padding low
+    rows=sorted(sequences.values(), key=lambda row: len(row[1]))
+    cls=torch.zeros(len(rows), retriever.BERT_HIDDEN_DIM, device=device)
+    with torch.no_grad():
+        for start in range(0, len(rows), batch_size):
+            chunk=rows[start:start+batch_size]
+            input_ids=nn.utils.rnn.pad_sequence([ids for _, ids in chunk], batch_first=True, padding_value=0).to(device)
+            cls[[idx for idx, _ in chunk]]=encode_rows(retriever, input_ids).float()
+
+    candidate_lists={}
+    with torch.no_grad():
+        for (filename_id, uoi_id), line_data in lines_dict[mode].items():
+            scene_line_ids=[line_id for line_id in scene_id2line_ids[mode][filename_id][line_data['scene_id']] if line_id.startswith('D')]
+            previous=list(reversed(scene_line_ids[:scene_line_ids.index(uoi_id)]))[:window]
+            if len(previous) < num_slots:
+                candidate_lists[(filename_id, uoi_id)]=[uoi_id]+previous
+                continue
 
+            candidates=[uoi_id]+previous
+            cj_cls=cls[[context_row[(filename_id, c)] for c in candidates]]
+            lj_cls=cls[[self_row]+[line_row[(filename_id, c)] for c in previous]]
+            li_cls=cls[[line_row[(filename_id, uoi_id)]]]
+            utterances_distance=torch.LongTensor([[int(uoi_id[1:])-int(c[1:]) for c in candidates]])
+            same_turn=torch.LongTensor([[int(line_id2turn_n[mode][filename_id][uoi_id] == line_id2turn_n[mode][filename_id][c]) for c in candidates]])
+            same_speaker=torch.LongTensor([[int(line_id2speaker_n[mode][filename_id][uoi_id] == line_id2speaker_n[mode][filename_id][c]) for c in candidates]])
+            first_spoke=torch.LongTensor([1 if line_data['scene_speaker_id']=='0' else 0])
+
+            logits=score_all_pairs(retriever, cj_cls, lj_cls, li_cls, bucket_distances(utterances_distance).to(device),
+                                   same_turn.to(device), same_speaker.to(device), first_spoke.to(device))[0]
+            best=[previous[i] for i in logits[1:].topk(num_slots-1).indices.tolist()]
+            candidate_lists[(filename_id, uoi_id)]=[uoi_id]+sorted(best, key=lambda c: int(c[1:]), reverse=True)
+    return candidate_lists
 
 
 def eval_lines_to_lines_dict(eval_lines):
@@ -806,6 +1044,50 @@ if __name__=='__main__':
                         default=50,
                         type=int,
                         help="The maximum of previous utterances considerated.")
+    arg_parser.add_argument('--retrieval_model_path', default=None, help='models.py checkpoint (in model_folder) that picks the max_previous_utterance candidates Bert_v7 scores')
+    arg_parser.add_argument('--retrieval_encoder_name', default='DialogueLineEncoder', help='models.py class of the retrieval checkpoint')
+    arg_parser.add_argument('--retrieval_model_name', default='bert-base-cased', help='pretrained encoder of the retrieval checkpoint')
+    arg_parser.add_argument("--retrieval_window",
+                        default=50,
+                        type=int,
+                        help="previous D lines (same scene) the retrieval model scores per utterance")
+    arg_parser.add_argument('--cascade_model_path', default=None, help='train_linear checkpoint (in model_folder) that prunes the candidates before Bert_v7 (cascade.py)')
+    arg_parser.add_argument('--cascade_model_name', default='bert-base-cased', help='train_linear --model_name, its tokenizer counts the words in common')
+    arg_parser.add_argument("--cascade_recall",
+                        default=0.,
+                        type=float,
+                        help="keep the candidates above the threshold cascade_4DD.py calibrated for this dev recall, 0 for no threshold")
+    arg_parser.add_argument("--cascade_top_k",
+                        default=0,
+                        type=int,
+                        help="keep at most this many candidates per utterance, 0 for no limit")
+    arg_parser.add_argument("--packed",
+                        default=0,
+                        type=int,
+                        help="PackedBert_v7: one encoder pass per utterance over all of its candidates")
+    arg_parser.add_argument('--exit_layers', default='', help='as given to train_4DD')
+    arg_parser.add_argument("--exit_threshold",
+                        default=0.,
+                        type=float,
+                        help="a candidate stops at the first exit layer that gives it a parent probability below this, 0 runs every layer")
+    arg_parser.add_argument("--quantize",
+                        default=0,
+                        type=int,
+                        help="dynamic int8 quantization of the linear layers (BERT, MHA, MyLSTM, pooler, classifier), CPU only")
+    arg_parser.add_argument('--exported', default='', help='export_4DD output (.pt TorchScript or .onnx) in model_folder, run instead of model_path, CPU only')
+    arg_parser.add_argument("--threads",
+                        default=0,
+                        type=int,
+                        help="intra-op CPU threads of the exported graph, 0 keeps the default")
+    arg_parser.add_argument("--compile",
+                        default=0,
+                        type=int,
+                        help="torch.compile the encoder, one graph per shape bucket (shape_buckets.py)")
+    arg_parser.add_argument('--compile_cache', default='compile_cache', help='folder for the compiled graphs, reused across runs')
+    arg_parser.add_argument("--bf16",
+                        default=0,
+                        type=int,
+                        help="bfloat16 autocast (Accelerator mixed_precision), float32 weights; check a checkpoint with parity_4DD first")
     arg_parser.add_argument("--use_tqdm",
                         default=False,
                         type=bool,
@@ -840,7 +1122,7 @@ if __name__=='__main__':
     ######
 
     ddp_kwargs=DistributedDataParallelKwargs(find_unused_parameters=False)
-    accelerator=Accelerator(kwargs_handlers=[ddp_kwargs])
+    accelerator=Accelerator(kwargs_handlers=[ddp_kwargs], mixed_precision='bf16' if args['bf16'] else None)
 
     timestamp=datetime.datetime.now().strftime("%m%d%Y-%H%M%S")    
     ######
@@ -877,6 +1159,8 @@ if __name__=='__main__':
     main_log(f'Initiating the PrLM: {pretrained_model_name}; max_previous_utterance: {max_previous_utterance}')
 
     config_class, model_class, tokenizer_class=BertConfig, Bert_v7, BertTokenizer
+    if args['packed']:
+        model_class, convert_examples_to_features=PackedBert_v7, convert_examples_to_packed_features
     tokenizer=tokenizer_class.from_pretrained(pretrained_model_name, 
                                             do_lower_case=False, 
                                             do_basic_tokenize=False)
@@ -887,15 +1171,61 @@ if __name__=='__main__':
     num_labels=len(label_list)
 
     config=config_class.from_pretrained(pretrained_model_name, num_labels=num_labels)
-    model=model_class.from_pretrained(pretrained_model_name, config=config)
 
     HIDDEN_DIM=config.hidden_size
     SEQUENCE_MAX_LEN=tokenizer.model_max_length    
 
-    model.load_state_dict(torch.load(OUTPUT_PATH.joinpath(args["model_path"])))
-
-    main_log(f'Loaded {OUTPUT_PATH.joinpath(args["model_path"])}!')
-    model=accelerator.prepare(model)
+    if args['exported']:
+        assert accelerator.device.type == 'cpu' and not (args['packed'] or args['exit_layers'] or args['bf16']), 'the exported graph is plain float32 Bert_v7 on CPU'
+        model=ExportedBert_v7(OUTPUT_PATH.joinpath(args['exported']), args['threads'])
+        main_log(f"Loaded {OUTPUT_PATH.joinpath(args['exported'])}!")
+    else:
+        config=checkpoint_config(OUTPUT_PATH.joinpath(args["model_path"]), config_class) or config
+        model=empty_model(lambda: model_class(config))
+
+        if args['exit_layers']:
+            assert not args['packed']
+            attach_exit_heads(model, model.bert, [int(k) for k in args['exit_layers'].split(',')], args['exit_threshold'])
+            main_log(f"Early exit after layers {model.exit_heads.layers}, threshold {args['exit_threshold']}")
+
+        plan=load_pruning_plan(OUTPUT_PATH.joinpath(args["model_path"]))
+        if plan is not None:
+            prune_encoder(model.bert, plan)
+            main_log(f"Pruned encoder: {[len(kept) for kept in plan['heads'].values()]} heads per layer")
+
+        load_checkpoint(model, OUTPUT_PATH.joinpath(args["model_path"]))
+
+        main_log(f'Loaded {OUTPUT_PATH.joinpath(args["model_path"])}!')
+        if args['quantize']:
+            assert accelerator.device.type == 'cpu' and not args['bf16'], 'int8 dynamic quantization runs on CPU, in float32'
+            model=quantize_dynamic_int8(model)
+            main_log('Quantized the linear layers to int8')
+        if args['compile']:
+            attach_compiled_encoder(model.bert, [SEQUENCE_MAX_LEN], [BATCH_SIZE*(1 if args['packed'] else num_labels)], args['compile_cache'])
+            main_log(f"Compiled encoder, cache: {args['compile_cache']}")
+        model=accelerator.prepare(model)
+
+    retriever=None
+    if args['retrieval_model_path']:
+        state_dict=read_state_dict(OUTPUT_PATH.joinpath(args["retrieval_model_path"]))
+        retriever_args={'model_name': args['retrieval_model_name'],
+                        'fix_encoder': 1,
+                        'from_checkpoint': 1,
+                        'distance_embedding_dim': state_dict['distance_embeddings.weight'].shape[0],
+                        'distance_embedding_size': state_dict['distance_embeddings.weight'].shape[1],
+                        'head_rank': head_rank_from_state_dict(state_dict)}
+        retriever=load_checkpoint(empty_model(lambda: globals()[args['retrieval_encoder_name']](retriever_args)), state_dict)
+        retriever=retriever.to(accelerator.device).eval()
+        main_log(f"Two-stage: {args['retrieval_encoder_name']} {args['retrieval_model_path']} keeps {max_previous_utterance} of {args['retrieval_window']} candidates")
+
+    linear_model=None
+    if args['cascade_model_path']:
+        assert retriever is None and not args['exported'], 'the cascade picks the candidates of the eager Bert_v7'
+        linear_model=load_linear_model(OUTPUT_PATH.joinpath(args['cascade_model_path']))
+        cascade_tokenizer=linear_tokenizer(args['cascade_model_name'])
+        cascade_threshold=load_threshold(OUTPUT_PATH.joinpath(args['cascade_model_path']), args['cascade_recall'])
+        accelerator.unwrap_model(model).unique_choices=True # the pruned slots are encoded once per utterance
+        main_log(f"Cascade: {args['cascade_model_path']} keeps candidates >= {cascade_threshold:.4f} (dev recall {args['cascade_recall']}), top {args['cascade_top_k'] or 'all'}")
 
     main_log('Loading files ...')
     file_paths=TEST_DATA_PATH.glob('*.tsv')
@@ -1024,6 +1354,20 @@ if __name__=='__main__':
         reversed_filename_to_filename_id={v: k for k, v in filename_to_filename_id.items()}
 
         ########
+
+        candidate_lists=None
+        if retriever is not None:
+            candidate_lists=retrieve_candidates(retriever, lines, file_lines, reversed_filename_to_filename_id, line_id2turn_n, line_id2speaker_n, scene_id2line_ids,
+                                                args['retrieval_window'], max_previous_utterance)
+        if linear_model is not None:
+            # train_linear's line texts, with the speaker
+            linear_line_text={mode: {filename_to_filename_id[filename]: {line_id: retrieval_line_text(line[5], line[6]) for line_id, line in file_line_dict.items()}
+                                     for filename, file_line_dict in file_lines.items()}}
+            scores, cascade_seconds=linear_scores(linear_model, cascade_tokenizer, max_previous_utterance-1, mode, lines, filename_to_filename_id, scene_id2line_ids,
+                                                  linear_line_text, line_id2turn_n, line_id2speaker, speaker2line_ids)
+            kept=select_candidates(scores, cascade_threshold, args['cascade_top_k'])
+            candidate_lists=cascade_candidate_lists(kept, lines, mode, reversed_filename_to_filename_id, max_previous_utterance)
+            main_log(f"{slug}: cascade kept {sum(len(c)-1 for c in candidate_lists.values())/max(len(candidate_lists), 1):.1f} candidates per utterance [{cascade_seconds:.2f}s]")
         
         test_examples, test_filenames=\
             processor.get_examples(tokenizer, 'test',
@@ -1033,7 +1377,8 @@ if __name__=='__main__':
                                 scene_id2line_ids, 
                                 line_id2scene_id,
                                 max_previous_utterance, 
-                                lines)
+                                lines,
+                                candidate_lists)
         test_data=TensorDataset(*prep_tensor_data(convert_examples_to_features(test_examples, label_list, SEQUENCE_MAX_LEN, max_previous_utterance, tokenizer)))
         test_sampler=SequentialSampler(test_data)
         test_data_loader=DataLoader(test_data, sampler=test_sampler, batch_size=BATCH_SIZE)
@@ -1043,6 +1388,7 @@ if __name__=='__main__':
         preds=None
         pred_lines=[]
         preds_dict={}
+        layers_run, pairs_run=0, 0
 
         for idx, batch in enumerate(test_data_loader):
             d={
@@ -1054,11 +1400,19 @@ if __name__=='__main__':
                 'filename_ids': batch[5],
                 'utterance_of_interest_ids': batch[6],
                 'candidate_ids_nested': batch[7],
+                'turn_ids': batch[8],
             }
             d={key: to_cuda(val) for key, val in d.items()} 
             with torch.no_grad():        
                 outputs=model(**d)
                 outputs=accelerator.gather(outputs)
+                if linear_model is not None: # pruned slots are padding, never the parent
+                    outputs['logits']=outputs['logits'].masked_fill(outputs['candidate_ids_nested'] == 99999, -10000.0)
+
+                if 'exit_layers' in outputs:
+                    real=outputs['candidate_ids_nested'] != 99999 # PAD_UTTERANCE_ID
+                    layers_run += int(outputs['exit_layers'][real].sum())
+                    pairs_run += int(real.sum())
                 
                 if preds is None:
                     preds=outputs['logits'].detach().cpu().numpy()
@@ -1129,7 +1483,12 @@ if __name__=='__main__':
 
         time_diff=datetime.timedelta(seconds=time.monotonic() - start_time)
         main_log(f"{slug}: {file_len} [{time_diff}]")
+        if pairs_run:
+            main_log(f"{slug}: {layers_run/pairs_run:.2f} encoder layers per candidate")
         # main_log(dataset.cache_files())
         
                 
 
+    if args['compile'] and not args['exported']:
+        for line in compile_report(accelerator.unwrap_model(model).bert):
+            main_log(f"Compile: {line}")
@@ -0,0 +1,256 @@
+import os, sys
+import os.path
+import torch
+import logging
+import argparse
+import pathlib
+import datetime
+import time
+import datasets
+import transformers
+import numpy as np
+from tqdm import tqdm
+from accelerate import Accelerator, DistributedDataParallelKwargs
+from accelerate.logging import get_logger
+
+from models import *
+from eval import *
+from pruning import load_pruning_plan, prune_encoder
+from checkpoints import read_state_dict, empty_model, load_checkpoint
+from cascade import linear_tokenizer, load_linear_model, linear_scores, select_candidates, candidate_lists, load_threshold
+from train_baseline import CDDataset, SceneCDDataset, collate_fn_cd, collate_fn_scene, read_line_dicts, to_cuda, to_cpu
+
+
+def main_log(msg):
+    global logger
+    return logger.info(msg, main_process_only=True)
+
+if __name__=='__main__':
+
+    ROOT=pathlib.Path('/global/scratch/users/kentkchang/dramatic-bert')
+    MODEL_PATH=ROOT / 'model'
+
+    CWD=pathlib.Path.cwd()
+
+    LOG_PATH=MODEL_PATH / 'log'
+
+    ######
+    arg_parser=argparse.ArgumentParser()
+
+    arg_parser.add_argument('--model_path', help='specify model_path')
+    arg_parser.add_argument('--encoder_name', help='specify encoder_name')
+    arg_parser.add_argument('--model_folder', help='specify model_folder')
+    arg_parser.add_argument('--model_name', help='specify model_name')
+    arg_parser.add_argument('--test_folder', help='specify test_folder')
+    arg_parser.add_argument('--preds_output_folder', help='specify preds_output_folder')
+    arg_parser.add_argument("--batch_size",
+                        default=4,
+                        type=int,
+                        help="specific batch_size.")
+    arg_parser.add_argument("--use_tqdm",
+                        default=False,
+                        type=bool,
+                        help="Use tqdm?")
+    arg_parser.add_argument("--context_lines",
+                        default=0,
+                        type=int,
+                        help="as given to train_baseline")
+    arg_parser.add_argument("--late_interaction",
+                        default=0,
+                        type=int,
+                        help="as given to the training script")
+    arg_parser.add_argument("--quantize",
+                        default=0,
+                        type=int,
+                        help="dynamic int8 quantization of the linear layers, CPU only")
+    arg_parser.add_argument('--embedding_cache',
+                        default=None,
+                        help='sqlite file for the persistent CLS cache (shared across runs and corpora)')
+    arg_parser.add_argument("--embedding_cache_size",
+                        default=1000000,
+                        type=int,
+                        help="max cached vectors before least recently used ones are evicted")
+    arg_parser.add_argument('--cascade_model_path', default=None, help='train_linear checkpoint (in model_folder) that prunes the candidate pairs before the encoder (cascade.py)')
+    arg_parser.add_argument('--cascade_model_name', default='bert-base-cased', help='train_linear --model_name, its tokenizer counts the words in common')
+    arg_parser.add_argument("--cascade_recall",
+                        default=0.,
+                        type=float,
+                        help="keep the candidates above the threshold cascade_4DD.py calibrated for this dev recall, 0 for no threshold")
+    arg_parser.add_argument("--cascade_top_k",
+                        default=0,
+                        type=int,
+                        help="keep at most this many candidates per utterance, 0 for no limit")
+
+    args=vars(arg_parser.parse_args())
+
+    BATCH_SIZE=args['batch_size']
+    OUTPUT_PATH=MODEL_PATH / args["model_folder"]
+    args["fix_encoder"]=0
+    args["n_gpu"]=torch.cuda.device_count()
+    args["distance_embedding_size"]=10
+    args["output_dir"]=str(LOG_PATH)
+
+    use_tqdm=args['use_tqdm']
+
+    TEST_DATA_PATH=CWD / str(args['test_folder'])
+
+    PREDS_FOLDER_PATH=CWD / str(args['preds_output_folder'])
+    PREDS_FOLDER_PATH.mkdir(exist_ok=True)
+
+    PREDS_PATH=PREDS_FOLDER_PATH / 'preds'
+    PREDS_PATH.mkdir(exist_ok=True)
+
+    CLUSTERS_PATH=PREDS_FOLDER_PATH / 'cluster'
+    CLUSTERS_PATH.mkdir(exist_ok=True)
+
+    ######
+
+    ddp_kwargs=DistributedDataParallelKwargs(find_unused_parameters=False)
+    accelerator=Accelerator(kwargs_handlers=[ddp_kwargs])
+
+    timestamp=datetime.datetime.now().strftime("%m%d%Y-%H%M%S")
+    ######
+
+    logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s %(message)s',
+                    datefmt='%m-%d %H:%M',
+                    filename=os.path.join(args["output_dir"], f"infer_baseline_{timestamp}.log"),
+                    filemode='w')
+    console=logging.StreamHandler()
+    console.setLevel(logging.INFO)
+    formatter=logging.Formatter('%(message)s')
+    console.setFormatter(formatter)
+    logging.getLogger('').addHandler(console)
+
+    datasets.utils.logging.set_verbosity_error()
+    transformers.utils.logging.set_verbosity_error()
+
+    logger=get_logger(__name__)
+
+    accelerator.wait_for_everyone()
+
+    ######
+    # distance_embedding_dim is data dependent at training time, read it (and the head layout) back from the checkpoint
+    state_dict=read_state_dict(OUTPUT_PATH.joinpath(args["model_path"]))
+    args["distance_embedding_dim"]=state_dict['distance_embeddings.weight'].shape[0]
+    args["head_rank"]=head_rank_from_state_dict(state_dict)
+
+    main_log(f"Enocder: {args['encoder_name']}")
+    args['from_checkpoint']=1
+    model=empty_model(lambda: globals()[args['encoder_name']](args))
+    plan=load_pruning_plan(OUTPUT_PATH.joinpath(args["model_path"]))
+    if plan is not None:
+        prune_encoder(model.utterance_encoder, plan)
+        main_log(f"Pruned encoder: {[len(kept) for kept in plan['heads'].values()]} heads per layer")
+    load_checkpoint(model, state_dict)
+    main_log(f'Loaded {OUTPUT_PATH.joinpath(args["model_path"])}!')
+
+    if args['embedding_cache']:
+        cache=EmbeddingCache(args['embedding_cache'], max_entries=args['embedding_cache_size'])
+        attach_embedding_cache(model, cache)
+        main_log(f"Embedding cache: {args['embedding_cache']} ({len(cache)} entries, key prefix {model.embedding_cache_prefix})")
+
+    if args['quantize']:
+        assert accelerator.device.type == 'cpu', 'int8 dynamic quantization runs on CPU'
+        model=quantize_dynamic_int8(model)
+        main_log('Quantized the linear layers to int8')
+
+    linear_model=None
+    if args['cascade_model_path']:
+        assert args['encoder_name'] != 'SceneDialogueEncoder', 'scene windows encode every line of the window together'
+        linear_model=load_linear_model(OUTPUT_PATH.joinpath(args['cascade_model_path']))
+        cascade_tokenizer=linear_tokenizer(args['cascade_model_name'])
+        cascade_threshold=load_threshold(OUTPUT_PATH.joinpath(args['cascade_model_path']), args['cascade_recall'])
+        main_log(f"Cascade: {args['cascade_model_path']} keeps candidates >= {cascade_threshold:.4f} (dev recall {args['cascade_recall']}), top {args['cascade_top_k'] or 'all'}")
+
+    tokenizer=model.utterance_encoder_tokenizer
+    SEQUENCE_MAX_LEN=model.SEQUENCE_MAX_LEN
+
+    model=accelerator.prepare(model)
+    model.eval()
+
+    file_paths=sorted(TEST_DATA_PATH.glob('*.tsv'))
+    if use_tqdm and accelerator.is_main_process:
+        file_paths=tqdm(file_paths)
+
+    main_log('Working through files ...')
+    for file_path in file_paths:
+        slug=file_path.parts[-1].replace('.tsv', '')
+        start_time=time.monotonic()
+
+        lines, filename_to_filename_id, scene_id2line_ids, line_id2line_text, line_id2turn_n, line_id2speaker, speaker2line_ids=read_line_dicts({'test': file_path})
+        reversed_filename_to_filename_id={v: k for k, v in filename_to_filename_id.items()}
+
+        if args['encoder_name'] == 'SceneDialogueEncoder':
+            test_dataset=SceneCDDataset(lines, filename_to_filename_id, scene_id2line_ids, line_id2line_text, line_id2turn_n, line_id2speaker, speaker2line_ids, tokenizer, 'test', SEQUENCE_MAX_LEN)
+            collate_fn=collate_fn_scene
+        else:
+            cascade=None
+            if linear_model is not None:
+                scores, cascade_seconds=linear_scores(linear_model, cascade_tokenizer, 10, 'test', lines, filename_to_filename_id, scene_id2line_ids, # CDDataset.max_candidates
+                                                      line_id2line_text, line_id2turn_n, line_id2speaker, speaker2line_ids)
+                cascade=candidate_lists(select_candidates(scores, cascade_threshold, args['cascade_top_k']), lines, 'test', reversed_filename_to_filename_id)
+                main_log(f"{slug}: cascade kept {sum(len(c)-1 for c in cascade.values())/max(len(cascade), 1):.1f} candidates per utterance [{cascade_seconds:.2f}s]")
+            test_dataset=CDDataset(lines, filename_to_filename_id, scene_id2line_ids, line_id2line_text, line_id2turn_n, line_id2speaker, speaker2line_ids, tokenizer, 'test', SEQUENCE_MAX_LEN, context_lines=args['context_lines'],
+                                   candidate_lists=cascade)
+            collate_fn=collate_fn_cd
+        test_data_loader=torch.utils.data.DataLoader(dataset=test_dataset,
+                                                batch_size=BATCH_SIZE,
+                                                collate_fn=collate_fn)
+        test_data_loader=accelerator.prepare(test_data_loader)
+
+        preds_dict={}
+        for idx, d in enumerate(test_data_loader):
+            d={key: to_cuda(val) for key, val in d.items()}
+            with torch.no_grad():
+                outputs=model(d)
+                outputs=accelerator.pad_across_processes(outputs, pad_index=-1) # scene batches hold a varying number of pairs
+                outputs=accelerator.gather(outputs)
+
+                for filename_id, utterance_of_interest_id, candidate_line_id, logit in \
+                    zip(outputs['filename_id'], outputs['utterance_of_interest_id'], outputs['candidate_line_id'], outputs['logits'].view(-1)):
+                    if filename_id < 0:
+                        continue
+                    filename_id, utterance_of_interest_id, candidate_line_id, logit=\
+                        int(to_cpu(filename_id)), int(to_cpu(utterance_of_interest_id)), int(to_cpu(candidate_line_id)), float(to_cpu(logit))
+
+                    if filename_id not in preds_dict:
+                        preds_dict[filename_id]={}
+                    if utterance_of_interest_id not in preds_dict[filename_id]:
+                        preds_dict[filename_id][utterance_of_interest_id]=[]
+                    preds_dict[filename_id][utterance_of_interest_id].append((candidate_line_id, logit))
+
+        test_pred_lines=[]
+        for filename_id, utterances_of_interest_dict in preds_dict.items():
+            filename=reversed_filename_to_filename_id[filename_id]
+            threads_predicted=0
+            with open(PREDS_PATH.joinpath(filename+'.tsv'), 'w') as p:
+                for utterance_of_interest in sorted(utterances_of_interest_dict):
+                    scores=sorted(utterances_of_interest_dict[utterance_of_interest], key=lambda tup: tup[1], reverse=True)
+                    best_parent_id=scores[0][0]
+
+                    if best_parent_id == utterance_of_interest:
+                        final_pred=f"T{threads_predicted}"
+                        threads_predicted += 1
+                    else:
+                        final_pred=f"D{best_parent_id}"
+
+                    test_pred_lines.append([filename, f"D{utterance_of_interest}", final_pred])
+                    p.write('\t'.join([filename, f"D{utterance_of_interest}", final_pred])+'\n')
+
+        cluster_dict, _=eval_lines_dict_to_clusters(eval_lines_to_lines_dict(test_pred_lines))
+
+        for filename, clusters in cluster_dict.items():
+            with open(CLUSTERS_PATH.joinpath(filename+'.txt'), 'w') as c:
+                for cluster in clusters:
+                    vals=[str(v) for v in cluster]
+                    vals.sort()
+                    c.write(filename +":"+ " ".join(vals)+'\n')
+
+        time_diff=datetime.timedelta(seconds=time.monotonic() - start_time)
+        main_log(f"{slug}: {len(test_dataset)} items [{time_diff}]")
+
+    if args['embedding_cache']:
+        cache=accelerator.unwrap_model(model).embedding_cache
+        main_log(f"Embedding cache hits: {cache.hits}; misses: {cache.misses}; entries: {len(cache)}")
+        cache.close()
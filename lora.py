@@ -0,0 +1,110 @@
+import math
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from transformers import AutoConfig
+
+from models import load_utterance_encoder
+
+
+################################################################################
+# LoRA fine-tuning of a BertModel (Bert_v7.bert, utterance_encoder): the attention
+# projections (query / key / value / output dense) get a low rank update,
+# W x + alpha/rank * B A x, with W frozen, A (rank x in) random and B (out x rank)
+# zero, so training starts from the pretrained encoder. Everything else in the
+# encoder is frozen, the heads outside of it train as before: the optimizer state,
+# the DDP all-reduce (only parameters that require grad are bucketed) and the
+# checkpoint only cover the LoRA weights and the heads.
+#
+# The adapter checkpoint holds those tensors, plus the rows of the [LINE] / [SELF]
+# tokens the models.py encoders add to the pretrained vocabulary (random, frozen);
+# its metadata names the pretrained encoder. checkpoints.read_state_dict merges it
+# back into dense weights, W + alpha/rank * B A over the pretrained encoder, so the
+# inference scripts load a plain checkpoint and run no extra matmuls.
+#
+# The dense full_dim x full_dim fc of the models.py encoders alone is 17-40% of the
+# model (bert-base, the pointer variants at the top), so with --lora_rank the
+# trainers factorize it through LORA_HEAD_RANK (models.head_linear) unless
+# --head_rank says otherwise; the Bert_v7 heads of train_4DD stay dense. Above
+# LORA_MAX_TRAINABLE of the parameters trainable the trainers log a warning.
+
+LORA_HEAD_RANK=64
+LORA_MAX_TRAINABLE=0.1
+
+LORA_TARGETS=('attention.self.query', 'attention.self.key', 'attention.self.value', 'attention.output.dense')
+
+class LoRALinear(nn.Linear):
+    '''
+    the wrapped nn.Linear's weight / bias (same state dict keys), plus lora_A / lora_B
+    '''
+    def __init__(self, linear, rank, alpha, dropout=0.):
+        super().__init__(linear.in_features, linear.out_features, bias=linear.bias is not None, device='meta')
+        self.weight=linear.weight
+        self.bias=linear.bias
+        self.scaling=alpha/rank
+        self.lora_A=nn.Parameter(torch.empty(rank, linear.in_features, device=linear.weight.device, dtype=linear.weight.dtype))
+        self.lora_B=nn.Parameter(torch.zeros(linear.out_features, rank, device=linear.weight.device, dtype=linear.weight.dtype))
+        nn.init.kaiming_uniform_(self.lora_A, a=math.sqrt(5))
+        self.lora_dropout=nn.Dropout(dropout)
+
+    def forward(self, x):
+        return F.linear(x, self.weight, self.bias) + F.linear(F.linear(self.lora_dropout(x), self.lora_A), self.lora_B)*self.scaling
+
+def attach_lora(encoder, rank=8, alpha=16, dropout=0.1, targets=LORA_TARGETS):
+    '''
+    freezes the encoder and swaps the target nn.Linear of every layer for a LoRALinear
+    '''
+    for p in encoder.parameters():
+        p.requires_grad=False
+    for name, module in list(encoder.named_modules()):
+        if isinstance(module, nn.Linear) and not isinstance(module, LoRALinear) and name.endswith(tuple(targets)):
+            parent, _, child=name.rpartition('.')
+            setattr(encoder.get_submodule(parent), child, LoRALinear(module, rank, alpha, dropout))
+    return encoder
+
+def lora_settings(rank, alpha, targets, model_name, prefix):
+    '''
+    the checkpoint metadata: model_name is the pretrained encoder, prefix its state dict prefix ('bert.', 'utterance_encoder.')
+    '''
+    return {'rank': rank, 'alpha': alpha, 'targets': list(targets), 'model_name': model_name, 'prefix': prefix,
+            'vocab_size': AutoConfig.from_pretrained(model_name).vocab_size}
+
+def adapter_state_dict(model, lora):
+    '''
+    the LoRA weights, everything outside of the encoder and the added token rows
+    '''
+    prefix=lora['prefix']
+    state_dict={k: v for k, v in model.state_dict().items() if not k.startswith(prefix) or '.lora_' in k}
+    embeddings=model.state_dict()[f"{prefix}embeddings.word_embeddings.weight"]
+    if embeddings.shape[0] > lora['vocab_size']:
+        state_dict[f"{prefix}embeddings.word_embeddings.added_rows"]=embeddings[lora['vocab_size']:]
+    return state_dict
+
+def merge_adapter(state_dict, lora):
+    '''
+    adapter state dict -> dense state dict of the whole model
+    '''
+    prefix, scaling=lora['prefix'], lora['alpha']/lora['rank']
+    state_dict=dict(state_dict)
+    dense={f"{prefix}{k}": v for k, v in load_utterance_encoder(lora['model_name']).state_dict().items()}
+    added_rows=state_dict.pop(f"{prefix}embeddings.word_embeddings.added_rows", None)
+    if added_rows is not None:
+        key=f"{prefix}embeddings.word_embeddings.weight"
+        dense[key]=torch.cat([dense[key], added_rows.to(dense[key].dtype)])
+    for k in [k for k in state_dict if k.endswith('.lora_A')]:
+        module=k[:-len('.lora_A')]
+        A, B=state_dict.pop(k), state_dict.pop(f"{module}.lora_B")
+        weight=dense[f"{module}.weight"]
+        dense[f"{module}.weight"]=(weight.float() + (B.float() @ A.float())*scaling).to(weight.dtype)
+    dense.update(state_dict)
+    return dense
+
+def lora_report(model, lora):
+    '''
+    -> trainable / total parameters, adapter / dense checkpoint bytes
+    '''
+    trainable=sum(p.numel() for p in model.parameters() if p.requires_grad)
+    total=sum(p.numel() for p in model.parameters())
+    adapter_bytes=sum(v.numel()*v.element_size() for v in adapter_state_dict(model, lora).values())
+    dense_bytes=sum(v.numel()*v.element_size() for k, v in model.state_dict().items() if '.lora_' not in k)
+    return trainable, total, adapter_bytes, dense_bytes
@@ -0,0 +1,95 @@
+import time
+import torch
+
+
+################################################################################
+# Memory-budgeted training plan: the effective batch is split into micro-batches
+# (gradient accumulation), and gradient checkpointing of the encoder layers is
+# turned on when no micro-batch fits without it. Each candidate is probed on the
+# device with one forward / backward of a real training batch; its peak is
+# torch.cuda.max_memory_allocated plus the AdamW state (two fp32 moments of every
+# trainable parameter), which is only allocated at the first optimizer step.
+#
+# Preference order: without checkpointing, micro-batches from the whole effective
+# batch down to 1, then the same with checkpointing. Recomputing the encoder layers
+# costs about a third more compute, while with max_previous_utterance sequences per
+# example a micro-batch of 1 still fills the device, so accumulation is the cheaper
+# of the two. The first candidate that fits the budget is the plan.
+
+def micro_batch_sizes(effective_batch_size):
+    '''
+    divisors of the effective batch, largest first: every accumulation step sees the same batch size
+    '''
+    return [n for n in range(effective_batch_size, 0, -1) if effective_batch_size % n == 0]
+
+def set_gradient_checkpointing(encoder, enable):
+    '''
+    encoder: a HF encoder (BertModel & co.); non-reentrant checkpointing where transformers has it, otherwise
+    the inputs of the checkpointed layers need grad for frozen embeddings (LoRA) to still reach the layers
+    '''
+    if not enable:
+        encoder.gradient_checkpointing_disable()
+        return
+    try:
+        encoder.gradient_checkpointing_enable(gradient_checkpointing_kwargs={'use_reentrant': False})
+    except TypeError:
+        encoder.gradient_checkpointing_enable()
+        if not encoder.get_input_embeddings().weight.requires_grad:
+            encoder.enable_input_require_grads()
+
+def optimizer_state_bytes(model):
+    return sum(2*p.numel()*4 for p in model.parameters() if p.requires_grad)
+
+def probe_peak_memory(model, run, device):
+    '''
+    run(): one forward / backward; -> peak bytes during it and its seconds, (None, None) when it runs out of memory
+    '''
+    model.zero_grad(set_to_none=True)
+    torch.cuda.empty_cache()
+    torch.cuda.reset_peak_memory_stats(device)
+    try:
+        start=time.perf_counter()
+        run()
+        torch.cuda.synchronize(device)
+        peak, seconds=torch.cuda.max_memory_allocated(device), time.perf_counter() - start
+    except torch.cuda.OutOfMemoryError:
+        peak, seconds=None, None
+    model.zero_grad(set_to_none=True)
+    torch.cuda.empty_cache()
+    return peak, seconds
+
+def plan_training(model, encoder, run, effective_batch_size, budget_bytes, device):
+    '''
+    run(micro_batch_size): one forward / backward of a training batch of that size
+    -> {'micro_batch_size', 'accumulation_steps', 'checkpointing', 'peak_bytes', 'probes': [(micro_batch_size, checkpointing, peak, seconds)]},
+    the encoder left with the plan's checkpointing; only 'probes' when nothing fits
+    '''
+    state_bytes=optimizer_state_bytes(model)
+    probes=[]
+    for checkpointing in [False, True]:
+        set_gradient_checkpointing(encoder, checkpointing)
+        for micro_batch_size in micro_batch_sizes(effective_batch_size):
+            peak, seconds=probe_peak_memory(model, lambda: run(micro_batch_size), device)
+            peak=peak + state_bytes if peak is not None else None
+            probes.append((micro_batch_size, checkpointing, peak, seconds))
+            if peak is not None and peak <= budget_bytes:
+                return {'micro_batch_size': micro_batch_size,
+                        'accumulation_steps': effective_batch_size//micro_batch_size,
+                        'checkpointing': checkpointing,
+                        'peak_bytes': peak,
+                        'probes': probes}
+    set_gradient_checkpointing(encoder, False)
+    return {'probes': probes}
+
+def plan_report(plan):
+    '''
+    -> log lines, the probes and the chosen plan
+    '''
+    lines=[]
+    for micro_batch_size, checkpointing, peak, seconds in plan['probes']:
+        memory=f"{peak/2**30:.2f}GB, {seconds/micro_batch_size:.3f}s per example" if peak is not None else 'out of memory'
+        lines.append(f"micro-batch {micro_batch_size}, checkpointing {'on' if checkpointing else 'off'}: {memory}")
+    if 'micro_batch_size' in plan:
+        lines.append(f"plan: micro-batch {plan['micro_batch_size']} x {plan['accumulation_steps']} accumulation steps, "
+                     f"checkpointing {'on' if plan['checkpointing'] else 'off'}, peak {plan['peak_bytes']/2**30:.2f}GB")
+    return lines
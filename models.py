@@ -26,6 +26,8 @@ from torch import optim
 from transformers import AutoModel, AutoConfig, AutoTokenizer 
 from sklearn.metrics import f1_score
 from accelerate.logging import get_logger
+from embedding_cache import EmbeddingCache, fingerprint_state_dict, hash_token_ids
+from frozen_layers import attach_layer_cache, encode_with_frozen_bottom
 
 
 class DialogueLineEncoder(nn.Module):
@@ -36,7 +38,7 @@ class DialogueLineEncoder(nn.Module):
         self.model_name=self.args['model_name']
     
         ### Utterance Encoder
-        self.utterance_encoder=AutoModel.from_pretrained(self.model_name)
+        self.utterance_encoder=load_utterance_encoder(self.model_name, self.args)
         self.utterance_encoder_config=AutoConfig.from_pretrained(self.model_name)
         self.utterance_encoder_tokenizer=AutoTokenizer.from_pretrained(self.model_name, do_lower_case=False, do_basic_tokenize=False, local_files_only=True) 
 
@@ -44,7 +46,7 @@ class DialogueLineEncoder(nn.Module):
         SELF_TOKEN='[SELF]'
 
         self.utterance_encoder_tokenizer.add_tokens([LINE_TOKEN, SELF_TOKEN], special_tokens=True)
-        self.utterance_encoder.resize_token_embeddings(len(self.utterance_encoder_tokenizer))
+        resize_token_embeddings(self.utterance_encoder, len(self.utterance_encoder_tokenizer))
 
         self.BERT_HIDDEN_DIM=self.utterance_encoder_config.hidden_size
         self.SEQUENCE_MAX_LEN=self.utterance_encoder_tokenizer.model_max_length
@@ -63,23 +65,15 @@ class DialogueLineEncoder(nn.Module):
 
         self.full_dim=self.BERT_HIDDEN_DIM*5 + self.args["distance_embedding_size"] + 50*3
         # dim2=round(full_dim*0.6)
-        self.fc=nn.Linear(self.full_dim, self.full_dim)
+        self.context_encoder=context_encoder(self.BERT_HIDDEN_DIM, self.args)
+        self.fc=head_linear(self.full_dim, self.full_dim, self.args)
         self.fc2=nn.Linear(self.full_dim, 1)
         self.tanh=nn.Tanh()
 
         self.seen={}
     
     def forward(self, batch):        
-        inputs_cj={"input_ids": batch["context"],
-                   "attention_mask": (batch["context"] > 0).long()}
-        inputs_lj={"input_ids": batch["parent_utterance"],
-                   "attention_mask": (batch["parent_utterance"] > 0).long()}
-        inputs_li={"input_ids": batch["utterance_of_interest"],
-                   "attention_mask": (batch["utterance_of_interest"] > 0).long()}        
-
-        cj_cls=self.utterance_encoder(**inputs_cj)['last_hidden_state'][:, 0, :]
-        lj_cls=self.utterance_encoder(**inputs_lj)['last_hidden_state'][:, 0, :]
-        li_cls=self.utterance_encoder(**inputs_li)['last_hidden_state'][:, 0, :]
+        cj_cls, lj_cls, li_cls=encode_pair_cls(self, batch)
 
         e_d=self.distance_embeddings(batch['utterances_distance'])
 
@@ -101,6 +95,9 @@ class DialogueLineEncoder(nn.Module):
                  'mode': batch['mode'],
                  "label": batch['label']}        
 
+        if self.training and self.args.get('in_batch_negatives'): # see train_baseline.in_batch_negatives_loss
+            outputs['cls']=(cj_cls, lj_cls, li_cls)
+
         return outputs
 
 class DialogueLineEncoderA(nn.Module):
@@ -111,7 +108,7 @@ class DialogueLineEncoderA(nn.Module):
         self.model_name=self.args['model_name']
     
         ### Utterance Encoder
-        self.utterance_encoder=AutoModel.from_pretrained(self.model_name)
+        self.utterance_encoder=load_utterance_encoder(self.model_name, self.args)
         self.utterance_encoder_config=AutoConfig.from_pretrained(self.model_name)
         self.utterance_encoder_tokenizer=AutoTokenizer.from_pretrained(self.model_name, do_lower_case=False, do_basic_tokenize=False, local_files_only=True) 
 
@@ -119,7 +116,7 @@ class DialogueLineEncoderA(nn.Module):
         SELF_TOKEN='[SELF]'
 
         self.utterance_encoder_tokenizer.add_tokens([LINE_TOKEN, SELF_TOKEN], special_tokens=True)
-        self.utterance_encoder.resize_token_embeddings(len(self.utterance_encoder_tokenizer))
+        resize_token_embeddings(self.utterance_encoder, len(self.utterance_encoder_tokenizer))
 
         self.BERT_HIDDEN_DIM=self.utterance_encoder_config.hidden_size
         self.SEQUENCE_MAX_LEN=self.utterance_encoder_tokenizer.model_max_length
@@ -138,23 +135,15 @@ class DialogueLineEncoderA(nn.Module):
 
         self.full_dim=self.BERT_HIDDEN_DIM*5 + self.args["distance_embedding_size"] + 10*3
         # dim2=round(full_dim*0.6)
-        self.fc=nn.Linear(self.full_dim, self.full_dim)
+        self.context_encoder=context_encoder(self.BERT_HIDDEN_DIM, self.args)
+        self.fc=head_linear(self.full_dim, self.full_dim, self.args)
         self.fc2=nn.Linear(self.full_dim, 1)
         self.tanh=nn.Tanh()
 
         self.seen={}
     
     def forward(self, batch):        
-        inputs_cj={"input_ids": batch["context"],
-                   "attention_mask": (batch["context"] > 0).long()}
-        inputs_lj={"input_ids": batch["parent_utterance"],
-                   "attention_mask": (batch["parent_utterance"] > 0).long()}
-        inputs_li={"input_ids": batch["utterance_of_interest"],
-                   "attention_mask": (batch["utterance_of_interest"] > 0).long()}        
-
-        cj_cls=self.utterance_encoder(**inputs_cj)['last_hidden_state'][:, 0, :]
-        lj_cls=self.utterance_encoder(**inputs_lj)['last_hidden_state'][:, 0, :]
-        li_cls=self.utterance_encoder(**inputs_li)['last_hidden_state'][:, 0, :]
+        cj_cls, lj_cls, li_cls=encode_pair_cls(self, batch)
 
         e_d=self.distance_embeddings(batch['utterances_distance'])
 
@@ -176,6 +165,9 @@ class DialogueLineEncoderA(nn.Module):
                  'mode': batch['mode'],
                  "label": batch['label']}        
 
+        if self.training and self.args.get('in_batch_negatives'): # see train_baseline.in_batch_negatives_loss
+            outputs['cls']=(cj_cls, lj_cls, li_cls)
+
         return outputs
 
 
@@ -187,7 +179,7 @@ class DialogueLineEncoderB(nn.Module):
         self.model_name=self.args['model_name']
     
         ### Utterance Encoder
-        self.utterance_encoder=AutoModel.from_pretrained(self.model_name)
+        self.utterance_encoder=load_utterance_encoder(self.model_name, self.args)
         self.utterance_encoder_config=AutoConfig.from_pretrained(self.model_name)
         self.utterance_encoder_tokenizer=AutoTokenizer.from_pretrained(self.model_name, do_lower_case=False, do_basic_tokenize=False, local_files_only=True) 
 
@@ -195,7 +187,7 @@ class DialogueLineEncoderB(nn.Module):
         SELF_TOKEN='[SELF]'
 
         self.utterance_encoder_tokenizer.add_tokens([LINE_TOKEN, SELF_TOKEN], special_tokens=True)
-        self.utterance_encoder.resize_token_embeddings(len(self.utterance_encoder_tokenizer))
+        resize_token_embeddings(self.utterance_encoder, len(self.utterance_encoder_tokenizer))
 
         self.BERT_HIDDEN_DIM=self.utterance_encoder_config.hidden_size
         self.SEQUENCE_MAX_LEN=self.utterance_encoder_tokenizer.model_max_length
@@ -214,23 +206,15 @@ class DialogueLineEncoderB(nn.Module):
 
         self.full_dim=self.BERT_HIDDEN_DIM*5 + self.args["distance_embedding_size"] + 10*2
         # dim2=round(full_dim*0.6)
-        self.fc=nn.Linear(self.full_dim, self.full_dim)
+        self.context_encoder=context_encoder(self.BERT_HIDDEN_DIM, self.args)
+        self.fc=head_linear(self.full_dim, self.full_dim, self.args)
         self.fc2=nn.Linear(self.full_dim, 1)
         self.tanh=nn.Tanh()
 
         self.seen={}
     
     def forward(self, batch):        
-        inputs_cj={"input_ids": batch["context"],
-                   "attention_mask": (batch["context"] > 0).long()}
-        inputs_lj={"input_ids": batch["parent_utterance"],
-                   "attention_mask": (batch["parent_utterance"] > 0).long()}
-        inputs_li={"input_ids": batch["utterance_of_interest"],
-                   "attention_mask": (batch["utterance_of_interest"] > 0).long()}        
-
-        cj_cls=self.utterance_encoder(**inputs_cj)['last_hidden_state'][:, 0, :]
-        lj_cls=self.utterance_encoder(**inputs_lj)['last_hidden_state'][:, 0, :]
-        li_cls=self.utterance_encoder(**inputs_li)['last_hidden_state'][:, 0, :]
+        cj_cls, lj_cls, li_cls=encode_pair_cls(self, batch)
 
         e_d=self.distance_embeddings(batch['utterances_distance'])
 
@@ -252,6 +236,9 @@ class DialogueLineEncoderB(nn.Module):
                  'mode': batch['mode'],
                  "label": batch['label']}        
 
+        if self.training and self.args.get('in_batch_negatives'): # see train_baseline.in_batch_negatives_loss
+            outputs['cls']=(cj_cls, lj_cls, li_cls)
+
         return outputs
 
 class DialogueLineEncoderC(nn.Module):
@@ -262,7 +249,7 @@ class DialogueLineEncoderC(nn.Module):
         self.model_name=self.args['model_name']
     
         ### Utterance Encoder
-        self.utterance_encoder=AutoModel.from_pretrained(self.model_name)
+        self.utterance_encoder=load_utterance_encoder(self.model_name, self.args)
         self.utterance_encoder_config=AutoConfig.from_pretrained(self.model_name)
         self.utterance_encoder_tokenizer=AutoTokenizer.from_pretrained(self.model_name, do_lower_case=False, do_basic_tokenize=False, local_files_only=True) 
 
@@ -270,7 +257,7 @@ class DialogueLineEncoderC(nn.Module):
         SELF_TOKEN='[SELF]'
 
         self.utterance_encoder_tokenizer.add_tokens([LINE_TOKEN, SELF_TOKEN], special_tokens=True)
-        self.utterance_encoder.resize_token_embeddings(len(self.utterance_encoder_tokenizer))
+        resize_token_embeddings(self.utterance_encoder, len(self.utterance_encoder_tokenizer))
 
         self.BERT_HIDDEN_DIM=self.utterance_encoder_config.hidden_size
         self.SEQUENCE_MAX_LEN=self.utterance_encoder_tokenizer.model_max_length
@@ -289,23 +276,15 @@ class DialogueLineEncoderC(nn.Module):
 
         self.full_dim=self.BERT_HIDDEN_DIM*5 + self.args["distance_embedding_size"] + 150*3
         # dim2=round(full_dim*0.6)
-        self.fc=nn.Linear(self.full_dim, self.full_dim)
+        self.context_encoder=context_encoder(self.BERT_HIDDEN_DIM, self.args)
+        self.fc=head_linear(self.full_dim, self.full_dim, self.args)
         self.fc2=nn.Linear(self.full_dim, 1)
         self.tanh=nn.Tanh()
 
         self.seen={}
     
     def forward(self, batch):        
-        inputs_cj={"input_ids": batch["context"],
-                   "attention_mask": (batch["context"] > 0).long()}
-        inputs_lj={"input_ids": batch["parent_utterance"],
-                   "attention_mask": (batch["parent_utterance"] > 0).long()}
-        inputs_li={"input_ids": batch["utterance_of_interest"],
-                   "attention_mask": (batch["utterance_of_interest"] > 0).long()}        
-
-        cj_cls=self.utterance_encoder(**inputs_cj)['last_hidden_state'][:, 0, :]
-        lj_cls=self.utterance_encoder(**inputs_lj)['last_hidden_state'][:, 0, :]
-        li_cls=self.utterance_encoder(**inputs_li)['last_hidden_state'][:, 0, :]
+        cj_cls, lj_cls, li_cls=encode_pair_cls(self, batch)
 
         e_d=self.distance_embeddings(batch['utterances_distance'])
 
@@ -327,6 +306,9 @@ class DialogueLineEncoderC(nn.Module):
                  'mode': batch['mode'],
                  "label": batch['label']}        
 
+        if self.training and self.args.get('in_batch_negatives'): # see train_baseline.in_batch_negatives_loss
+            outputs['cls']=(cj_cls, lj_cls, li_cls)
+
         return outputs
 
 class DialogueLineEncoderD(nn.Module):
@@ -337,7 +319,7 @@ class DialogueLineEncoderD(nn.Module):
         self.model_name=self.args['model_name']
     
         ### Utterance Encoder
-        self.utterance_encoder=AutoModel.from_pretrained(self.model_name)
+        self.utterance_encoder=load_utterance_encoder(self.model_name, self.args)
         self.utterance_encoder_config=AutoConfig.from_pretrained(self.model_name)
         self.utterance_encoder_tokenizer=AutoTokenizer.from_pretrained(self.model_name, do_lower_case=False, do_basic_tokenize=False, local_files_only=True) 
 
@@ -345,7 +327,7 @@ class DialogueLineEncoderD(nn.Module):
         SELF_TOKEN='[SELF]'
 
         self.utterance_encoder_tokenizer.add_tokens([LINE_TOKEN, SELF_TOKEN], special_tokens=True)
-        self.utterance_encoder.resize_token_embeddings(len(self.utterance_encoder_tokenizer))
+        resize_token_embeddings(self.utterance_encoder, len(self.utterance_encoder_tokenizer))
 
         self.BERT_HIDDEN_DIM=self.utterance_encoder_config.hidden_size
         self.SEQUENCE_MAX_LEN=self.utterance_encoder_tokenizer.model_max_length
@@ -364,23 +346,15 @@ class DialogueLineEncoderD(nn.Module):
 
         self.full_dim=self.BERT_HIDDEN_DIM*5 + self.args["distance_embedding_size"] + 150*2
         # dim2=round(full_dim*0.6)
-        self.fc=nn.Linear(self.full_dim, self.full_dim)
+        self.context_encoder=context_encoder(self.BERT_HIDDEN_DIM, self.args)
+        self.fc=head_linear(self.full_dim, self.full_dim, self.args)
         self.fc2=nn.Linear(self.full_dim, 1)
         self.tanh=nn.Tanh()
 
         self.seen={}
     
     def forward(self, batch):        
-        inputs_cj={"input_ids": batch["context"],
-                   "attention_mask": (batch["context"] > 0).long()}
-        inputs_lj={"input_ids": batch["parent_utterance"],
-                   "attention_mask": (batch["parent_utterance"] > 0).long()}
-        inputs_li={"input_ids": batch["utterance_of_interest"],
-                   "attention_mask": (batch["utterance_of_interest"] > 0).long()}        
-
-        cj_cls=self.utterance_encoder(**inputs_cj)['last_hidden_state'][:, 0, :]
-        lj_cls=self.utterance_encoder(**inputs_lj)['last_hidden_state'][:, 0, :]
-        li_cls=self.utterance_encoder(**inputs_li)['last_hidden_state'][:, 0, :]
+        cj_cls, lj_cls, li_cls=encode_pair_cls(self, batch)
 
         e_d=self.distance_embeddings(batch['utterances_distance'])
 
@@ -402,6 +376,9 @@ class DialogueLineEncoderD(nn.Module):
                  'mode': batch['mode'],
                  "label": batch['label']}        
 
+        if self.training and self.args.get('in_batch_negatives'): # see train_baseline.in_batch_negatives_loss
+            outputs['cls']=(cj_cls, lj_cls, li_cls)
+
         return outputs
 
 class DialogueLineEncoderE(nn.Module):
@@ -412,7 +389,7 @@ class DialogueLineEncoderE(nn.Module):
         self.model_name=self.args['model_name']
     
         ### Utterance Encoder
-        self.utterance_encoder=AutoModel.from_pretrained(self.model_name)
+        self.utterance_encoder=load_utterance_encoder(self.model_name, self.args)
         self.utterance_encoder_config=AutoConfig.from_pretrained(self.model_name)
         self.utterance_encoder_tokenizer=AutoTokenizer.from_pretrained(self.model_name, do_lower_case=False, do_basic_tokenize=False, local_files_only=True) 
 
@@ -420,7 +397,7 @@ class DialogueLineEncoderE(nn.Module):
         SELF_TOKEN='[SELF]'
 
         self.utterance_encoder_tokenizer.add_tokens([LINE_TOKEN, SELF_TOKEN], special_tokens=True)
-        self.utterance_encoder.resize_token_embeddings(len(self.utterance_encoder_tokenizer))
+        resize_token_embeddings(self.utterance_encoder, len(self.utterance_encoder_tokenizer))
 
         self.BERT_HIDDEN_DIM=self.utterance_encoder_config.hidden_size
         self.SEQUENCE_MAX_LEN=self.utterance_encoder_tokenizer.model_max_length
@@ -439,23 +416,15 @@ class DialogueLineEncoderE(nn.Module):
 
         self.full_dim=self.BERT_HIDDEN_DIM*5 + self.args["distance_embedding_size"] + 200*2
         # dim2=round(full_dim*0.6)
-        self.fc=nn.Linear(self.full_dim, self.full_dim)
+        self.context_encoder=context_encoder(self.BERT_HIDDEN_DIM, self.args)
+        self.fc=head_linear(self.full_dim, self.full_dim, self.args)
         self.fc2=nn.Linear(self.full_dim, 1)
         self.tanh=nn.Tanh()
 
         self.seen={}
     
     def forward(self, batch):        
-        inputs_cj={"input_ids": batch["context"],
-                   "attention_mask": (batch["context"] > 0).long()}
-        inputs_lj={"input_ids": batch["parent_utterance"],
-                   "attention_mask": (batch["parent_utterance"] > 0).long()}
-        inputs_li={"input_ids": batch["utterance_of_interest"],
-                   "attention_mask": (batch["utterance_of_interest"] > 0).long()}        
-
-        cj_cls=self.utterance_encoder(**inputs_cj)['last_hidden_state'][:, 0, :]
-        lj_cls=self.utterance_encoder(**inputs_lj)['last_hidden_state'][:, 0, :]
-        li_cls=self.utterance_encoder(**inputs_li)['last_hidden_state'][:, 0, :]
+        cj_cls, lj_cls, li_cls=encode_pair_cls(self, batch)
 
         e_d=self.distance_embeddings(batch['utterances_distance'])
 
@@ -477,6 +446,9 @@ class DialogueLineEncoderE(nn.Module):
                  'mode': batch['mode'],
                  "label": batch['label']}        
 
+        if self.training and self.args.get('in_batch_negatives'): # see train_baseline.in_batch_negatives_loss
+            outputs['cls']=(cj_cls, lj_cls, li_cls)
+
         return outputs
 
 class DialogueLineEncoderF(nn.Module):
@@ -487,7 +459,7 @@ class DialogueLineEncoderF(nn.Module):
         self.model_name=self.args['model_name']
     
         ### Utterance Encoder
-        self.utterance_encoder=AutoModel.from_pretrained(self.model_name)
+        self.utterance_encoder=load_utterance_encoder(self.model_name, self.args)
         self.utterance_encoder_config=AutoConfig.from_pretrained(self.model_name)
         self.utterance_encoder_tokenizer=AutoTokenizer.from_pretrained(self.model_name, do_lower_case=False, do_basic_tokenize=False) 
 
@@ -495,7 +467,7 @@ class DialogueLineEncoderF(nn.Module):
         SELF_TOKEN='[SELF]'
 
         self.utterance_encoder_tokenizer.add_tokens([LINE_TOKEN, SELF_TOKEN], special_tokens=True)
-        self.utterance_encoder.resize_token_embeddings(len(self.utterance_encoder_tokenizer))
+        resize_token_embeddings(self.utterance_encoder, len(self.utterance_encoder_tokenizer))
 
         self.BERT_HIDDEN_DIM=self.utterance_encoder_config.hidden_size
         self.SEQUENCE_MAX_LEN=self.utterance_encoder_tokenizer.model_max_length
@@ -514,23 +486,15 @@ class DialogueLineEncoderF(nn.Module):
 
         self.full_dim=self.BERT_HIDDEN_DIM*5 + self.args["distance_embedding_size"] + 250*2
         # dim2=round(full_dim*0.6)
-        self.fc=nn.Linear(self.full_dim, self.full_dim)
+        self.context_encoder=context_encoder(self.BERT_HIDDEN_DIM, self.args)
+        self.fc=head_linear(self.full_dim, self.full_dim, self.args)
         self.fc2=nn.Linear(self.full_dim, 1)
         self.tanh=nn.Tanh()
 
         self.seen={}
     
     def forward(self, batch):        
-        inputs_cj={"input_ids": batch["context"],
-                   "attention_mask": (batch["context"] > 0).long()}
-        inputs_lj={"input_ids": batch["parent_utterance"],
-                   "attention_mask": (batch["parent_utterance"] > 0).long()}
-        inputs_li={"input_ids": batch["utterance_of_interest"],
-                   "attention_mask": (batch["utterance_of_interest"] > 0).long()}        
-
-        cj_cls=self.utterance_encoder(**inputs_cj)['last_hidden_state'][:, 0, :]
-        lj_cls=self.utterance_encoder(**inputs_lj)['last_hidden_state'][:, 0, :]
-        li_cls=self.utterance_encoder(**inputs_li)['last_hidden_state'][:, 0, :]
+        cj_cls, lj_cls, li_cls=encode_pair_cls(self, batch)
 
         e_d=self.distance_embeddings(batch['utterances_distance'])
 
@@ -552,6 +516,9 @@ class DialogueLineEncoderF(nn.Module):
                  'mode': batch['mode'],
                  "label": batch['label']}        
 
+        if self.training and self.args.get('in_batch_negatives'): # see train_baseline.in_batch_negatives_loss
+            outputs['cls']=(cj_cls, lj_cls, li_cls)
+
         return outputs        
 
 ################################################################################
@@ -564,7 +531,7 @@ class MultitaskDialogueEncoder(nn.Module): # new 1228
         self.model_name=self.args['model_name']
     
         ### Utterance Encoder
-        self.utterance_encoder=AutoModel.from_pretrained(self.model_name)
+        self.utterance_encoder=load_utterance_encoder(self.model_name, self.args)
         self.utterance_encoder_config=AutoConfig.from_pretrained(self.model_name)
         self.utterance_encoder_tokenizer=AutoTokenizer.from_pretrained(self.model_name, do_lower_case=False, do_basic_tokenize=False, local_files_only=True) 
 
@@ -572,7 +539,7 @@ class MultitaskDialogueEncoder(nn.Module): # new 1228
         SELF_TOKEN='[SELF]'
 
         self.utterance_encoder_tokenizer.add_tokens([LINE_TOKEN, SELF_TOKEN], special_tokens=True)
-        self.utterance_encoder.resize_token_embeddings(len(self.utterance_encoder_tokenizer))
+        resize_token_embeddings(self.utterance_encoder, len(self.utterance_encoder_tokenizer))
 
         self.BERT_HIDDEN_DIM=self.utterance_encoder_config.hidden_size
         self.SEQUENCE_MAX_LEN=self.utterance_encoder_tokenizer.model_max_length
@@ -595,21 +562,13 @@ class MultitaskDialogueEncoder(nn.Module): # new 1228
         # self.fc2=nn.Linear(self.full_dim, 1)
         self.tanh=nn.Tanh()
 
-        self.fc=nn.Linear(self.full_dim, self.full_dim)
+        self.context_encoder=context_encoder(self.BERT_HIDDEN_DIM, self.args)
+        self.fc=head_linear(self.full_dim, self.full_dim, self.args)
         self.fc_reply=nn.Linear(self.full_dim, 1)
         self.fc_thread=nn.Linear(self.full_dim, 1)
     
     def forward(self, batch):        
-        inputs_cj={"input_ids": batch["context"],
-                   "attention_mask": (batch["context"] > 0).long()}
-        inputs_lj={"input_ids": batch["parent_utterance"],
-                   "attention_mask": (batch["parent_utterance"] > 0).long()}
-        inputs_li={"input_ids": batch["utterance_of_interest"],
-                   "attention_mask": (batch["utterance_of_interest"] > 0).long()}        
-
-        cj_cls=self.utterance_encoder(**inputs_cj)['last_hidden_state'][:, 0, :]
-        lj_cls=self.utterance_encoder(**inputs_lj)['last_hidden_state'][:, 0, :]
-        li_cls=self.utterance_encoder(**inputs_li)['last_hidden_state'][:, 0, :]
+        cj_cls, lj_cls, li_cls=encode_pair_cls(self, batch)
 
         e_d=self.distance_embeddings(batch['utterances_distance'])
 
@@ -623,6 +582,8 @@ class MultitaskDialogueEncoder(nn.Module): # new 1228
         out=self.tanh(out)
 
         reply_logits=self.fc_reply(out).squeeze()
+        # computed in every mode so the set of parameters used is the same each step (DDP static_graph)
+        thread_logits=self.fc_thread(out).squeeze()
 
         if (1 in batch['mode']) or (2 in batch['mode']):
             outputs={
@@ -634,7 +595,6 @@ class MultitaskDialogueEncoder(nn.Module): # new 1228
                     "label": batch['label']
                     }        
         else:
-            thread_logits=self.fc_thread(out).squeeze()
             outputs={
                     "filename_id": batch['filename_id'],
                     "candidate_line_id": batch['candidate_line_id'],
@@ -646,6 +606,9 @@ class MultitaskDialogueEncoder(nn.Module): # new 1228
                     "thread_label": batch['same_thread']
                     }        
 
+        if self.training and self.args.get('in_batch_negatives'): # see train_baseline.in_batch_negatives_loss
+            outputs['cls']=(cj_cls, lj_cls, li_cls)
+
         return outputs
 
 
@@ -657,7 +620,7 @@ class MultitaskDialogueEncoderWithPointer(nn.Module): # new 1228
         self.model_name=self.args['model_name']
     
         ### Utterance Encoder
-        self.utterance_encoder=AutoModel.from_pretrained(self.model_name)
+        self.utterance_encoder=load_utterance_encoder(self.model_name, self.args)
         self.utterance_encoder_config=AutoConfig.from_pretrained(self.model_name)
         self.utterance_encoder_tokenizer=AutoTokenizer.from_pretrained(self.model_name, do_lower_case=False, do_basic_tokenize=False, local_files_only=True) 
 
@@ -665,7 +628,7 @@ class MultitaskDialogueEncoderWithPointer(nn.Module): # new 1228
         SELF_TOKEN='[SELF]'
 
         self.utterance_encoder_tokenizer.add_tokens([LINE_TOKEN, SELF_TOKEN], special_tokens=True)
-        self.utterance_encoder.resize_token_embeddings(len(self.utterance_encoder_tokenizer))
+        resize_token_embeddings(self.utterance_encoder, len(self.utterance_encoder_tokenizer))
 
         self.BERT_HIDDEN_DIM=self.utterance_encoder_config.hidden_size
         self.SEQUENCE_MAX_LEN=self.utterance_encoder_tokenizer.model_max_length
@@ -688,7 +651,8 @@ class MultitaskDialogueEncoderWithPointer(nn.Module): # new 1228
         # self.fc2=nn.Linear(self.full_dim, 1)
         self.tanh=nn.Tanh()
 
-        self.fc=nn.Linear(self.full_dim, self.full_dim)
+        self.context_encoder=context_encoder(self.BERT_HIDDEN_DIM, self.args)
+        self.fc=head_linear(self.full_dim, self.full_dim, self.args)
         self.fc_reply=nn.Linear(self.full_dim, 1)
         self.fc_thread=nn.Linear(self.full_dim, 1)
     
@@ -720,18 +684,20 @@ class MultitaskDialogueEncoderWithPointer(nn.Module): # new 1228
         return torch.cat([p1, p2], 1)
 
     def forward(self, batch):        
-        inputs_cj={"input_ids": batch["context"],
-                   "attention_mask": (batch["context"] > 0).long()}
         inputs_lj={"input_ids": batch["parent_utterance"],
                    "attention_mask": (batch["parent_utterance"] > 0).long()}
         inputs_li={"input_ids": batch["utterance_of_interest"],
                    "attention_mask": (batch["utterance_of_interest"] > 0).long()}        
 
-        cj_cls=self.utterance_encoder(**inputs_cj)['last_hidden_state'][:, 0, :]
-        lj_cls=self.utterance_encoder(**inputs_lj)['last_hidden_state'][:, 0, :]
-        li_cls=self.utterance_encoder(**inputs_li)['last_hidden_state'][:, 0, :]
-
-        q1_align, q2_align=self.soft_attention_align(lj_cls, li_cls, inputs_lj['attention_mask'], inputs_li['attention_mask'])
+        if self.args.get('late_interaction'):
+            cj_cls=encode_cls(self, batch, 'context')
+            lj_tokens, lj_mask=encode_tokens(self, batch, 'parent_utterance')
+            li_tokens, li_mask=encode_tokens(self, batch, 'utterance_of_interest')
+            lj_cls, li_cls=lj_tokens[:, 0, :], li_tokens[:, 0, :]
+            q1_align, q2_align=max_sim_align(lj_tokens, li_tokens, lj_mask, li_mask)
+        else:
+            cj_cls, lj_cls, li_cls=encode_pair_cls(self, batch)
+            q1_align, q2_align=self.soft_attention_align(lj_cls, li_cls, inputs_lj['attention_mask'], inputs_li['attention_mask'])
         q1_combined=torch.cat([lj_cls, q1_align, self.submul(lj_cls, q1_align)], 1)
         q2_combined=torch.cat([li_cls, q2_align, self.submul(li_cls, q2_align)], 1)
 
@@ -747,6 +713,8 @@ class MultitaskDialogueEncoderWithPointer(nn.Module): # new 1228
         out=self.tanh(out)
 
         reply_logits=self.fc_reply(out).squeeze()
+        # computed in every mode so the set of parameters used is the same each step (DDP static_graph)
+        thread_logits=self.fc_thread(out).squeeze()
 
         if (1 in batch['mode']) or (2 in batch['mode']):
             outputs={
@@ -758,7 +726,6 @@ class MultitaskDialogueEncoderWithPointer(nn.Module): # new 1228
                     "label": batch['label']
                     }        
         else:
-            thread_logits=self.fc_thread(out).squeeze()
             outputs={
                     "filename_id": batch['filename_id'],
                     "candidate_line_id": batch['candidate_line_id'],
@@ -783,7 +750,7 @@ class DialogueEncoderWithPointer(nn.Module): # new 1228
         self.model_name=self.args['model_name']
     
         ### Utterance Encoder
-        self.utterance_encoder=AutoModel.from_pretrained(self.model_name)
+        self.utterance_encoder=load_utterance_encoder(self.model_name, self.args)
         self.utterance_encoder_config=AutoConfig.from_pretrained(self.model_name)
         self.utterance_encoder_tokenizer=AutoTokenizer.from_pretrained(self.model_name, do_lower_case=False, do_basic_tokenize=False, local_files_only=True) 
 
@@ -791,7 +758,7 @@ class DialogueEncoderWithPointer(nn.Module): # new 1228
         SELF_TOKEN='[SELF]'
 
         self.utterance_encoder_tokenizer.add_tokens([LINE_TOKEN, SELF_TOKEN], special_tokens=True)
-        self.utterance_encoder.resize_token_embeddings(len(self.utterance_encoder_tokenizer))
+        resize_token_embeddings(self.utterance_encoder, len(self.utterance_encoder_tokenizer))
 
         self.BERT_HIDDEN_DIM=self.utterance_encoder_config.hidden_size
         self.SEQUENCE_MAX_LEN=self.utterance_encoder_tokenizer.model_max_length
@@ -814,7 +781,8 @@ class DialogueEncoderWithPointer(nn.Module): # new 1228
         # self.fc2=nn.Linear(self.full_dim, 1)
         self.tanh=nn.Tanh()
 
-        self.fc=nn.Linear(self.full_dim, self.full_dim)
+        self.context_encoder=context_encoder(self.BERT_HIDDEN_DIM, self.args)
+        self.fc=head_linear(self.full_dim, self.full_dim, self.args)
         self.fc_2=nn.Linear(self.full_dim, 1)
     
     def soft_attention_align(self, x1, x2, mask1, mask2):
@@ -845,18 +813,20 @@ class DialogueEncoderWithPointer(nn.Module): # new 1228
         return torch.cat([p1, p2], 1)
 
     def forward(self, batch):        
-        inputs_cj={"input_ids": batch["context"],
-                   "attention_mask": (batch["context"] > 0).long()}
         inputs_lj={"input_ids": batch["parent_utterance"],
                    "attention_mask": (batch["parent_utterance"] > 0).long()}
         inputs_li={"input_ids": batch["utterance_of_interest"],
                    "attention_mask": (batch["utterance_of_interest"] > 0).long()}        
 
-        cj_cls=self.utterance_encoder(**inputs_cj)['last_hidden_state'][:, 0, :]
-        lj_cls=self.utterance_encoder(**inputs_lj)['last_hidden_state'][:, 0, :]
-        li_cls=self.utterance_encoder(**inputs_li)['last_hidden_state'][:, 0, :]
-
-        q1_align, q2_align=self.soft_attention_align(lj_cls, li_cls, inputs_lj['attention_mask'], inputs_li['attention_mask'])
+        if self.args.get('late_interaction'):
+            cj_cls=encode_cls(self, batch, 'context')
+            lj_tokens, lj_mask=encode_tokens(self, batch, 'parent_utterance')
+            li_tokens, li_mask=encode_tokens(self, batch, 'utterance_of_interest')
+            lj_cls, li_cls=lj_tokens[:, 0, :], li_tokens[:, 0, :]
+            q1_align, q2_align=max_sim_align(lj_tokens, li_tokens, lj_mask, li_mask)
+        else:
+            cj_cls, lj_cls, li_cls=encode_pair_cls(self, batch)
+            q1_align, q2_align=self.soft_attention_align(lj_cls, li_cls, inputs_lj['attention_mask'], inputs_li['attention_mask'])
         q1_combined=torch.cat([lj_cls, q1_align, self.submul(lj_cls, q1_align)], 1)
         q2_combined=torch.cat([li_cls, q2_align, self.submul(li_cls, q2_align)], 1)
 
@@ -878,11 +848,459 @@ class DialogueEncoderWithPointer(nn.Module): # new 1228
                  "candidate_line_id": batch['candidate_line_id'],
                  "utterance_of_interest_id": batch['utterance_of_interest_id'],
                  'mode': batch['mode'],
-                 "label": batch['label']}        
+                 "label": batch['label']}
+
+
+        return outputs
+
+################################################################################
+
+class SceneDialogueEncoder(nn.Module):
+    '''
+    encodes a whole scene window once (a long-context encoder, e.g. allenai/longformer-base-4096),
+    mean-pools every line's tokens into a line vector and scores all (uoi, candidate) pairs of the
+    window from those; batches come from train_baseline.SceneCDDataset / collate_fn_scene
+    '''
+    def __init__(self, args):
+        super().__init__()
+
+        self.args=args
+        self.model_name=self.args['model_name']
+
+        ### Scene Encoder
+        self.utterance_encoder=load_utterance_encoder(self.model_name, self.args)
+        self.utterance_encoder_config=AutoConfig.from_pretrained(self.model_name)
+        self.utterance_encoder_tokenizer=AutoTokenizer.from_pretrained(self.model_name, do_lower_case=False, do_basic_tokenize=False, local_files_only=True)
+
+        LINE_TOKEN='[LINE]'
+        SELF_TOKEN='[SELF]'
+
+        self.utterance_encoder_tokenizer.add_tokens([LINE_TOKEN, SELF_TOKEN], special_tokens=True)
+        resize_token_embeddings(self.utterance_encoder, len(self.utterance_encoder_tokenizer))
+
+        self.BERT_HIDDEN_DIM=self.utterance_encoder_config.hidden_size
+        self.SEQUENCE_MAX_LEN=self.utterance_encoder_tokenizer.model_max_length
+
+        self.fix_encoder=self.args["fix_encoder"]
+
+        if self.fix_encoder:
+            for p in self.utterance_encoder.parameters():
+                p.requires_grad=False
+
+        # stands in for the candidate line when the candidate is the utterance itself (new thread)
+        self.self_embedding=nn.Parameter(torch.randn(self.BERT_HIDDEN_DIM)*0.02)
+
+        self.distance_embeddings=nn.Embedding(args["distance_embedding_dim"], self.args["distance_embedding_size"])
+
+        self.first_speaker_embeddings=nn.Embedding(2, 50)
+        self.turn_embeddings=nn.Embedding(2, 50)
+        self.speaker_embeddings=nn.Embedding(2, 50)
+
+        self.full_dim=self.BERT_HIDDEN_DIM*4 + self.args["distance_embedding_size"] + 50*3
+        self.fc=head_linear(self.full_dim, self.full_dim, self.args)
+        self.fc2=nn.Linear(self.full_dim, 1)
+        self.tanh=nn.Tanh()
+
+    def encode_lines(self, batch):
+        '''
+        num_slots * hidden, the mean of each line's token states
+        '''
+        scene_tokens=batch['scene_tokens']
+        hidden=self.utterance_encoder(input_ids=scene_tokens, attention_mask=(scene_tokens > 0).long())['last_hidden_state']
+        hidden=hidden.reshape(-1, hidden.size(-1))
+
+        token_slot=batch['token_slot'].reshape(-1)
+        in_line=token_slot >= 0
+        num_slots=int(token_slot.max())+1
+        line_sum=hidden.new_zeros(num_slots, hidden.size(-1)).index_add(0, token_slot[in_line], hidden[in_line])
+        line_len=hidden.new_zeros(num_slots).index_add(0, token_slot[in_line], hidden.new_ones(int(in_line.sum())))
+        return line_sum / line_len.clamp(min=1).unsqueeze(1)
+
+    def forward(self, batch):
+        line_vectors=self.encode_lines(batch)
+
+        li=line_vectors[batch['uoi_slot']]
+        is_self=(batch['candidate_slot'] < 0).unsqueeze(1)
+        lj=torch.where(is_self, self.self_embedding.unsqueeze(0).expand_as(li), line_vectors[batch['candidate_slot'].clamp(min=0)])
+
+        e_d=self.distance_embeddings(batch['utterances_distance'])
+
+        t_d=self.turn_embeddings(batch['same_turn'])
+        f_d=self.first_speaker_embeddings(batch['first_spoke'])
+        k_d=self.speaker_embeddings(batch['same_speaker'])
+
+        out=torch.cat([lj, li, li-lj, li*lj, e_d, t_d, f_d, k_d], 1)
+        out=self.fc(out)
+        out=self.tanh(out)
 
+        logits=self.fc2(out).squeeze(-1)
+
+        outputs={"filename_id": batch['filename_id'],
+                 "logits": logits,
+                 "candidate_line_id": batch['candidate_line_id'],
+                 "utterance_of_interest_id": batch['utterance_of_interest_id'],
+                 'mode': batch['mode'],
+                 "label": batch['label']}
 
         return outputs
 
+################################################################################
+# Encoder loading
+#
+# only the CLS vector of last_hidden_state is used, so the pooler is not built: its
+# weights would never get a gradient and DDP would need find_unused_parameters=True.
+# with args['from_checkpoint'] the encoder is only built from its config, the checkpoint
+# brings every weight (checkpoints.py builds the model on the meta device)
+
+def load_utterance_encoder(model_name, args=None):
+    if args is not None and args.get('from_checkpoint'):
+        config=AutoConfig.from_pretrained(model_name)
+        try:
+            return AutoModel.from_config(config, add_pooling_layer=False)
+        except TypeError:
+            return AutoModel.from_config(config)
+    try:
+        return AutoModel.from_pretrained(model_name, add_pooling_layer=False)
+    except TypeError: # architectures without a pooler (e.g. electra) do not take the argument
+        return AutoModel.from_pretrained(model_name)
+
+def resize_token_embeddings(encoder, num_tokens):
+    '''
+    rows for the added [LINE] / [SELF] tokens; on the meta device there is nothing to initialize them from
+    '''
+    if encoder.get_input_embeddings().weight.is_meta:
+        try:
+            return encoder.resize_token_embeddings(num_tokens, mean_resizing=False)
+        except TypeError: # older transformers, no mean initialization anyway
+            pass
+    return encoder.resize_token_embeddings(num_tokens)
+
+LEGACY_UNUSED_PREFIXES=['utterance_encoder.pooler.', 'bert.pooler.', 'BiLSTM.', 'W.']
+
+def drop_legacy_keys(state_dict, model):
+    '''
+    checkpoints saved before the unused modules were removed still carry their weights
+    '''
+    expected=model.state_dict().keys()
+    return {k: v for k, v in state_dict.items()
+            if k in expected or not any(k.startswith(prefix) for prefix in LEGACY_UNUSED_PREFIXES)}
+
+################################################################################
+# CLS encoding shared by every forward, with optional caches
+#
+# the embedding cache is only consulted in eval mode: training needs gradients through
+# the encoder, and the key pins the exact encoder weights it was computed with.
+# the layer cache (frozen_layers.py) holds the output of the frozen bottom layers and
+# is used in both modes
+
+def encode_cls(model, batch, key):
+    '''
+    CLS vector of batch[key] (batch_size * SEQUENCE_MAX_LEN token ids) through model.utterance_encoder
+    '''
+    if key == 'context' and getattr(model, 'context_encoder', None) is not None:
+        return encode_context_lines(model, batch)
+    cls=encode_sequences(model, batch, key)
+    if key == 'utterance_of_interest' and 'group_index' in batch:
+        # listwise batches (train_baseline --listwise) carry each utterance once per candidate group
+        cls=cls[batch['group_index']]
+    return cls
+
+def encode_pair_cls(model, batch):
+    '''
+    CLS vectors of the context, parent_utterance and utterance_of_interest of every pair
+    '''
+    if 'lines' not in batch:
+        return encode_cls(model, batch, 'context'), encode_cls(model, batch, 'parent_utterance'), encode_cls(model, batch, 'utterance_of_interest')
+    # listwise batches with context_lines (train_baseline collate_fn_grouped): the candidates, the context
+    # lines and the utterances are lines of the same scene, each distinct one is a row of batch['lines'] once
+    line_cls=encode_rows(model, batch['lines'])
+    cj_cls=model.context_encoder(line_cls[batch['context_line']], batch['context_num_lines'])
+    return cj_cls, line_cls[batch['parent_utterance_line']], line_cls[batch['utterance_of_interest_line']][batch['group_index']]
+
+def encode_sequences(model, batch, key):
+    if f"{key}_cls" in batch: # precomputed by feature_store.FeatureStoreCollate
+        return batch[f"{key}_cls"]
+    return encode_rows(model, batch[key])
+
+def encode_rows(model, input_ids):
+    # the same utterance / [SELF] / context rows repeat across the candidates of a batch:
+    # encode each distinct row once and gather back (backward sums the gradients of the copies)
+    unique_ids, inverse=torch.unique(input_ids, dim=0, return_inverse=True)
+    if unique_ids.size(0) < input_ids.size(0):
+        return encode_unique(model, unique_ids)[inverse]
+    return encode_unique(model, input_ids)
+
+def encode_unique(model, input_ids):
+    if getattr(model, 'embedding_cache', None) is not None and not model.training:
+        return cached_cls(model, input_ids)
+    if getattr(model, 'layer_cache', None) is not None:
+        return encode_with_frozen_bottom(model.utterance_encoder, input_ids, (input_ids > 0).long(), None,
+                                         model.frozen_layers, model.layer_cache, model.layer_cache_prefix)[:, 0, :]
+    inputs={"input_ids": input_ids,
+            "attention_mask": (input_ids > 0).long()}
+    return model.utterance_encoder(**inputs)['last_hidden_state'][:, 0, :]
+
+def cached_cls(model, input_ids):
+    keys=[f"{model.embedding_cache_prefix}:{hash_token_ids(row)}" for row in input_ids]
+    found=model.embedding_cache.get_many(keys)
+
+    missing=sorted(set(keys) - set(found.keys()))
+    if missing:
+        rows=[keys.index(k) for k in missing]
+        missing_ids=input_ids[rows]
+        inputs={"input_ids": missing_ids,
+                "attention_mask": (missing_ids > 0).long()}
+        with torch.no_grad():
+            cls=model.utterance_encoder(**inputs)['last_hidden_state'][:, 0, :]
+        # round through float16 so a cold and a warm run give identical scores
+        fresh={k: v.half().float().cpu().numpy() for k, v in zip(missing, cls)}
+        model.embedding_cache.put_many(fresh)
+        found.update(fresh)
+
+    cls=torch.from_numpy(np.stack([found[k] for k in keys]))
+    return cls.to(device=input_ids.device, dtype=model.utterance_encoder.get_input_embeddings().weight.dtype)
+
+def attach_embedding_cache(model, cache):
+    '''
+    call after the checkpoint is loaded: the key prefix fingerprints the encoder weights
+    '''
+    model.embedding_cache=cache
+    model.embedding_cache_prefix=f"{fingerprint_state_dict(model.utterance_encoder.state_dict())}:{model.SEQUENCE_MAX_LEN}"
+    return model
+
+################################################################################
+# Context from per-line CLS vectors
+#
+# with train_baseline --context_lines N, batch['context'] holds the previous N lines one row each
+# (batch * N * line_len) instead of up to 512 tokens of concatenated lines: each distinct line is
+# encoded once per batch (and hits the embedding cache at inference), and a GRU composes them
+
+class ContextGRU(nn.Module):
+    def __init__(self, hidden_dim):
+        super().__init__()
+        self.gru=nn.GRU(hidden_dim, hidden_dim, batch_first=True)
+
+    def forward(self, line_cls, num_lines):
+        '''
+        line_cls: batch * max_lines * hidden, oldest line first; num_lines: batch
+        items without previous lines read the single padding row, as the concatenated context encodes an empty sequence
+        '''
+        packed=nn.utils.rnn.pack_padded_sequence(line_cls, num_lines.clamp(min=1).cpu(), batch_first=True, enforce_sorted=False)
+        _, h=self.gru(packed)
+        return h[-1]
+
+def context_encoder(hidden_dim, args):
+    if args.get('context_lines'):
+        return ContextGRU(hidden_dim)
+    return None
+
+def encode_context_lines(model, batch):
+    context=batch['context']
+    line_cls=encode_rows(model, context.reshape(-1, context.size(-1)))
+    return model.context_encoder(line_cls.reshape(context.size(0), context.size(1), -1), batch['context_num_lines'])
+
+################################################################################
+# Late interaction for the pointer heads
+#
+# with args['late_interaction']=N the pointer models align the parent and the utterance on
+# token states (the first N of each line, CLS included) instead of on CLS vectors: every token
+# takes its most similar token of the other line (padding masked), and the aligned tokens are
+# mean-pooled. The states come from the same encoder pass that gives the CLS vectors, each
+# distinct line once per batch; at inference they go through the embedding cache (float16)
+
+def encode_tokens(model, batch, key):
+    '''
+    batch_size * tokens * hidden states of batch[key] (tokens <= args['late_interaction']), and the token mask
+    '''
+    input_ids=batch[key]
+    max_tokens=model.args['late_interaction']
+    unique_ids, inverse=torch.unique(input_ids, dim=0, return_inverse=True)
+    if getattr(model, 'embedding_cache', None) is not None and not model.training:
+        states=cached_token_states(model, unique_ids, max_tokens)
+    elif getattr(model, 'layer_cache', None) is not None:
+        states=encode_with_frozen_bottom(model.utterance_encoder, unique_ids, (unique_ids > 0).long(), None,
+                                         model.frozen_layers, model.layer_cache, model.layer_cache_prefix)[:, :max_tokens]
+    else:
+        states=model.utterance_encoder(input_ids=unique_ids, attention_mask=(unique_ids > 0).long())['last_hidden_state'][:, :max_tokens]
+    mask=unique_ids[:, :max_tokens] > 0
+
+    if key == 'utterance_of_interest' and 'group_index' in batch:
+        inverse=inverse[batch['group_index']]
+    return states[inverse], mask[inverse]
+
+def cached_token_states(model, input_ids, max_tokens):
+    keys=[f"{model.embedding_cache_prefix}:tokens{max_tokens}:{hash_token_ids(row)}" for row in input_ids]
+    found=model.embedding_cache.get_many(keys)
+
+    missing=sorted(set(keys) - set(found.keys()))
+    if missing:
+        rows=[keys.index(k) for k in missing]
+        missing_ids=input_ids[rows]
+        with torch.no_grad():
+            states=model.utterance_encoder(input_ids=missing_ids, attention_mask=(missing_ids > 0).long())['last_hidden_state']
+        lengths=(missing_ids[:, :max_tokens] > 0).sum(1).tolist()
+        fresh={k: v[:n].half().float().cpu().numpy() for k, v, n in zip(missing, states, lengths)}
+        model.embedding_cache.put_many(fresh)
+        found.update(fresh)
+
+    states=np.zeros((input_ids.size(0), min(input_ids.size(1), max_tokens), model.BERT_HIDDEN_DIM), dtype=np.float32)
+    for i, k in enumerate(keys):
+        states[i, :len(found[k])]=found[k]
+    return torch.from_numpy(states).to(device=input_ids.device, dtype=model.utterance_encoder.get_input_embeddings().weight.dtype)
+
+def max_sim_align(x1, x2, mask1, mask2):
+    '''
+    x1: batch_size * len1 * hidden, x2: batch_size * len2 * hidden, masks True on tokens
+    returns the batch_size * hidden means of the best matching x2 token of every x1 token, and vice versa
+    '''
+    sim=torch.matmul(x1, x2.transpose(-1, -2))
+    best2=sim.masked_fill(~mask2.unsqueeze(1), -float('inf')).argmax(-1) # batch_size * len1
+    best1=sim.transpose(-1, -2).masked_fill(~mask1.unsqueeze(1), -float('inf')).argmax(-1) # batch_size * len2
+    x1_align=torch.gather(x2, 1, best2.unsqueeze(-1).expand(-1, -1, x2.size(-1)))
+    x2_align=torch.gather(x1, 1, best1.unsqueeze(-1).expand(-1, -1, x1.size(-1)))
+
+    mask1, mask2=mask1.unsqueeze(-1).to(x1.dtype), mask2.unsqueeze(-1).to(x2.dtype)
+    x1_align=(x1_align*mask1).sum(1) / mask1.sum(1).clamp(min=1)
+    x2_align=(x2_align*mask2).sum(1) / mask2.sum(1).clamp(min=1)
+    return x1_align, x2_align
+
+################################################################################
+# All-pairs scoring for the DialogueLineEncoder family
+#
+# fc is linear, so fc([cj, lj, li, li-lj, li*lj, e_d, t_d, f_d, k_d]) splits into
+#   W_c cj + (W_lj - W_sub) lj    -> once per candidate line
+#   (W_li + W_sub) li + b         -> once per utterance of interest
+#   W_mul (li*lj)                 -> per pair
+#   W_e e_d + W_t t_d + ...       -> per pair, looked up from projected embedding tables
+
+def bucket_distances(utterances_distance):
+    '''
+    torch version of get_distance_bucket (+ abs) in the train_*.py scripts
+    '''
+    d=utterances_distance.long()
+    d=torch.where(d<4, d, torch.where(d<7, torch.full_like(d, 4), torch.full_like(d, 5)))
+    return d.abs()
+
+def split_head(model):
+    '''
+    returns the column blocks of model.fc, in the order the forward concatenates them
+    '''
+    assert not hasattr(model, 'soft_attention_align'), 'all-pairs scoring does not cover the pointer heads'
+    names=['cj', 'lj', 'li', 'sub', 'mul', 'e_d', 't_d']
+    sizes=[model.BERT_HIDDEN_DIM]*5 + [model.distance_embeddings.embedding_dim, model.turn_embeddings.embedding_dim]
+    if hasattr(model, 'first_speaker_embeddings'):
+        names.append('f_d')
+        sizes.append(model.first_speaker_embeddings.embedding_dim)
+    names.append('k_d')
+    sizes.append(model.speaker_embeddings.embedding_dim)
+    return dict(zip(names, torch.split(model.fc.weight, sizes, dim=1)))
+
+def score_all_pairs(model, cj_cls, lj_cls, li_cls, utterances_distance, same_turn, same_speaker, first_spoke=None):
+    '''
+    cj_cls, lj_cls: num_candidates * hidden (context and line of each candidate)
+    li_cls: num_uoi * hidden
+    utterances_distance, same_turn, same_speaker: num_uoi * num_candidates (distance already bucketed)
+    first_spoke: num_uoi, only used by the variants that embed it
+    returns num_uoi * num_candidates logits, equal to forward() on every (uoi, candidate) pair
+    '''
+    blocks=split_head(model)
+    out_layer=model.fc2 if hasattr(model, 'fc2') else model.fc_reply
+
+    candidate_proj=cj_cls @ blocks['cj'].t() + lj_cls @ (blocks['lj']-blocks['sub']).t() # C * D
+    uoi_proj=li_cls @ (blocks['li']+blocks['sub']).t() + model.fc.bias # U * D
+
+    pre=uoi_proj.unsqueeze(1) + candidate_proj.unsqueeze(0)
+    pre=pre + (li_cls.unsqueeze(1)*lj_cls.unsqueeze(0)) @ blocks['mul'].t() # U * C * D
+
+    pre=pre + (model.distance_embeddings.weight @ blocks['e_d'].t())[utterances_distance]
+    pre=pre + (model.turn_embeddings.weight @ blocks['t_d'].t())[same_turn]
+    pre=pre + (model.speaker_embeddings.weight @ blocks['k_d'].t())[same_speaker]
+    if 'f_d' in blocks:
+        f_proj=(model.first_speaker_embeddings.weight @ blocks['f_d'].t())[first_spoke]
+        pre=pre + (f_proj.unsqueeze(1) if f_proj.dim()==2 else f_proj)
+
+    logits=out_layer(model.tanh(pre)).squeeze(-1)
+    return logits
+
+################################################################################
+# Factorized head: fc is full_dim x full_dim (~19M parameters, ~55M in the pointer
+# variants); with args["head_rank"]=r it becomes full_dim -> r -> full_dim
+
+class LowRankLinear(nn.Module):
+    def __init__(self, in_features, out_features, rank):
+        super().__init__()
+        self.down=nn.Linear(in_features, rank, bias=False)
+        self.up=nn.Linear(rank, out_features)
+
+    @property
+    def weight(self):
+        # dense equivalent, for split_head / score_all_pairs
+        return self.up.weight @ self.down.weight
+
+    @property
+    def bias(self):
+        return self.up.bias
+
+    def forward(self, x):
+        return self.up(self.down(x))
+
+def head_linear(in_features, out_features, args):
+    if args.get('head_rank'):
+        return LowRankLinear(in_features, out_features, args['head_rank'])
+    return nn.Linear(in_features, out_features)
+
+def factorize_head_state_dict(state_dict, rank, prefix='fc.'):
+    '''
+    converts a dense fc checkpoint to the LowRankLinear layout with a truncated SVD,
+    W ~ (U_r S_r^0.5) (S_r^0.5 V_r^T)
+    '''
+    state_dict=dict(state_dict)
+    weight=state_dict.pop(f"{prefix}weight").float()
+    U, S, Vh=torch.linalg.svd(weight, full_matrices=False)
+    root=S[:rank].sqrt()
+    state_dict[f"{prefix}down.weight"]=root.unsqueeze(1) * Vh[:rank]
+    state_dict[f"{prefix}up.weight"]=U[:, :rank] * root.unsqueeze(0)
+    state_dict[f"{prefix}up.bias"]=state_dict.pop(f"{prefix}bias")
+    return state_dict
+
+def head_rank_from_state_dict(state_dict, prefix='fc.'):
+    return state_dict[f"{prefix}down.weight"].shape[0] if f"{prefix}down.weight" in state_dict else None
+
+################################################################################
+# CPU inference: dynamic int8 quantization of every nn.Linear (encoder layers and heads;
+# in Bert_v7 also the MHA projections, the MyLSTM gates, pooler and classifier). Weights
+# are stored as int8, activations are quantized per batch. Forward only; split_head reads
+# fc.weight, so a quantized model cannot be the all-pairs / two-stage retriever
+
+def quantize_dynamic_int8(model):
+    '''
+    in place (the model may hold an open embedding cache), call after the checkpoint is loaded
+    '''
+    model.cpu().eval()
+    if getattr(model, 'embedding_cache', None) is not None:
+        model.embedding_cache_prefix=f"{model.embedding_cache_prefix}:int8"
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+
+#
+# bfloat16 autocast, what Accelerator(mixed_precision='bf16') does to the prepared model on CPU
+# (--bf16 of train_4DD, train_baseline, inference_4DD): matmuls run in bfloat16, the weights (and
+# the optimizer's master copy) stay float32 and so do the float outputs; bf16 keeps float32's
+# exponent range, so training needs no loss scaling
+
+def autocast_bf16(model):
+    '''
+    in place, for a model that is not going through accelerator.prepare (parity_4DD)
+    '''
+    if getattr(model, 'embedding_cache', None) is not None:
+        model.embedding_cache_prefix=f"{model.embedding_cache_prefix}:bf16"
+    forward=model.forward
+    def autocast_forward(*args, **kwargs):
+        with torch.autocast('cpu', dtype=torch.bfloat16):
+            outputs=forward(*args, **kwargs)
+        return {k: v.float() if torch.is_tensor(v) and v.is_floating_point() else v for k, v in outputs.items()}
+    model.forward=autocast_forward
+    return model
+
 ################################################################################
 
 class LogisticRegression(torch.nn.Module):
@@ -0,0 +1,258 @@
+########
+# Accuracy parity of the CPU inference variants of a Bert_v7 checkpoint against float32 on a
+# dev file: the dev metrics train_4DD logs (and their change), how often the variant picks the same
+# parent, the largest logit difference, and throughput (candidate pairs per second); with
+# --exit_threshold, that the choices which do not exit early keep their logits
+########
+import copy
+import time
+import logging
+import argparse
+import pathlib
+import numpy as np
+import torch
+from torch.utils.data import (DataLoader, SequentialSampler, TensorDataset)
+from transformers import BertConfig, BertTokenizer
+
+from models import quantize_dynamic_int8, autocast_bf16
+from eval import *
+from early_exit import attach_exit_heads
+from pruning import load_pruning_plan, prune_encoder
+from checkpoints import checkpoint_config, empty_model, load_checkpoint
+from train_4DD import (Bert_v7, PackedBert_v7, DCDProcessor, convert_examples_to_features,
+                       convert_examples_to_packed_features, prep_tensor_data)
+
+
+VARIANTS={
+    'int8': quantize_dynamic_int8,
+    'bf16': autocast_bf16,
+}
+
+def read_4DD_file(path, mode='dev', labeled=True):
+    '''
+    train_4DD's file reading for a single file, every line of it goes to mode
+    labeled=False keeps the D lines with an empty anno column too, as new threads
+    (DCDProcessor needs a parent; distill_4DD never uses their label)
+    -> lines, line dicts and filename ids in train_4DD's layout, and the gold clusters of the annotated lines
+    '''
+    lines={mode: {}}
+    scene_id2line_ids={mode: {}}
+    line_id2scene_id={mode: {}}
+    line_id2line_text={mode: {}}
+    line_id2speaker_n={mode: {}}
+    filename_to_filename_id={}
+    gold_lines=[]
+
+    with open(path, 'r') as f:
+        next(f)
+        for line in f:
+            line=line.replace('\n', '')
+            category, filename, title, file_line_no, turn_line_no, scene_id, line_type, line_no, new_line_no, speaker_label, scene_speaker_id, anno, line_text=line.split('\t')
+
+            if filename not in filename_to_filename_id:
+                filename_to_filename_id[filename]=len(filename_to_filename_id)
+            filename_id=filename_to_filename_id[filename]
+
+            if new_line_no.startswith('D') and (anno or not labeled):
+                lines[mode][(filename_id, new_line_no)]={
+                    'corpus': category,
+                    'title': title,
+                    'scene_id': scene_id,
+                    'scene_speaker_id': scene_speaker_id,
+                    'turn_line_no': turn_line_no,
+                    'reply_to_id': anno or 'T'
+                }
+                if anno:
+                    gold_lines.append([filename, new_line_no, anno])
+
+            line_id2line_text[mode].setdefault(filename_id, {})[new_line_no]=f"{line_text}"
+            scene_id2line_ids[mode].setdefault(filename_id, {}).setdefault(scene_id, [])
+            if new_line_no.startswith('A') or new_line_no.startswith('D'):
+                scene_id2line_ids[mode][filename_id][scene_id].append(new_line_no)
+            if new_line_no.startswith('D'):
+                line_id2scene_id[mode].setdefault(filename_id, {})[new_line_no]=scene_id
+                line_id2speaker_n[mode].setdefault(filename_id, {})[new_line_no]=scene_speaker_id
+
+    reversed_filename_to_filename_id={v: k for k, v in filename_to_filename_id.items()}
+    gold=eval_lines_dict_to_clusters(eval_lines_to_lines_dict(gold_lines))[0] if gold_lines else {}
+    return lines, line_id2line_text, line_id2scene_id, line_id2speaker_n, scene_id2line_ids, reversed_filename_to_filename_id, gold
+
+def predict(model, data_loader, reversed_filename_to_filename_id, mask_padding=False):
+    '''
+    train_4DD's dev pass -> predicted parent per utterance, dev lines, pairwise hits, seconds, logits
+    mask_padding: padding slots are never picked (the slots a cascade pruned, cascade_4DD)
+    '''
+    model.eval()
+    device=next(model.parameters()).device
+    parents, pred_lines, all_logits=[], [], []
+    correct, total=0, 0
+    last_filename=''
+    seconds=0.
+    for batch in data_loader:
+        d={
+            'input_ids': batch[0],
+            'attention_mask': batch[1],
+            'token_type_ids': batch[2],
+            'adj_matrix_speaker': batch[3],
+            'adj_matrix_scene': batch[4],
+            'turn_ids': batch[10]
+        }
+        d={key: val.to(device) for key, val in d.items()}
+        start=time.perf_counter()
+        with torch.no_grad():
+            logits=model(**d)['logits']
+        seconds += time.perf_counter() - start
+        if mask_padding:
+            logits=logits.masked_fill(batch[7].to(logits.device) == 99999, -10000.0)
+        all_logits.append(logits.float().cpu())
+
+        for filename_id, utterance_of_interest_id, candidate_ids, pred_id, true_parent_id in \
+                zip(batch[5].tolist(), batch[6].tolist(), batch[7].tolist(), logits.argmax(1).tolist(), batch[8].tolist()):
+            filename=reversed_filename_to_filename_id[filename_id]
+            if last_filename != filename:
+                last_filename=filename
+                threads_predicted=0
+
+            final_pred=f"D{candidate_ids[pred_id]}"
+            if (utterance_of_interest_id == candidate_ids[pred_id]) or (utterance_of_interest_id == 99999):
+                final_pred=f"T{threads_predicted}"
+                threads_predicted += 1
+
+            parents.append(candidate_ids[pred_id])
+            pred_lines.append((filename, f"D{utterance_of_interest_id}", final_pred))
+            correct += int(candidate_ids[pred_id] == true_parent_id)
+            total += 1
+    return parents, pred_lines, correct/total, seconds, torch.cat(all_logits)
+
+def early_exit_parity(model, data_loader, threshold):
+    '''
+    the choices that do not exit keep the logits of a full depth pass that leaves out the same choices (exited_choices)
+    -> max |logit diff| over the choices that did not exit, share of the choices that exited, share of the encoder layers run
+    '''
+    device=next(model.parameters()).device
+    num_layers=len(model.bert.encoder.layer)
+    logit_diff, num_exited, layers_run, num_choices=0., 0, 0, 0
+    for batch in data_loader:
+        d={
+            'input_ids': batch[0],
+            'attention_mask': batch[1],
+            'token_type_ids': batch[2],
+            'adj_matrix_speaker': batch[3],
+            'adj_matrix_scene': batch[4],
+            'turn_ids': batch[10]
+        }
+        d={key: val.to(device) for key, val in d.items()}
+        with torch.no_grad():
+            model.exit_threshold=threshold
+            outputs=model(**d)
+            exited=outputs['exit_layers'] < num_layers
+            model.exit_threshold=0.
+            full_depth=model(**d, exited_choices=exited)['logits']
+        if (~exited).any():
+            logit_diff=max(logit_diff, (outputs['logits'] - full_depth)[~exited].abs().max().item())
+        num_exited += int(exited.sum())
+        layers_run += int(outputs['exit_layers'].sum())
+        num_choices += exited.numel()
+    return logit_diff, num_exited/num_choices, layers_run/(num_choices*num_layers)
+
+def dev_scores(gold, pred_lines, pairwise_accuracy):
+    auto, _=eval_lines_dict_to_clusters(eval_lines_to_lines_dict(pred_lines))
+    contingency, row_sums, col_sums=clusters_to_contingency(gold, auto)
+    return {
+        'pairwise': pairwise_accuracy*100,
+        'ari': adjusted_rand_index(contingency, row_sums, col_sums),
+        '1-vi': variation_of_information(contingency, row_sums, col_sums),
+        'shen': shen_f1(contingency, row_sums, col_sums, gold, auto),
+        'oto': one_to_one(contingency, row_sums, col_sums),
+        'em-f': exact_match(gold, auto, skip_single=False)
+    }
+
+if __name__=='__main__':
+
+    arg_parser=argparse.ArgumentParser()
+    arg_parser.add_argument('--model_path', help='Bert_v7 checkpoint (train_4DD output)')
+    arg_parser.add_argument('--model_name', default='bert-base-cased', help='specify model_name')
+    arg_parser.add_argument('--dev_file', help='dev tsv, in the train_4DD format')
+    arg_parser.add_argument("--max_previous_utterance",
+                        default=50,
+                        type=int,
+                        help="as given to train_4DD")
+    arg_parser.add_argument("--batch_size",
+                        default=4,
+                        type=int,
+                        help="specific batch_size.")
+    arg_parser.add_argument('--variants', default='int8,bf16', help=f"comma separated, of {', '.join(VARIANTS)}")
+    arg_parser.add_argument("--packed",
+                        default=0,
+                        type=int,
+                        help="as given to train_4DD")
+    arg_parser.add_argument('--exit_layers', default='', help='as given to train_4DD')
+    arg_parser.add_argument("--exit_threshold",
+                        default=0.,
+                        type=float,
+                        help="with --exit_layers: check that the choices that do not exit at this threshold keep their logits")
+    arg_parser.add_argument("--threads",
+                        default=0,
+                        type=int,
+                        help="torch CPU threads, 0 keeps the default")
+
+    args=vars(arg_parser.parse_args())
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s', datefmt='%m-%d %H:%M')
+    logger=logging.getLogger(__name__)
+
+    if args['threads']:
+        torch.set_num_threads(args['threads'])
+
+    max_previous_utterance=args['max_previous_utterance']
+    model_class, convert=(PackedBert_v7, convert_examples_to_packed_features) if args['packed'] else (Bert_v7, convert_examples_to_features)
+
+    tokenizer=BertTokenizer.from_pretrained(args['model_name'], do_lower_case=False, do_basic_tokenize=False)
+    processor=DCDProcessor()
+    label_list=processor.get_labels(max_previous_utterance)
+
+    lines, line_id2line_text, line_id2scene_id, line_id2speaker_n, scene_id2line_ids, reversed_filename_to_filename_id, gold=\
+        read_4DD_file(pathlib.Path(args['dev_file']))
+    dev_examples, _=processor.get_examples(tokenizer, 'dev',
+                                           reversed_filename_to_filename_id,
+                                           line_id2line_text,
+                                           line_id2speaker_n,
+                                           scene_id2line_ids,
+                                           line_id2scene_id,
+                                           max_previous_utterance,
+                                           lines)
+    dev_data=TensorDataset(*prep_tensor_data(convert(dev_examples, label_list, tokenizer.model_max_length, max_previous_utterance, tokenizer)))
+    dev_data_loader=DataLoader(dev_data, sampler=SequentialSampler(dev_data), batch_size=args['batch_size'])
+    num_pairs=len(dev_data)*max_previous_utterance
+    logger.info(f"{args['dev_file']}: {len(dev_data)} utterances, {num_pairs} candidate pairs")
+
+    config=checkpoint_config(args['model_path'], BertConfig) or BertConfig.from_pretrained(args['model_name'], num_labels=len(label_list))
+    model=empty_model(lambda: model_class(config))
+    if args['exit_layers']:
+        attach_exit_heads(model, model.bert, [int(k) for k in args['exit_layers'].split(',')])
+    plan=load_pruning_plan(args['model_path'])
+    if plan is not None:
+        prune_encoder(model.bert, plan)
+    load_checkpoint(model, args['model_path'])
+    model.eval()
+
+    rows=[]
+    reference, pred_lines, pairwise_accuracy, seconds, reference_logits=predict(model, dev_data_loader, reversed_filename_to_filename_id)
+    rows.append(('float32', dev_scores(gold, pred_lines, pairwise_accuracy), 1., 0., seconds))
+
+    for name in args['variants'].split(','):
+        variant=VARIANTS[name](copy.deepcopy(model))
+        parents, pred_lines, pairwise_accuracy, seconds, logits=predict(variant, dev_data_loader, reversed_filename_to_filename_id)
+        agreement=float(np.mean(np.array(parents) == np.array(reference)))
+        rows.append((name, dev_scores(gold, pred_lines, pairwise_accuracy), agreement, (logits - reference_logits).abs().max().item(), seconds))
+        del variant
+
+    float_scores, float_seconds=rows[0][1], rows[0][4]
+    for name, scores, agreement, logit_diff, seconds in rows:
+        logger.info(f"{name:>8}: " + '; '.join(f"{k}: {v:.2f} ({v-float_scores[k]:+.2f})" for k, v in scores.items()) +
+                    f"; same parent as float32: {agreement*100:.2f}%; max |logit diff|: {logit_diff:.4f}; {num_pairs/seconds:.1f} pairs/s ({float_seconds/seconds:.2f}x)")
+
+    if args['exit_layers'] and args['exit_threshold'] > 0:
+        logit_diff, exited, layers=early_exit_parity(model, dev_data_loader, args['exit_threshold'])
+        logger.info(f"early exit at {args['exit_threshold']}: {exited*100:.2f}% of the choices exited, {layers*100:.2f}% of the encoder layers run; "
+                    f"max |logit diff| of the other choices against a full depth pass without the exited ones: {logit_diff:.6f}")
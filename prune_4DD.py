@@ -0,0 +1,207 @@
+########
+# Structured pruning of a trained Bert_v7 (pruning.py): attention heads and FFN neurons of
+# Bert_v7.bert are scored on the dev file, removed, and the pruned model is fine-tuned on the
+# train file for a short while to recover. Logs the dev metrics and throughput of the
+# original, pruned and recovered model; saves the recovered checkpoint with its
+# .pruning.json, which inference_4DD picks up
+########
+import os
+import logging
+import argparse
+import pathlib
+import datetime
+import datasets
+import transformers
+from tqdm import tqdm
+from torch import optim
+from torch.utils.data import (DataLoader, RandomSampler, SequentialSampler, TensorDataset)
+from transformers import BertConfig, BertTokenizer
+from accelerate import Accelerator, DistributedDataParallelKwargs
+from accelerate.logging import get_logger
+
+from pruning import accumulate_importance, select_pruning, prune_encoder, encoder_flops, save_pruning_plan
+from checkpoints import save_checkpoint, checkpoint_config, empty_model, load_checkpoint
+from train_4DD import Bert_v7, DCDProcessor, convert_examples_to_features, prep_tensor_data
+from parity_4DD import read_4DD_file, predict, dev_scores
+
+
+def main_log(msg):
+    global logger
+    return logger.info(msg, main_process_only=True)
+
+def batch_inputs(batch):
+    return {
+        'input_ids': batch[0],
+        'attention_mask': batch[1],
+        'token_type_ids': batch[2],
+        'adj_matrix_speaker': batch[3],
+        'adj_matrix_scene': batch[4],
+        'labels': batch[9]
+    }
+
+def dev_importance(model, data_loader, num_batches=0):
+    '''
+    eval mode (no dropout), gradients of the dev loss; num_batches=0 uses all of them
+    '''
+    model.eval()
+    device=next(model.parameters()).device
+    importance=None
+    for i, batch in enumerate(data_loader):
+        if num_batches and i == num_batches:
+            break
+        d={key: val.to(device) for key, val in batch_inputs(batch).items()}
+        model(**d)['loss'].backward()
+        importance=accumulate_importance(model.bert, importance)
+        model.zero_grad()
+    return importance
+
+if __name__=='__main__':
+
+    arg_parser=argparse.ArgumentParser()
+    arg_parser.add_argument('--model_path', help='Bert_v7 checkpoint (train_4DD output)')
+    arg_parser.add_argument('--model_name', default='bert-base-cased', help='specify model_name')
+    arg_parser.add_argument('--train_file', help='recovery fine-tune data')
+    arg_parser.add_argument('--dev_file', help='importance scores and the report')
+    arg_parser.add_argument('--model_output', help='folder for the pruned checkpoint')
+    arg_parser.add_argument("--max_previous_utterance",
+                        default=50,
+                        type=int,
+                        help="as given to train_4DD")
+    arg_parser.add_argument("--batch_size",
+                        default=4,
+                        type=int,
+                        help="specific batch_size.")
+    arg_parser.add_argument("--prune_heads",
+                        default=0.3,
+                        type=float,
+                        help="fraction of the attention heads to remove")
+    arg_parser.add_argument("--prune_ffn",
+                        default=0.3,
+                        type=float,
+                        help="fraction of the FFN neurons of every layer to remove")
+    arg_parser.add_argument("--importance_batches",
+                        default=0,
+                        type=int,
+                        help="dev batches to score on, 0 for all")
+    arg_parser.add_argument("--recovery_epochs",
+                        default=1,
+                        type=int,
+                        help="fine-tune epochs after pruning")
+    arg_parser.add_argument("--learning_rate",
+                        default=5e-6,
+                        type=float,
+                        help="recovery learning rate")
+    arg_parser.add_argument("--use_tqdm",
+                        default=False,
+                        type=bool,
+                        help="Use tqdm?")
+
+    args=vars(arg_parser.parse_args())
+
+    OUTPUT_PATH=pathlib.Path(args['model_output'])
+    OUTPUT_PATH.mkdir(exist_ok=True)
+    use_tqdm=args['use_tqdm']
+    BATCH_SIZE=args['batch_size']
+    max_previous_utterance=args['max_previous_utterance']
+
+    ddp_kwargs=DistributedDataParallelKwargs(find_unused_parameters=False, static_graph=True)
+    accelerator=Accelerator(kwargs_handlers=[ddp_kwargs])
+
+    timestamp=datetime.datetime.now().strftime("%m%d%Y-%H%M%S")
+    logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s %(message)s',
+                    datefmt='%m-%d %H:%M',
+                    filename=os.path.join(str(OUTPUT_PATH), f"prune_{timestamp}.log"),
+                    filemode='w')
+    console=logging.StreamHandler()
+    console.setLevel(logging.INFO)
+    formatter=logging.Formatter('%(message)s')
+    console.setFormatter(formatter)
+    logging.getLogger('').addHandler(console)
+
+    datasets.utils.logging.set_verbosity_error()
+    transformers.utils.logging.set_verbosity_error()
+
+    logger=get_logger(__name__)
+
+    transformers.set_seed(2022)
+    accelerator.wait_for_everyone()
+
+    tokenizer=BertTokenizer.from_pretrained(args['model_name'], do_lower_case=False, do_basic_tokenize=False)
+    processor=DCDProcessor()
+    label_list=processor.get_labels(max_previous_utterance)
+    SEQUENCE_MAX_LEN=tokenizer.model_max_length
+
+    data={}
+    for mode in ['train', 'dev']:
+        lines, line_id2line_text, line_id2scene_id, line_id2speaker_n, scene_id2line_ids, reversed_filename_to_filename_id, gold=\
+            read_4DD_file(pathlib.Path(args[f"{mode}_file"]), mode)
+        examples, _=processor.get_examples(tokenizer, mode,
+                                           reversed_filename_to_filename_id,
+                                           line_id2line_text,
+                                           line_id2speaker_n,
+                                           scene_id2line_ids,
+                                           line_id2scene_id,
+                                           max_previous_utterance,
+                                           lines)
+        data[mode]=TensorDataset(*prep_tensor_data(convert_examples_to_features(examples, label_list, SEQUENCE_MAX_LEN, max_previous_utterance, tokenizer)))
+    dev_data_loader=DataLoader(data['dev'], sampler=SequentialSampler(data['dev']), batch_size=BATCH_SIZE)
+    data_loader=DataLoader(data['train'], sampler=RandomSampler(data['train']), batch_size=BATCH_SIZE)
+    num_pairs=len(data['dev'])*max_previous_utterance
+
+    config=checkpoint_config(args['model_path'], BertConfig) or BertConfig.from_pretrained(args['model_name'], num_labels=len(label_list))
+    model=load_checkpoint(empty_model(lambda: Bert_v7(config)), args['model_path'])
+    model.to(accelerator.device)
+
+    report=[]
+    def evaluate(stage):
+        _, pred_lines, pairwise_accuracy, seconds, _=predict(model, dev_data_loader, reversed_filename_to_filename_id)
+        report.append((stage, dev_scores(gold, pred_lines, pairwise_accuracy), seconds, encoder_flops(model.bert)))
+        main_log(f"{stage}: " + '; '.join(f"{k}: {v:.2f}" for k, v in report[-1][1].items()) + f"; {num_pairs/seconds:.1f} pairs/s")
+
+    evaluate('original')
+
+    main_log('Scoring heads and FFN neurons on dev ...')
+    importance=dev_importance(model, dev_data_loader, args['importance_batches'])
+    plan=select_pruning(importance, args['prune_heads'], args['prune_ffn'])
+    prune_encoder(model.bert, plan)
+    main_log(f"Heads kept per layer: {[len(kept) for kept in plan['heads'].values()]}")
+    main_log(f"FFN neurons kept per layer: {[len(kept) for kept in plan['ffn'].values()]}")
+    evaluate('pruned')
+
+    ### OPTIMIZER
+    param_optimizer=list(model.named_parameters())
+    no_decay=['bias', 'LayerNorm.bias', 'LayerNorm.weight']
+    optimizer_grouped_parameters = [
+        {'params': [p for n, p in param_optimizer if not any(nd in n for nd in no_decay)], 'weight_decay': 0.01},
+        {'params': [p for n, p in param_optimizer if any(nd in n for nd in no_decay)], 'weight_decay': 0.0}
+    ]
+    optimizer=optim.AdamW(optimizer_grouped_parameters, lr=args["learning_rate"])
+    model, optimizer, data_loader=accelerator.prepare(model, optimizer, data_loader)
+
+    main_log('Recovery fine-tune ...')
+    for epoch in range(args['recovery_epochs']):
+        model.train()
+        train_loss=0
+        for i, batch in enumerate(tqdm(data_loader) if use_tqdm else data_loader):
+            loss=model(**batch_inputs(batch))['loss']
+            train_loss += loss.detach().item()
+            accelerator.backward(loss)
+            optimizer.step()
+            optimizer.zero_grad()
+        main_log(f"Epoch {epoch+1}: training loss {train_loss/len(data_loader):.4f}")
+
+    accelerator.wait_for_everyone()
+    model=accelerator.unwrap_model(model)
+    if accelerator.is_main_process:
+        evaluate('recovered')
+
+        model_path=OUTPUT_PATH.joinpath(f"pytorch_model-{timestamp}-pruned.safetensors")
+        save_checkpoint(model, model_path, model.config)
+        save_pruning_plan(plan, model_path)
+        main_log(f"Saved {model_path}")
+
+        original_seconds, original_flops=report[0][2], report[0][3]
+        for stage, scores, seconds, flops in report:
+            main_log(f"{stage:>10}: " + '; '.join(f"{k}: {v:.2f}" for k, v in scores.items()) +
+                     f"; encoder FLOPs {flops/original_flops*100:.0f}%; speedup {original_seconds/seconds:.2f}x")
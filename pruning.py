@@ -0,0 +1,119 @@
+import os
+import json
+import torch
+import torch.nn as nn
+
+
+################################################################################
+# Structured pruning of a fine-tuned BertModel (Bert_v7.bert, utterance_encoder):
+# attention heads and FFN neurons are scored on dev data and cut out of the weight
+# matrices, so the pruned encoder does less work (a head mask would not).
+#
+# Importance, first order: for the columns of attention.output.dense that head h
+# feeds, sum(W * dL/dW) equals dL/dg for a gate g on the head's output (summed over
+# the batch), and the same holds for an FFN neuron and its column of output.dense;
+# |dL/dg| is summed over the dev batches. Head scores are normalized per layer.
+#
+# The kept heads / neurons of each layer are the plan, stored next to the checkpoint
+# in <checkpoint>.pruning.json; prune_encoder(fresh_encoder, plan) gives the pruned
+# shapes back before the checkpoint is loaded
+
+def attention_heads(layer):
+    return layer.attention.self.num_attention_heads, layer.attention.self.attention_head_size
+
+def accumulate_importance(encoder, importance=None):
+    '''
+    call after loss.backward(); importance: the previous return value, or None to start
+    '''
+    if importance is None:
+        importance={'heads': [0.]*len(encoder.encoder.layer), 'ffn': [0.]*len(encoder.encoder.layer)}
+    for i, layer in enumerate(encoder.encoder.layer):
+        num_heads, head_size=attention_heads(layer)
+        w=layer.attention.output.dense.weight
+        g=(w * w.grad).sum(0).view(num_heads, head_size).sum(1)
+        importance['heads'][i]=importance['heads'][i] + g.abs().detach().float().cpu()
+        w=layer.output.dense.weight
+        importance['ffn'][i]=importance['ffn'][i] + (w * w.grad).sum(0).abs().detach().float().cpu()
+    return importance
+
+def select_pruning(importance, head_fraction, ffn_fraction):
+    '''
+    drops the head_fraction least important heads over all layers (at least one head stays in every
+    layer) and the ffn_fraction least important FFN neurons of every layer
+    -> plan: {'heads': {layer: kept head indices}, 'ffn': {layer: kept neuron indices}}
+    '''
+    heads=[scores / scores.norm().clamp(min=1e-12) for scores in importance['heads']]
+    ranked=sorted(((float(s), i, h) for i, scores in enumerate(heads) for h, s in enumerate(scores)))
+    num_drop=int(head_fraction * len(ranked))
+    kept_heads={i: set(range(len(scores))) for i, scores in enumerate(heads)}
+    for _, i, h in ranked:
+        if num_drop == 0:
+            break
+        if len(kept_heads[i]) > 1:
+            kept_heads[i].discard(h)
+            num_drop -= 1
+
+    kept_ffn={}
+    for i, scores in enumerate(importance['ffn']):
+        num_keep=max(len(scores) - int(ffn_fraction * len(scores)), 1)
+        kept_ffn[i]=sorted(scores.topk(num_keep).indices.tolist())
+
+    return {'heads': {i: sorted(kept) for i, kept in kept_heads.items()}, 'ffn': kept_ffn}
+
+def prune_linear(linear, index, dim):
+    '''
+    new nn.Linear with the rows (dim=0, outputs) or columns (dim=1, inputs) of index
+    '''
+    index=torch.as_tensor(index, dtype=torch.long, device=linear.weight.device)
+    new=nn.Linear(linear.in_features if dim == 0 else len(index),
+                  len(index) if dim == 0 else linear.out_features,
+                  bias=linear.bias is not None).to(device=linear.weight.device, dtype=linear.weight.dtype)
+    with torch.no_grad():
+        new.weight.copy_(linear.weight.index_select(dim, index))
+        if linear.bias is not None:
+            new.bias.copy_(linear.bias[index] if dim == 0 else linear.bias)
+    new.weight.requires_grad=linear.weight.requires_grad
+    return new
+
+def prune_encoder(encoder, plan):
+    for i, layer in enumerate(encoder.encoder.layer):
+        kept=plan['heads'].get(i)
+        num_heads, head_size=attention_heads(layer)
+        if kept is not None and len(kept) < num_heads:
+            index=[h*head_size + k for h in kept for k in range(head_size)]
+            attention=layer.attention.self
+            attention.query=prune_linear(attention.query, index, 0)
+            attention.key=prune_linear(attention.key, index, 0)
+            attention.value=prune_linear(attention.value, index, 0)
+            attention.num_attention_heads=len(kept)
+            attention.all_head_size=len(index)
+            layer.attention.output.dense=prune_linear(layer.attention.output.dense, index, 1)
+
+        kept=plan['ffn'].get(i)
+        if kept is not None and len(kept) < layer.intermediate.dense.out_features:
+            layer.intermediate.dense=prune_linear(layer.intermediate.dense, kept, 0)
+            layer.output.dense=prune_linear(layer.output.dense, kept, 1)
+    return encoder
+
+def encoder_flops(encoder):
+    '''
+    multiply-adds per token of the encoder layers' linear maps (attention scores excluded)
+    '''
+    return sum(m.in_features * m.out_features for m in encoder.encoder.layer.modules() if isinstance(m, nn.Linear))
+
+def pruning_plan_path(checkpoint_path):
+    return f"{checkpoint_path}.pruning.json"
+
+def save_pruning_plan(plan, checkpoint_path):
+    with open(pruning_plan_path(checkpoint_path), 'w') as f:
+        json.dump(plan, f)
+
+def load_pruning_plan(checkpoint_path):
+    '''
+    None when the checkpoint was not pruned
+    '''
+    if not os.path.exists(pruning_plan_path(checkpoint_path)):
+        return None
+    with open(pruning_plan_path(checkpoint_path)) as f:
+        plan=json.load(f)
+    return {key: {int(i): kept for i, kept in layers.items()} for key, layers in plan.items()}
@@ -0,0 +1,134 @@
+import os
+import time
+import torch
+from torch._dynamo.utils import counters
+
+
+################################################################################
+# torch.compile for the encoders (Bert_v7.bert, utterance_encoder) with a bounded
+# number of graphs. The models.py batches are padded to their longest row (merge)
+# and encode_rows passes a different number of distinct rows every time, so every
+# batch would be a new shape and a recompile. The encoder call pads the rows and
+# the sequence length up to a few bucket sizes, runs the graph compiled for that
+# bucket and cuts the output back: padded positions are masked and padded rows are
+# separate sequences, so the real rows get the same states.
+#
+# The compiled forward is bound to the encoder instance, its parameters and state
+# dict keys are unchanged (checkpoints load and save as usual). Inductor keeps its
+# compiled artifacts in cache_dir, later runs with the same buckets start warm.
+#
+# Every (rows, length, train / eval, grad) bucket is its own graph of the same
+# forward code, so dynamo's per-code recompile limit (8 by default) is raised to
+# the number of buckets; past the limit dynamo would silently run eager, which
+# compile_report tells apart from a compiled bucket.
+
+DEFAULT_LENGTH_BUCKETS=[32, 64, 128, 256, 512]
+DEFAULT_ROW_BUCKETS=[2**k for k in range(10)] # 1 .. 512
+
+def bucket(n, sizes):
+    '''
+    smallest size >= n; past the largest, the next multiple of it
+    '''
+    for size in sizes:
+        if n <= size:
+            return size
+    return -(-n // sizes[-1]) * sizes[-1]
+
+def pad_to(x, rows, length, value=0):
+    if x is None:
+        return None
+    return torch.nn.functional.pad(x, (0, length - x.size(1), 0, rows - x.size(0)), value=value)
+
+def cut(output, rows, length):
+    '''
+    the real rows (and tokens) of every tensor of a ModelOutput / tuple
+    '''
+    if torch.is_tensor(output):
+        if output.dim() == 4: # attentions
+            return output[:rows, :, :length, :length]
+        return output[:rows, :length] if output.dim() > 2 else output[:rows]
+    if isinstance(output, tuple):
+        return tuple(cut(o, rows, length) for o in output)
+    for key in output.keys():
+        output[key]=cut(output[key], rows, length)
+    return output
+
+def sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+def attach_compiled_encoder(encoder, length_buckets=DEFAULT_LENGTH_BUCKETS, row_buckets=DEFAULT_ROW_BUCKETS, cache_dir=None):
+    '''
+    encoder: a HF encoder (BertModel & co.) called with input_ids / attention_mask / token_type_ids
+    Bert_v7 batches are already padded to SEQUENCE_MAX_LEN with batch_size * num_labels rows, a single
+    bucket of each takes the short last batch
+    the first call of a bucket also runs it eagerly once, compile_report compares the two
+    '''
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        os.environ['TORCHINDUCTOR_CACHE_DIR']=os.path.abspath(cache_dir)
+        torch._inductor.config.fx_graph_cache=True
+
+    num_buckets=len(row_buckets)*len(length_buckets)*4 # x train / eval x grad / no_grad
+    torch._dynamo.config.cache_size_limit=max(torch._dynamo.config.cache_size_limit, num_buckets)
+    eager=type(encoder).forward.__get__(encoder)
+    compiled=torch.compile(eager, dynamic=False)
+    stats={} # (rows, length, mode, grad) -> [eager seconds, first call seconds, steady seconds, steady calls, compiled]
+
+    def forward(input_ids=None, attention_mask=None, token_type_ids=None, **kwargs):
+        num_rows, length=input_ids.shape
+        rows, padded_length=bucket(num_rows, row_buckets), bucket(length, length_buckets)
+        if attention_mask is None:
+            attention_mask=torch.ones_like(input_ids)
+        attention_mask=pad_to(attention_mask, rows, padded_length)
+        attention_mask[num_rows:, 0]=1 # padded rows attend to one token, no all-masked softmax
+        inputs={'input_ids': pad_to(input_ids, rows, padded_length),
+                'attention_mask': attention_mask,
+                'token_type_ids': pad_to(token_type_ids, rows, padded_length)}
+
+        key=(rows, padded_length, 'train' if encoder.training else 'eval', torch.is_grad_enabled()) # mode and grad mode are graph keys too
+        if key not in stats:
+            # timing only: no autograd graph, and the dropout RNG is left as it was
+            with torch.random.fork_rng(devices=[input_ids.device] if input_ids.device.type == 'cuda' else []), torch.no_grad():
+                start=time.perf_counter()
+                eager(**inputs, **kwargs)
+                sync(input_ids.device)
+            stats[key]=[time.perf_counter() - start, 0., 0., 0, False]
+            graphs=counters['stats']['unique_graphs']
+        start=time.perf_counter()
+        output=compiled(**inputs, **kwargs)
+        sync(input_ids.device)
+        seconds=time.perf_counter() - start
+        if stats[key][1] == 0.:
+            stats[key][1]=seconds
+            stats[key][4]=counters['stats']['unique_graphs'] > graphs # False: dynamo fell back to eager
+        else:
+            stats[key][2] += seconds
+            stats[key][3] += 1
+        return cut(output, num_rows, length)
+
+    encoder.forward=forward
+    encoder.compile_stats=stats
+    return encoder
+
+def compile_report(encoder):
+    '''
+    one line per bucket: first call (compile, or cache load), eager (no_grad) and steady-state compiled seconds
+    '''
+    lines=[]
+    compile_seconds, saved=0., 0.
+    for (rows, length, mode, grad), (eager_seconds, first, steady, calls, compiled) in sorted(encoder.compile_stats.items()):
+        name=f"{rows}x{length} {mode}{'' if grad else ' no_grad'}"
+        if not compiled:
+            lines.append(f"{name}: not compiled, dynamo ran it eagerly (recompile limit or graph break)")
+            continue
+        compile_seconds += first
+        if calls:
+            steady /= calls
+            saved += (eager_seconds - steady) * calls
+            lines.append(f"{name}: first call {first:.2f}s, eager {eager_seconds*1000:.1f}ms, compiled {steady*1000:.1f}ms ({eager_seconds/steady:.2f}x) over {calls} calls")
+        else:
+            lines.append(f"{name}: first call {first:.2f}s, eager {eager_seconds*1000:.1f}ms, no further calls")
+    num_compiled=sum(stats[4] for stats in encoder.compile_stats.values())
+    lines.append(f"{num_compiled} graphs, {len(encoder.compile_stats) - num_compiled} buckets run eagerly, {compile_seconds:.1f}s in first calls, {saved:.2f}s saved by the steady calls")
+    return lines
@@ -4,6 +4,7 @@
 from __future__ import absolute_import, division, print_function
 import os.path
 import ast
+import contextlib
 import copy
 import ortools
 import ortools.graph.pywrapgraph as pywrapgraph
@@ -11,6 +12,12 @@ from sklearn import metrics
 from tqdm import tqdm
 from models import *
 from eval import *
+from frozen_layers import attach_layer_cache, encode_with_frozen_bottom
+from early_exit import attach_exit_heads, encode_with_early_exit, exit_loss
+from shape_buckets import attach_compiled_encoder, compile_report
+from checkpoints import save_checkpoint
+from lora import LORA_TARGETS, LORA_MAX_TRAINABLE, attach_lora, lora_settings, lora_report
+from memory_plan import plan_training, plan_report
 import re
 import os
 import sys
@@ -91,15 +98,7 @@ class MHA(nn.Module):
 
         context_layer = torch.matmul(attention_probs, value_layer)
         context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
-        w = (
-            self.dense.weight.t()
-            .view(self.num_attention_heads, self.attention_head_size, self.hidden_size)
-            .to(context_layer.dtype)
-        )
-        b = self.dense.bias.to(context_layer.dtype)
-
-        
-        projected_context_layer = torch.einsum("bfnd,ndh->bfh", context_layer, w) + b
+        projected_context_layer = self.dense(context_layer.view(context_layer.size(0), context_layer.size(1), self.all_head_size))
         projected_context_layer_dropout = self.dropout(projected_context_layer)
         layernormed_context_layer = self.LayerNorm(input_ids_a + projected_context_layer_dropout)
         return (layernormed_context_layer, attention_probs) if output_attentions else (layernormed_context_layer,)
@@ -147,10 +146,12 @@ class MyLSTM(nn.Module):
 
         return ht, Ct_x, Ct_m 
 
-    def forward(self, x, m, init_stat=None):
+    def forward(self, x, m, init_stat=None, skip=None):
+        '''
+        skip: (batch_size, seq_len) bool, those steps carry the state over as if they were not in the sequence
+        '''
         batch_sz, seq_sz, _ = x.size()
         hidden_seq = []
-        cell_seq = []
         if init_stat is None:
             ht = torch.zeros((batch_sz, self.hidden_sz)).to(x.device)
             Ct_x = torch.zeros((batch_sz, self.hidden_sz)).to(x.device)
@@ -160,15 +161,13 @@ class MyLSTM(nn.Module):
         for t in range(seq_sz):  # iterate over the time steps
             xt = x[:, t, :]
             mt = m[:, t, :]
-            ht, Ct_x, Ct_m= self.node_forward(xt, ht, Ct_x, mt, Ct_m)
-            hidden_seq.append(ht)
-            cell_seq.append(Ct_x)
-            if t == 0:
-                mht = ht
-                mct = Ct_x
+            if skip is None:
+                ht, Ct_x, Ct_m= self.node_forward(xt, ht, Ct_x, mt, Ct_m)
             else:
-                mht = torch.max(torch.stack(hidden_seq), dim=0)[0]
-                mct = torch.max(torch.stack(cell_seq), dim=0)[0]
+                keep = ~skip[:, t, None]
+                ht_t, Ct_x_t, Ct_m_t = self.node_forward(xt, ht, Ct_x, mt, Ct_m)
+                ht, Ct_x, Ct_m = torch.where(keep, ht_t, ht), torch.where(keep, Ct_x_t, Ct_x), torch.where(keep, Ct_m_t, Ct_m)
+            hidden_seq.append(ht)
         hidden_seq = torch.stack(hidden_seq).permute(1, 0, 2) ##batch_size x max_len x hidden
         return hidden_seq
 
@@ -183,8 +182,7 @@ class Bert_v7(BertPreTrainedModel):
         self.gcn_layer = gcn_layer
         self.mylstm_hidden_size = mylstm_hidden_size
 
-        self.bert = BertModel(config)
-        self.BiLSTM = nn.LSTM(config.hidden_size, self.lstm_hidden_size, self.lstm_num_layers, bias=True, batch_first=True, bidirectional=True)
+        self.bert = BertModel(config, add_pooling_layer=False) # only sequence_output is used
         self.graph_dim = config.hidden_size
         self.lstm_f = MyLSTM(config.hidden_size, self.mylstm_hidden_size, self.graph_dim) 
         self.lstm_b = MyLSTM(config.hidden_size, self.mylstm_hidden_size, self.graph_dim)
@@ -197,12 +195,61 @@ class Bert_v7(BertPreTrainedModel):
         # self.classifier2 = nn.Linear(config.hidden_size, 2)
         self.SASelfMHA = nn.ModuleList([MHA(config) for _ in range(num_decoupling)])
         self.linear = nn.Linear(2*config.hidden_size, config.hidden_size)
-        self.W = nn.ModuleList()
-        for layer in range(self.gcn_layer):
-            self.W.append(nn.Linear(self.graph_dim, self.graph_dim))
 
         self.init_weights()
 
+    def choice_representations(self, num_labels, input_ids, token_type_ids, attention_mask, position_ids, turn_ids, head_mask, inputs_embeds, output_attentions, output_hidden_states):
+        '''
+        (batch_size, num_choice, hidden_size) CLS of every "[CLS] candidate [SEP] utterance [SEP]" choice, and the encoder outputs
+        '''
+        input_ids = input_ids.view(-1, input_ids.size(-1)) if input_ids is not None else None 
+        attention_mask = attention_mask.view(-1, attention_mask.size(-1)) if attention_mask is not None else None
+        orig_attention_mask = attention_mask
+        token_type_ids = token_type_ids.view(-1, token_type_ids.size(-1)) if token_type_ids is not None else None        
+        position_ids = position_ids.view(-1, position_ids.size(-1)) if position_ids is not None else None
+        inputs_embeds = (
+            inputs_embeds.view(-1, inputs_embeds.size(-2), inputs_embeds.size(-1))
+            if inputs_embeds is not None
+            else None
+        )
+        if getattr(self, 'layer_cache', None) is not None: # bottom layers frozen, see frozen_layers.py
+            outputs = (encode_with_frozen_bottom(self.bert, input_ids, orig_attention_mask, token_type_ids,
+                                                 self.frozen_layers, self.layer_cache, self.layer_cache_prefix),)
+        elif getattr(self, 'unique_choices', False): # the slots a cascade (cascade.py) prunes are the same row, encode each row once
+            rows, inverse = torch.unique(torch.cat((input_ids, orig_attention_mask, token_type_ids), 1), dim=0, return_inverse=True)
+            seq_len = input_ids.size(1)
+            outputs = (self.bert(rows[:, :seq_len], attention_mask=rows[:, seq_len:2*seq_len], token_type_ids=rows[:, 2*seq_len:])[0][inverse],)
+        else:
+            outputs = self.bert(
+                input_ids,
+                attention_mask=orig_attention_mask,
+                token_type_ids=token_type_ids,
+                position_ids=position_ids,
+                head_mask=head_mask,
+                inputs_embeds=inputs_embeds,
+                output_attentions=output_attentions,
+                output_hidden_states=output_hidden_states,
+            )
+        sequence_output = outputs[0] # (batch_size * num_choice, seq_len, hidden_size)
+        cls_rep = sequence_output[:,0,:] #(batch_size*num_chioce, hidden_size)
+        hidden_size = sequence_output.size(-1)
+        cls_rep = cls_rep.view(-1, num_labels, hidden_size) #(batch_size, num_chioce, hidden_size)
+        return cls_rep, outputs
+
+    def early_exit_representations(self, num_labels, input_ids, token_type_ids, attention_mask):
+        '''
+        eval mode with exit heads attached (early_exit.py): a choice stops at the first exit layer whose
+        head is confident the candidate is not the parent; the first choice (the utterance itself) runs every layer
+        '''
+        first_choice = torch.arange(input_ids.size(0)*num_labels, device=input_ids.device) % num_labels == 0
+        cls, exit_logits, exited, layers_run = encode_with_early_exit(
+            self.bert, self.exit_heads,
+            input_ids.view(-1, input_ids.size(-1)),
+            attention_mask.view(-1, attention_mask.size(-1)),
+            token_type_ids.view(-1, token_type_ids.size(-1)) if token_type_ids is not None else None,
+            self.exit_threshold, never_exit=first_choice)
+        return cls.view(-1, num_labels, cls.size(-1)), exit_logits.view(-1, num_labels), exited.view(-1, num_labels), layers_run.view(-1, num_labels)
+
     def forward(
         self,
         input_ids=None,
@@ -221,36 +268,29 @@ class Bert_v7(BertPreTrainedModel):
         filename_ids=None,
         utterance_of_interest_ids=None,
         candidate_ids_nested=None,
-        true_parent_ids=None
+        true_parent_ids=None,
+        exited_choices=None
     ):
+        '''
+        exited_choices: (batch_size, num_choice) bool, choices left out of the choice graph and ranked last;
+        the early exit sets it, given explicitly it takes full depth CLS vectors (parity_4DD)
+        '''
         num_labels = input_ids.shape[1] if input_ids is not None else inputs_embeds.shape[1]
-
-        input_ids = input_ids.view(-1, input_ids.size(-1)) if input_ids is not None else None 
-        attention_mask = attention_mask.view(-1, attention_mask.size(-1)) if attention_mask is not None else None
-        orig_attention_mask = attention_mask
-        token_type_ids = token_type_ids.view(-1, token_type_ids.size(-1)) if token_type_ids is not None else None        
-        position_ids = position_ids.view(-1, position_ids.size(-1)) if position_ids is not None else None
-        inputs_embeds = (
-            inputs_embeds.view(-1, inputs_embeds.size(-2), inputs_embeds.size(-1))
-            if inputs_embeds is not None
-            else None
-        )
-        outputs = self.bert(
-            input_ids,
-            attention_mask=orig_attention_mask,
-            token_type_ids=token_type_ids,
-            position_ids=position_ids,
-            head_mask=head_mask,
-            inputs_embeds=inputs_embeds,
-            output_attentions=output_attentions,
-            output_hidden_states=output_hidden_states,
-        )
-        sequence_output = outputs[0] # (batch_size * num_choice, seq_len, hidden_size)
-        cls_rep = sequence_output[:,0,:] #(batch_size*num_chioce, hidden_size)
-        hidden_size = sequence_output.size(-1)
-        cls_rep = cls_rep.view(-1, num_labels, hidden_size) #(batch_size, num_chioce, hidden_size)
+        exit_heads = getattr(self, 'exit_heads', None)
+        if exit_heads is not None and not self.training and self.exit_threshold > 0:
+            cls_rep, _, exited, layers_run = self.early_exit_representations(num_labels, input_ids, token_type_ids, attention_mask)
+            outputs, heads_loss = (cls_rep,), None
+        else:
+            exited, layers_run = exited_choices, None
+            train_exits = exit_heads is not None and labels is not None
+            cls_rep, outputs = self.choice_representations(num_labels, input_ids, token_type_ids, attention_mask, position_ids, turn_ids,
+                                                           head_mask, inputs_embeds, output_attentions, output_hidden_states or train_exits)
+            heads_loss = exit_loss(exit_heads(outputs.hidden_states), labels, num_labels) if train_exits else None
         adj_matrix_speaker = adj_matrix_speaker.unsqueeze(1)
         sa_self_mask = (1.0 - adj_matrix_speaker) * -10000.0
+        if exited is not None: # no choice attends to an exited one
+            exited_keys = exited[:, None, None, :]
+            sa_self_mask = sa_self_mask.masked_fill(exited_keys, torch.finfo(sa_self_mask.dtype).min)
         sa_self_ = self.SASelfMHA[0](cls_rep, cls_rep, attention_mask = sa_self_mask)[0]
         for t in range(1, self.num_decoupling):
             sa_self_ = self.SASelfMHA[t](sa_self_, sa_self_, attention_mask = sa_self_mask)[0]
@@ -258,31 +298,26 @@ class Bert_v7(BertPreTrainedModel):
 
         adj_matrix_scene = adj_matrix_scene.unsqueeze(1)
         sa_self_mask = (1.0 - adj_matrix_scene) * -10000.0
+        if exited is not None:
+            sa_self_mask = sa_self_mask.masked_fill(exited_keys, torch.finfo(sa_self_mask.dtype).min)
         for t in range(1, self.num_decoupling):
             sa_self_ = self.SASelfMHA[t](sa_self_, sa_self_, attention_mask = sa_self_mask)[0]
         with_sa_self = self.linear(torch.cat((cls_rep,sa_self_),2))
         batch_size, sent_len, input_dim = cls_rep.size()#(batch_size, num_chioce, 2*lstm_hidden_size)
         graph_input = with_sa_self[:, :, :self.graph_dim]#(batch_size, num_chioce, 2*lstm_hidden_size)
         # forward LSTM
-        lstm_out_f = self.lstm_f(cls_rep, graph_input)#(batch_size, num_chioce, mylstm_hidden_size)
+        lstm_out_f = self.lstm_f(cls_rep, graph_input, skip=exited)#(batch_size, num_chioce, mylstm_hidden_size)
         # backward LSTM
         cls_rep_b = torch.flip(cls_rep, [1])
         graph_input_b = torch.flip(graph_input, [1])
-        lstm_out_b = self.lstm_b(cls_rep_b, graph_input_b)#(batch_size, num_chioce, mylstm_hidden_size)
+        lstm_out_b = self.lstm_b(cls_rep_b, graph_input_b, skip=torch.flip(exited, [1]) if exited is not None else None)#(batch_size, num_chioce, mylstm_hidden_size)
         lstm_out_b = torch.flip(lstm_out_b, [1])
 
         lstm_output = torch.cat((lstm_out_f, lstm_out_b), dim=2)#(batch_size, num_chioce, 2*mylstm_hidden_size)
         lstm_output = self.drop_lstm(lstm_output)
 
-        target = lstm_output[:,0,:] #(batch_size, 2*mylstm_hidden_size)
-        final_lstm_output = lstm_output.repeat(1,1,4) #(batch_size, num_chioce, 2*mylstm_hidden_size *4)
-        for i in range(final_lstm_output.size(0)):
-            for j in range(final_lstm_output.size(1)):
-                a = lstm_output[i,j,:]
-                b = target[i,:]
-                c = a * b
-                d = a - b
-                final_lstm_output[i,j,:] = torch.cat((a,b,c,d)) #(2*mylstm_hidden_size *4)
+        target = lstm_output[:,:1,:].expand_as(lstm_output) #(batch_size, num_chioce, 2*mylstm_hidden_size)
+        final_lstm_output = torch.cat((lstm_output, target, lstm_output * target, lstm_output - target), dim=2) #(batch_size, num_chioce, 2*mylstm_hidden_size *4)
 
         pooled_output = self.pooler_activation(self.pooler(final_lstm_output)) #(batch_size, num_chioce, 4*mylstm_hidden_size )
         pooled_output = self.dropout(pooled_output)
@@ -300,13 +335,61 @@ class Bert_v7(BertPreTrainedModel):
             "true_parent_ids": true_parent_ids,
             "labels": labels
         }
+        if exited is not None: # exited choices rank below every other one
+            outputs["logits"] = reshaped_logits.masked_fill(exited, torch.finfo(reshaped_logits.dtype).min)
+        if layers_run is not None:
+            outputs["exit_layers"] = layers_run
         if labels is not None:
             loss_fct=CrossEntropyLoss()
             loss=loss_fct(reshaped_logits, labels)        
+            if heads_loss is not None:
+                loss=loss + heads_loss
             outputs["loss"]=loss
             
         return outputs
 
+class PackedBert_v7(Bert_v7):
+    '''
+    Bert_v7 with one encoder pass per utterance instead of one per (utterance, candidate) choice:
+    "[CLS] utterance [SEP] cand_0 [SEP] cand_1 [SEP] ... cand_N-1 [SEP]" (convert_examples_to_packed_features),
+    candidate j is the mean of the tokens with turn_ids == j+1. Same parameters as Bert_v7, so either
+    checkpoint loads into the other
+    '''
+    def choice_representations(self, num_labels, input_ids, token_type_ids, attention_mask, position_ids, turn_ids, head_mask, inputs_embeds, output_attentions, output_hidden_states):
+        num_labels = self.config.num_labels # the packed features carry a single choice
+        input_ids = input_ids.view(-1, input_ids.size(-1)) if input_ids is not None else None
+        attention_mask = attention_mask.view(-1, attention_mask.size(-1)) if attention_mask is not None else None
+        token_type_ids = token_type_ids.view(-1, token_type_ids.size(-1)) if token_type_ids is not None else None
+        position_ids = position_ids.view(-1, position_ids.size(-1)) if position_ids is not None else None
+        turn_ids = turn_ids.view(-1, turn_ids.size(-1))
+        inputs_embeds = (
+            inputs_embeds.view(-1, inputs_embeds.size(-2), inputs_embeds.size(-1))
+            if inputs_embeds is not None
+            else None
+        )
+        if getattr(self, 'layer_cache', None) is not None: # bottom layers frozen, see frozen_layers.py
+            sequence_output = encode_with_frozen_bottom(self.bert, input_ids, attention_mask, token_type_ids,
+                                                        self.frozen_layers, self.layer_cache, self.layer_cache_prefix)
+            outputs = (sequence_output,)
+        else:
+            outputs = self.bert(
+                input_ids,
+                attention_mask=attention_mask,
+                token_type_ids=token_type_ids,
+                position_ids=position_ids,
+                head_mask=head_mask,
+                inputs_embeds=inputs_embeds,
+                output_attentions=output_attentions,
+                output_hidden_states=output_hidden_states,
+            )
+            sequence_output = outputs[0] # (batch_size, seq_len, hidden_size)
+        slots = F.one_hot(turn_ids, num_labels + 1)[:, :, 1:].to(sequence_output.dtype) #(batch_size, seq_len, num_choice)
+        if attention_mask is not None:
+            slots = slots * attention_mask.unsqueeze(-1).to(sequence_output.dtype)
+        cls_rep = torch.bmm(slots.transpose(1, 2), sequence_output) #(batch_size, num_choice, hidden_size)
+        cls_rep = cls_rep / slots.sum(1).clamp(min=1).unsqueeze(-1)
+        return cls_rep, outputs
+
 def set_seed(seed: int) -> None:
     np.random.seed(seed)
     random.seed(seed)
@@ -418,7 +501,11 @@ class DCDProcessor(DataProcessor):
     
     def get_examples(self, tokenizer, mode, 
                      reversed_filename_to_filename_id, line_id2line_text, line_id2speaker_n, scene_id2line_ids, line_id2scene_id, 
-                     max_previous_utterance, lines_dict):        
+                     max_previous_utterance, lines_dict, candidate_lists=None):        
+        '''
+        candidate_lists: {(filename_id, utterance_id): [utterance_id, candidate ids ...]}, as in inference_4DD
+        (cascade.candidate_lists); slot j then holds the j-th listed line instead of the j-th previous one
+        '''
         
         start_token=tokenizer.cls_token  
         sep_token=tokenizer.sep_token
@@ -435,6 +522,8 @@ class DCDProcessor(DataProcessor):
             if filename not in filenames:
                 filenames.append(filename)
                         
+            info_tuple_index={info_tuple[1]: idx for idx, info_tuple in enumerate(info_tuples)}
+
             for info_tuple_idx, info_tuple in enumerate(info_tuples):
                 seen_cands=[]
                 true_parent_utterance_id, utterance_id=info_tuple
@@ -453,6 +542,9 @@ class DCDProcessor(DataProcessor):
                 for j in range(0, max_previous_utterance):
                     i=info_tuple_idx % max_previous_utterance
                     diff=info_tuple_idx - j
+                    if candidate_lists is not None:
+                        selected=candidate_lists[(filename_id, uoi_id)]
+                        diff=info_tuple_index[selected[j]] if j < len(selected) else -1
 
                     if diff > len(info_tuples):
                         text_b.append('')
@@ -610,6 +702,76 @@ def convert_examples_to_features(examples, label_list, max_seq_length, max_utter
 
     return features
             
+def _fair_budget(lengths, total):
+    """Largest per-sequence lengths that fit total, short sequences keep all of their tokens."""
+    budget = [0] * len(lengths)
+    spent = 0
+    for n, i in enumerate(sorted(range(len(lengths)), key=lambda i: lengths[i])):
+        budget[i] = max(min(lengths[i], (total - spent) // (len(lengths) - n)), 0)
+        spent += budget[i]
+    return budget
+
+def convert_examples_to_packed_features(examples, label_list, max_seq_length, max_utterance_num,
+                                        tokenizer):
+    """
+    PackedBert_v7 input, one sequence per example: "[CLS] utterance [SEP] cand_0 [SEP] ... cand_N-1 [SEP]"
+    segment 0 for the utterance, 1 for the candidates, turn_ids j+1 on candidate j (and its [SEP]), 0 elsewhere;
+    the utterance keeps at most max_seq_length//4 tokens, the candidates share the rest
+    and lose tokens from the front, as _truncate_seq_pair does
+    """
+    label_map={label: i for i, label in enumerate(label_list)}
+    cls_token=tokenizer.cls_token
+    sep_token=tokenizer.sep_token
+
+    features=[]
+
+    for (ex_index, example) in enumerate(examples):
+        tokens_a = tokenizer.tokenize(example.text_a[0])[:max_seq_length // 4]
+        candidates = [tokenizer.tokenize(text_b) for text_b in example.text_b]
+        budget = _fair_budget([len(toks) for toks in candidates], max_seq_length - len(tokens_a) - 2 - len(candidates))
+
+        tokens = [cls_token] + tokens_a + [sep_token]
+        segment_ids = [0] * len(tokens)
+        turn_ids = [0] * len(tokens)
+        for j, toks in enumerate(candidates):
+            toks = toks[len(toks) - budget[j]:] + [sep_token]
+            tokens += toks
+            segment_ids += [1] * len(toks)
+            turn_ids += [j + 1] * len(toks)
+
+        input_ids = tokenizer.convert_tokens_to_ids(tokens)
+        input_mask = [1] * len(input_ids)
+
+        padding = [0] * (max_seq_length - len(input_ids))
+        input_ids += padding
+        input_mask += padding
+        segment_ids += padding
+        turn_ids += padding
+        sep_pos = [0] * (max_utterance_num + 1)
+
+        assert len(input_ids) == max_seq_length
+        assert len(turn_ids) == max_seq_length
+
+        if example.label!=None:
+            label_id=label_map[example.label]
+        else:
+            label_id=None
+
+        features.append(
+            InputFeatures(
+                example_id = example.guid,
+                choices_features = [(input_ids, input_mask, segment_ids, sep_pos, turn_ids)],
+                utterance_id=example.utterance_id,
+                candidate_ids=example.candidate_ids,
+                true_parent_id=example.true_parent_id,
+                label=label_id,
+                adj_matrix_speaker=example.adj_matrix_speaker,
+                adj_matrix_scene=example.adj_matrix_scene
+                )
+        )
+
+    return features
+
 def _truncate_seq_pair(tokens_a, tokens_b, max_length):
     """Truncates a sequence pair in place to the maximum length."""
     while True:
@@ -630,13 +792,14 @@ def prep_tensor_data(features):
     all_guid=torch.tensor([f.example_id for f in features], dtype=torch.long)
     all_utterance_ids=torch.tensor([f.utterance_id for f in features], dtype=torch.long)
     all_candidate_ids_nested=torch.tensor([f.candidate_ids for f in features], dtype=torch.long)
+    all_turn_ids=torch.tensor(select_field(features, 'turn_ids'), dtype=torch.long)
 
     try:
         all_true_parent_ids=torch.tensor([f.true_parent_id for f in features], dtype=torch.long)
         all_label_ids=torch.tensor([f.label for f in features], dtype=torch.long)
-        return all_input_ids, all_input_mask, all_segment_ids, all_adj_speaker, all_adj_matrix_scene, all_guid, all_utterance_ids, all_candidate_ids_nested, all_true_parent_ids, all_label_ids
+        return all_input_ids, all_input_mask, all_segment_ids, all_adj_speaker, all_adj_matrix_scene, all_guid, all_utterance_ids, all_candidate_ids_nested, all_true_parent_ids, all_label_ids, all_turn_ids
     except:
-        return all_input_ids, all_input_mask, all_segment_ids, all_adj_speaker, all_adj_matrix_scene, all_guid, all_utterance_ids, all_candidate_ids_nested
+        return all_input_ids, all_input_mask, all_segment_ids, all_adj_speaker, all_adj_matrix_scene, all_guid, all_utterance_ids, all_candidate_ids_nested, all_turn_ids
 
 if __name__=='__main__':
 
@@ -653,6 +816,11 @@ if __name__=='__main__':
     arg_parser.add_argument('--model_output', help='specify model_output')
     arg_parser.add_argument('--log_output', help='specify log_output')
 
+    arg_parser.add_argument("--packed",
+                        default=0,
+                        type=int,
+                        help="PackedBert_v7: one encoder pass per utterance over all of its candidates")
+    arg_parser.add_argument('--exit_layers', default='', help='comma separated encoder layers (1-based) that get an early exit head, e.g. 3,6,9')
     arg_parser.add_argument("--use_tqdm",
                         default=False,
                         type=bool,
@@ -663,6 +831,45 @@ if __name__=='__main__':
                         type=int,
                         help="specific batch_size.")
 
+    arg_parser.add_argument("--freeze_layers",
+                        default=0,
+                        type=int,
+                        help="freeze the embeddings and the bottom k encoder layers and cache their output")
+    arg_parser.add_argument('--layer_cache', default='layer_cache.sqlite', help='sqlite file for the frozen layers output')
+    arg_parser.add_argument("--layer_cache_size",
+                        default=200000,
+                        type=int,
+                        help="max cached sequences before least recently used ones are evicted")
+    arg_parser.add_argument("--compile",
+                        default=0,
+                        type=int,
+                        help="torch.compile the encoder, one graph per shape bucket (shape_buckets.py)")
+    arg_parser.add_argument('--compile_cache', default='compile_cache', help='folder for the compiled graphs, reused across runs')
+    arg_parser.add_argument("--bf16",
+                        default=0,
+                        type=int,
+                        help="bfloat16 autocast (Accelerator mixed_precision), float32 weights; check a checkpoint with parity_4DD first")
+    arg_parser.add_argument("--memory_budget",
+                        default=0.,
+                        type=float,
+                        help="GB per device: probe micro-batches of effective_batch_size, with and without gradient checkpointing, and train with the first that fits (memory_plan.py; 0: off)")
+    arg_parser.add_argument("--effective_batch_size",
+                        default=0,
+                        type=int,
+                        help="examples per optimizer step, batch_size-sized micro-batches accumulated (0: batch_size)")
+    arg_parser.add_argument("--lora_rank",
+                        default=0,
+                        type=int,
+                        help="LoRA on the encoder attention projections (lora.py), frozen encoder; the checkpoint is the adapter (0: off)")
+    arg_parser.add_argument("--lora_alpha",
+                        default=16,
+                        type=int,
+                        help="LoRA scaling, the update is alpha/rank * B A")
+    arg_parser.add_argument('--lora_targets', default=','.join(LORA_TARGETS), help='comma separated encoder Linear names that get a LoRA update')
+    arg_parser.add_argument("--lora_learning_rate",
+                        default=5e-4,
+                        type=float,
+                        help="learning rate with --lora_rank")
 
     args=vars(arg_parser.parse_args())
 
@@ -677,6 +884,8 @@ if __name__=='__main__':
     args['epochs']=int(args['epochs'])
     args["n_gpu"]=torch.cuda.device_count()
     args["learning_rate"]=5e-6
+    if args['lora_rank']:
+        args["learning_rate"]=args['lora_learning_rate']
     args['grad_clip']=1
     args["fix_encoder"]=0
     args["output_dir"]=OUTPUT_PATH
@@ -684,11 +893,14 @@ if __name__=='__main__':
 
     use_tqdm=args['use_tqdm']
     BATCH_SIZE=args['batch_size']
+    EFFECTIVE_BATCH_SIZE=args['effective_batch_size'] or BATCH_SIZE
+    assert EFFECTIVE_BATCH_SIZE % BATCH_SIZE == 0 or args['memory_budget'], 'effective_batch_size is a multiple of batch_size'
+    ACCUMULATION_STEPS=EFFECTIVE_BATCH_SIZE//BATCH_SIZE
 
     ######
 
-    ddp_kwargs=DistributedDataParallelKwargs(find_unused_parameters=True)
-    accelerator=Accelerator(kwargs_handlers=[ddp_kwargs])
+    ddp_kwargs=DistributedDataParallelKwargs(find_unused_parameters=False, static_graph=True)
+    accelerator=Accelerator(kwargs_handlers=[ddp_kwargs], mixed_precision='bf16' if args['bf16'] else None)
 
     ######
     timestamp=datetime.datetime.now().strftime("%m%d%Y-%H%M%S")    
@@ -819,6 +1031,8 @@ if __name__=='__main__':
     main_log(f'Initiating the PrLM: {pretrained_model_name}')
 
     config_class, model_class, tokenizer_class=BertConfig, Bert_v7, BertTokenizer
+    if args['packed']:
+        model_class, convert_examples_to_features=PackedBert_v7, convert_examples_to_packed_features
     tokenizer=tokenizer_class.from_pretrained(pretrained_model_name, 
                                             do_lower_case=False, 
                                             do_basic_tokenize=False)
@@ -840,6 +1054,9 @@ if __name__=='__main__':
 
     config=config_class.from_pretrained(pretrained_model_name, num_labels=num_labels)
     model=model_class.from_pretrained(pretrained_model_name, config=config)
+    if accelerator.is_main_process: # the output folder also works as --model_name for inference
+        config.save_pretrained(str(OUTPUT_PATH))
+        tokenizer.save_pretrained(str(OUTPUT_PATH))
 
     HIDDEN_DIM=config.hidden_size
     SEQUENCE_MAX_LEN=tokenizer.model_max_length
@@ -897,8 +1114,66 @@ if __name__=='__main__':
     dev_sampler=SequentialSampler(dev_data)
     dev_data_loader=DataLoader(dev_data, sampler=dev_sampler, batch_size=BATCH_SIZE)
 
+    if args['exit_layers']:
+        assert not args['packed'] and not args['freeze_layers'], 'exit heads read per-choice hidden states of every layer'
+        attach_exit_heads(model, model.bert, [int(k) for k in args['exit_layers'].split(',')])
+        main_log(f"Early exit heads after layers {model.exit_heads.layers}")
+
+    lora=None
+    if args['lora_rank']:
+        assert not args['freeze_layers'], 'LoRA trains every layer'
+        attach_lora(model.bert, args['lora_rank'], args['lora_alpha'], targets=args['lora_targets'].split(','))
+        lora=lora_settings(args['lora_rank'], args['lora_alpha'], args['lora_targets'].split(','), args['model_name'], 'bert.')
+        trainable, total, adapter_bytes, dense_bytes=lora_report(model, lora)
+        main_log(f"LoRA rank {args['lora_rank']} on {args['lora_targets']}: {trainable} of {total} parameters trainable ({trainable/total*100:.2f}%), "
+                 f"checkpoint {adapter_bytes/2**20:.1f}MB instead of {dense_bytes/2**20:.1f}MB")
+        if trainable > total*LORA_MAX_TRAINABLE:
+            main_log(f"WARNING: {trainable/total*100:.2f}% of the parameters trainable (the dense Bert_v7 heads outside of the encoder), "
+                     f"LoRA saves little optimizer memory, checkpoint size or gradient traffic")
+
+    if args['freeze_layers']:
+        attach_layer_cache(model, model.bert, EmbeddingCache(args['layer_cache'], max_entries=args['layer_cache_size']), args['freeze_layers'])
+        main_log(f"Frozen bottom {args['freeze_layers']} layers, cache: {args['layer_cache']}")
+
+    if args['compile']:
+        assert not args['freeze_layers'], 'the frozen layers path runs the encoder layers itself'
+        attach_compiled_encoder(model.bert, [SEQUENCE_MAX_LEN], [BATCH_SIZE*(1 if args['packed'] else num_labels)], args['compile_cache'])
+        main_log(f"Compiled encoder, cache: {args['compile_cache']}")
+
+    if args['memory_budget']:
+        assert accelerator.device.type == 'cuda', 'the plan is probed with the CUDA peak memory stats'
+        assert not (args['compile'] or args['freeze_layers']), 'the plan checkpoints the eager encoder layers'
+        model=model.to(accelerator.device)
+        def probe_step(micro_batch_size):
+            batch=[t.to(accelerator.device) for t in train_data[:micro_batch_size]]
+            d={
+                'input_ids': batch[0],
+                'attention_mask': batch[1],
+                'token_type_ids': batch[2],
+                'adj_matrix_speaker': batch[3],
+                'adj_matrix_scene': batch[4],
+                'filename_ids': batch[5],
+                'utterance_of_interest_ids': batch[6],
+                'candidate_ids_nested': batch[7],
+                'true_parent_ids': batch[8],
+                'labels': batch[9],
+                'turn_ids': batch[10]
+            }
+            model.train()
+            with accelerator.autocast():
+                loss=model(**d)['loss'].mean()
+            loss.backward()
+        plan=plan_training(model, model.bert, probe_step, EFFECTIVE_BATCH_SIZE, int(args['memory_budget']*2**30), accelerator.device)
+        for line in plan_report(plan):
+            main_log(f"Memory plan: {line}")
+        assert 'micro_batch_size' in plan, f"no micro-batch fits in {args['memory_budget']}GB"
+        BATCH_SIZE, ACCUMULATION_STEPS=plan['micro_batch_size'], plan['accumulation_steps']
+        data_loader=DataLoader(train_data, sampler=train_sampler, batch_size=BATCH_SIZE)
+        dev_data_loader=DataLoader(dev_data, sampler=dev_sampler, batch_size=BATCH_SIZE)
+    main_log(f"Batch: {BATCH_SIZE} x {ACCUMULATION_STEPS} accumulation steps = {EFFECTIVE_BATCH_SIZE} examples per optimizer step")
+
     ### OPTIMIZER
-    param_optimizer=list(model.named_parameters())
+    param_optimizer=[(n, p) for n, p in model.named_parameters() if p.requires_grad] # LoRA: adapter and heads only
     no_decay=['bias', 'LayerNorm.bias', 'LayerNorm.weight']
     optimizer_grouped_parameters = [
         {'params': [p for n, p in param_optimizer if not any(nd in n for nd in no_decay)], 'weight_decay': 0.01},
@@ -943,15 +1218,21 @@ if __name__=='__main__':
                 'utterance_of_interest_ids': batch[6],
                 'candidate_ids_nested': batch[7],
                 'true_parent_ids': batch[8],       
-                'labels': batch[9]
+                'labels': batch[9],
+                'turn_ids': batch[10]
             }
 
-            outputs=model(**d)
-            loss=outputs['loss'].mean()
-            train_loss += loss.detach().item()
-            accelerator.backward(loss)    
-            optimizer.step()
-            optimizer.zero_grad()
+            group_start=i - i % ACCUMULATION_STEPS
+            group_size=min(ACCUMULATION_STEPS, len(data_loader) - group_start) # the last group of an epoch can be short
+            sync=(i == group_start + group_size - 1)
+            with (contextlib.nullcontext() if sync else accelerator.no_sync(model)): # gradients are all-reduced once per optimizer step
+                outputs=model(**d)
+                loss=outputs['loss'].mean()
+                train_loss += loss.detach().item()
+                accelerator.backward(loss/group_size)
+            if sync:
+                optimizer.step()
+                optimizer.zero_grad()
 
             if use_tqdm:
                 progress_bar.update(1)
@@ -980,7 +1261,8 @@ if __name__=='__main__':
                         'utterance_of_interest_ids': batch[6],
                         'candidate_ids_nested': batch[7],
                         'true_parent_ids': batch[8],     
-                        'labels': batch[9]
+                        'labels': batch[9],
+                        'turn_ids': batch[10]
                     }
 
                     d={key: to_cuda(val) for key, val in d.items()} 
@@ -1056,11 +1338,16 @@ if __name__=='__main__':
                     eval_metric=0.2*pairwise_accuracy+0.8*cluster_metrics
 
                     if eval_metric>best_eval_metric:
-                        best_model_path=f"pytorch_model-{timestamp}-epoch{epoch}.bin"
+                        best_model_path=f"pytorch_model-{timestamp}-epoch{epoch}.safetensors"
                         main_log(f"^ New best -- Model saved: {best_model_path}")
                         best_eval_metric=eval_metric
                         # main_log(f"Pairwise_accuracy: {pairwise_accuracy*100:.2f}; ari: {ari:5.2f}; 1-vi: {vi:.2f}; shen: {shen:.2f}; oto: {oto:.2f}; em-f: {em_f:.2f}")
                         # torch.save(model.state_dict(), best_model_path)
                         accelerator.wait_for_everyone()
                         unwrapped_model=accelerator.unwrap_model(model)
-                        accelerator.save(unwrapped_model.state_dict(), str(pathlib.Path(args["output_dir"].joinpath(best_model_path))))
+                        if accelerator.is_main_process:
+                            save_checkpoint(unwrapped_model, args["output_dir"].joinpath(best_model_path), unwrapped_model.config, lora=lora)
+
+    if args['compile']:
+        for line in compile_report(accelerator.unwrap_model(model).bert):
+            main_log(f"Compile: {line}")
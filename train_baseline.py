@@ -32,6 +32,11 @@ from accelerate.logging import get_logger
 
 from models import *
 from eval import *
+from feature_store import build_feature_store, FeatureStore, FeatureStoreCollate
+from pruning import accumulate_importance, select_pruning, prune_encoder, encoder_flops, save_pruning_plan
+from shape_buckets import attach_compiled_encoder, compile_report
+from checkpoints import save_checkpoint, read_state_dict
+from lora import LORA_TARGETS, LORA_HEAD_RANK, LORA_MAX_TRAINABLE, attach_lora, lora_settings, lora_report
 
 def set_seed(seed: int) -> None:
     np.random.seed(seed)
@@ -60,11 +65,14 @@ def merge(sequences, ignore_idx=None):
 
 
 class CDDataset(torch.utils.data.Dataset):
-    def __init__(self, lines, filename_to_filename_id, scene_id2line_ids, line_id2line_text, line_id2turn_n, line_id2speaker, speaker2line_ids, tokenizer, mode, max_length=512, num_negative_examples=10):
+    def __init__(self, lines, filename_to_filename_id, scene_id2line_ids, line_id2line_text, line_id2turn_n, line_id2speaker, speaker2line_ids, tokenizer, mode, max_length=512, num_negative_examples=10, context_lines=0, candidate_lists=None):
         self.tokenizer=tokenizer
         self.max_length=max_length
         
         self.num_negative_examples=num_negative_examples
+        self.context_lines=context_lines
+        self.candidate_lists=candidate_lists # cascade.candidate_lists: only these candidates are paired (produce_candidates)
+        self.tokenized_lines={}
         self.max_candidates=10
         self.max_distance=12
         
@@ -124,6 +132,21 @@ class CDDataset(torch.utils.data.Dataset):
                             if (not candidate_line_id.startswith('A')) ]
         return candidate_line_ids
         
+    def window_fields(self, filename_id, scene_id, utterance_of_interest_id, candidate_line_id, true_parent_utterance_id):
+        '''
+        per-line turn / speaker / scene, so pairs across items of a batch can be scored (in-batch negatives)
+        '''
+        if true_parent_utterance_id.startswith('D') and true_parent_utterance_id[1:].isdigit():
+            true_parent_id=int(true_parent_utterance_id[1:])
+        else:
+            true_parent_id=-1 if true_parent_utterance_id.startswith('T') else -2
+        return {'scene_id': scene_id,
+                'utterance_of_interest_turn': self.line_id2turn_n[self.mode][filename_id][utterance_of_interest_id],
+                'candidate_turn': self.line_id2turn_n[self.mode][filename_id][candidate_line_id],
+                'utterance_of_interest_speaker': self.line_id2speaker[self.mode][filename_id][utterance_of_interest_id],
+                'candidate_speaker': self.line_id2speaker[self.mode][filename_id][candidate_line_id],
+                'true_parent_id': true_parent_id}
+
     def get_concat_context(self, filename_id, scene_id, line_id):
         all_line_ids_in_scene=self.scene_id2line_ids[self.mode][filename_id][scene_id]
         previous_line_ids=all_line_ids_in_scene[:all_line_ids_in_scene.index(line_id)]
@@ -139,12 +162,30 @@ class CDDataset(torch.utils.data.Dataset):
             
         context_tokens=[]
         for context_id in reversed(context_ids):
-            tokens=tokenizer.tokenize(line_id2line_text[self.mode][filename_id][context_id])
+            tokens=self.tokenizer.tokenize(self.line_id2line_text[self.mode][filename_id][context_id])
             if len(context_tokens)<=self.max_length:
                 context_tokens.extend(tokens)            
             
         return f"{self.start_token} {self.tokenizer.convert_tokens_to_string(context_tokens)}"
 
+    def get_context(self, filename_id, scene_id, line_id):
+        '''
+        the concatenated previous lines as one sequence, or with context_lines the last context_lines
+        previous lines, one sequence each (oldest first, see models.ContextGRU)
+        '''
+        if not self.context_lines:
+            return self.tokenize_line(self.get_concat_context(filename_id, scene_id, line_id))
+
+        all_line_ids_in_scene=self.scene_id2line_ids[self.mode][filename_id][scene_id]
+        context_ids=all_line_ids_in_scene[:all_line_ids_in_scene.index(line_id)][-self.context_lines:]
+        context=[]
+        for context_id in context_ids:
+            # shared across the items of the pool, every line is tokenized once
+            if (filename_id, context_id) not in self.tokenized_lines:
+                self.tokenized_lines[(filename_id, context_id)]=self.tokenize_line(f"{self.start_token} {self.line_id2line_text[self.mode][filename_id][context_id]}")
+            context.append(self.tokenized_lines[(filename_id, context_id)])
+        return context
+
     def produce_candidates(self):
         pool=[]
         for key, line_data in self.lines[self.mode].items():    
@@ -159,10 +200,9 @@ class CDDataset(torch.utils.data.Dataset):
             scene_speaker_id=line_data['scene_speaker_id']
             
             ### add self token for every instance
-            context_plain=self.get_concat_context(filename_id, scene_id, utterance_of_interest_id)
+            context=self.get_context(filename_id, scene_id, utterance_of_interest_id)
             self_plain=f"{self.start_token} {self.self_token}"
 
-            context=self.tokenize_line(context_plain)
             self_tokenized=self.tokenize_line(self_plain)
 
             item={'filename_id': filename_id,
@@ -180,6 +220,7 @@ class CDDataset(torch.utils.data.Dataset):
                     'label': 1 if true_parent_utterance_id.startswith('T') else 0
                     }
 
+            item.update(self.window_fields(filename_id, scene_id, utterance_of_interest_id, utterance_of_interest_id, true_parent_utterance_id))
             pool.append(item)
 
             candidate_line_ids=self.get_candidate_line_ids(filename_id, scene_id, utterance_of_interest_id)
@@ -187,11 +228,13 @@ class CDDataset(torch.utils.data.Dataset):
             
             if self.max_candidates:
                 candidate_line_ids=candidate_line_ids[:self.max_candidates]
+            if self.candidate_lists is not None:
+                kept=self.candidate_lists[(filename_id, utterance_of_interest_id)]
+                candidate_line_ids=[c for c in candidate_line_ids if c in kept]
 
             for candidate_line_id in candidate_line_ids:
-                context_plain=self.get_concat_context(filename_id, scene_id, candidate_line_id)
+                context=self.get_context(filename_id, scene_id, candidate_line_id)
                 candidate_line_plain=f"{self.start_token} {self.line_id2line_text[self.mode][line_data['filename_id']][candidate_line_id]}"
-                context=self.tokenize_line(context_plain)
                 candidate_line=self.tokenize_line(candidate_line_plain) 
 
                 utterances_distance=int(utterance_of_interest_id[1:])-int(candidate_line_id[1:]) 
@@ -218,6 +261,7 @@ class CDDataset(torch.utils.data.Dataset):
                       'mode': self.mode_dict[self.mode],
                       'label': y}
 
+                item.update(self.window_fields(filename_id, scene_id, utterance_of_interest_id, candidate_line_id, true_parent_utterance_id))
                 pool.append(item)
 
         return pool    
@@ -235,8 +279,7 @@ class CDDataset(torch.utils.data.Dataset):
             true_parent_utterance_id=line_data['reply_to_id']
             scene_speaker_id=line_data['scene_speaker_id']
             ### add self token for every instance
-            context_plain=self.get_concat_context(filename_id, scene_id, utterance_of_interest_id)
-            context=self.tokenize_line(context_plain)
+            context=self.get_context(filename_id, scene_id, utterance_of_interest_id)
 
             self_plain=f"{self.start_token} {self.self_token}"            
             self_tokenized=self.tokenize_line(self_plain)
@@ -256,12 +299,12 @@ class CDDataset(torch.utils.data.Dataset):
                     'label': 1 if true_parent_utterance_id.startswith('T') else 0
                     }
 
+            item.update(self.window_fields(filename_id, scene_id, utterance_of_interest_id, utterance_of_interest_id, true_parent_utterance_id))
             pool.append(item)
 
             if true_parent_utterance_id.startswith('D'):
                 true_parent_utterance_plain=f"{self.start_token} {self.line_id2line_text[self.mode][line_data['filename_id']][true_parent_utterance_id]}"
-                context_plain=self.get_concat_context(filename_id, scene_id, true_parent_utterance_id)
-                context=self.tokenize_line(context_plain)
+                context=self.get_context(filename_id, scene_id, true_parent_utterance_id)
                 true_parent_utterance=self.tokenize_line(true_parent_utterance_plain)
                 try:
                     utterances_distance=int(utterance_of_interest_id[1:])-int(true_parent_utterance_id[1:]) 
@@ -286,6 +329,7 @@ class CDDataset(torch.utils.data.Dataset):
                       'mode': self.mode_dict[self.mode],
                       'label': 1}
 
+                item.update(self.window_fields(filename_id, scene_id, utterance_of_interest_id, true_parent_utterance_id, true_parent_utterance_id))
                 pool.append(item)
 
             if true_parent_utterance_id.startswith('D'): # need one less neg ex
@@ -301,9 +345,8 @@ class CDDataset(torch.utils.data.Dataset):
             
             for negative_id in negative_ids:                
                 negative_parent_utterance_plain=f"{self.start_token} {self.line_id2line_text[self.mode][line_data['filename_id']][negative_id]}"
-                context_plain=self.get_concat_context(filename_id, scene_id, negative_id)
+                context=self.get_context(filename_id, scene_id, negative_id)
                 utterances_distance=int(utterance_of_interest_id[1:])-int(negative_id[1:])
-                context=self.tokenize_line(context_plain)
                 negative_parent_utterance=self.tokenize_line(negative_parent_utterance_plain)            
                 turn_a=self.line_id2turn_n[self.mode][line_data['filename_id']][utterance_of_interest_id]
                 turn_b=self.line_id2turn_n[self.mode][line_data['filename_id']][negative_id]
@@ -324,6 +367,7 @@ class CDDataset(torch.utils.data.Dataset):
                     'mode': self.mode_dict[self.mode],
                     'label': y}
 
+                item.update(self.window_fields(filename_id, scene_id, utterance_of_interest_id, negative_id, true_parent_utterance_id))
                 pool.append(item)
         return pool
 
@@ -343,6 +387,26 @@ def get_distance_bucket(d):
     if d>=7:
         return 5
 
+def batch_ids(values):
+    '''
+    strings -> ints, only equality within the batch is meaningful
+    '''
+    ids={}
+    return [ids.setdefault(v, len(ids)) for v in values]
+
+def merge_lines(sequences):
+    '''
+    merge from batch * num_lines * line_len to batch * max_lines * max_len, and the number of lines of each item
+    '''
+    num_lines=[len(seq) for seq in sequences]
+    lines, _=merge([line for seq in sequences for line in seq] or [torch.Tensor([])])
+    padded_lines=torch.zeros(len(sequences), max(max(num_lines), 1), lines.size(1)).long()
+    offset=0
+    for i, n in enumerate(num_lines):
+        padded_lines[i, :n]=lines[offset:offset+n]
+        offset+=n
+    return padded_lines, torch.LongTensor(num_lines)
+
 def collate_fn_cd(data):
     entry={}
     for key in data[0].keys():
@@ -350,7 +414,10 @@ def collate_fn_cd(data):
 
     # merge sequences  
     filename_id=torch.LongTensor(entry['filename_id'])
-    context, context_lengths=merge(entry['context'])
+    if isinstance(entry['context'][0], list): # CDDataset context_lines
+        context, context_num_lines=merge_lines(entry['context'])
+    else:
+        context, context_lengths=merge(entry['context'])
     candidate_line_id=torch.LongTensor([int(id[1:]) for id in entry['candidate_line_id']])
     parent_utterance, parent_utterance_lengths=merge(entry["parent_utterance"])
     utterance_of_interest_id=torch.LongTensor([int(id[1:]) for id in entry['utterance_of_interest_id']])
@@ -362,6 +429,12 @@ def collate_fn_cd(data):
     same_speaker=torch.LongTensor([int(st) for st in entry['same_speaker']])
     mode=torch.LongTensor([int(st) for st in entry['mode']])
     label=torch.tensor(entry['label'])
+    scene_id=torch.LongTensor(batch_ids(entry['scene_id']))
+    turns=torch.LongTensor(batch_ids(entry['utterance_of_interest_turn'] + entry['candidate_turn']))
+    utterance_of_interest_turn, candidate_turn=turns[:len(data)], turns[len(data):]
+    utterance_of_interest_speaker=torch.LongTensor([int(s) for s in entry['utterance_of_interest_speaker']])
+    candidate_speaker=torch.LongTensor([int(s) for s in entry['candidate_speaker']])
+    true_parent_id=torch.LongTensor(entry['true_parent_id'])
     
     collated_data={'filename_id': filename_id,
                    'context': context,
@@ -375,10 +448,281 @@ def collate_fn_cd(data):
                    'same_speaker': same_speaker,
                    'same_turn': same_turn,
                    'mode': mode,
-                   'label': label}
+                   'label': label,
+                   'scene_id': scene_id,
+                   'utterance_of_interest_turn': utterance_of_interest_turn,
+                   'candidate_turn': candidate_turn,
+                   'utterance_of_interest_speaker': utterance_of_interest_speaker,
+                   'candidate_speaker': candidate_speaker,
+                   'true_parent_id': true_parent_id}
+
+    if isinstance(entry['context'][0], list):
+        collated_data['context_num_lines']=context_num_lines
     
     return collated_data
 
+class SceneBatchSampler(torch.utils.data.Sampler):
+    '''
+    batches of pool items from the same (filename, scene), so in-batch negatives come from the same
+    scene window; a scene's last batch can be short. Items within a scene and batch order are shuffled every epoch
+    '''
+    def __init__(self, dataset, batch_size):
+        self.batch_size=batch_size
+        self.scenes={}
+        for idx, item in enumerate(dataset.pool):
+            self.scenes.setdefault((item['filename_id'], item['scene_id']), []).append(idx)
+
+    def __iter__(self):
+        batches=[]
+        for scene in self.scenes.values():
+            scene=random.sample(scene, len(scene))
+            batches.extend(scene[start:start+self.batch_size] for start in range(0, len(scene), self.batch_size))
+        random.shuffle(batches)
+        return iter(batches)
+
+    def __len__(self):
+        return sum(math.ceil(len(scene)/self.batch_size) for scene in self.scenes.values())
+
+def in_batch_negatives_loss(model, outputs, d, max_distance=12):
+    '''
+    scores every utterance of interest of the batch against every candidate line of the batch
+    with models.score_all_pairs (the CLS vectors come from the forward, no extra encoder work).
+    candidates from the same scene within max_distance lines before the utterance are its
+    negatives, unless they are its true parent; softmax cross entropy per utterance
+    '''
+    cj_cls, lj_cls, li_cls=outputs['cls']
+    filename_id=d['filename_id']
+    utterance_of_interest_id=d['utterance_of_interest_id']
+    candidate_line_id=d['candidate_line_id']
+    is_self=candidate_line_id == utterance_of_interest_id
+
+    # one row per utterance of interest, one column per candidate line (self candidates are per utterance)
+    rows, cols={}, {}
+    for idx, (f, u, c, s) in enumerate(zip(filename_id.tolist(), utterance_of_interest_id.tolist(), candidate_line_id.tolist(), is_self.tolist())):
+        rows.setdefault((f, u), idx)
+        cols.setdefault((f, c, s), idx)
+    rows=torch.tensor(list(rows.values()), device=filename_id.device)
+    cols=torch.tensor(list(cols.values()), device=filename_id.device)
+
+    pair=lambda key_a, key_b: (d[key_a][rows].unsqueeze(1), d[key_b][cols].unsqueeze(0))
+    uoi, cand=pair('utterance_of_interest_id', 'candidate_line_id')
+    same_window=(filename_id[rows].unsqueeze(1) == filename_id[cols].unsqueeze(0)) & (d['scene_id'][rows].unsqueeze(1) == d['scene_id'][cols].unsqueeze(0))
+    col_is_self=is_self[cols].unsqueeze(0)
+    valid=same_window & torch.where(col_is_self, uoi == cand, (cand < uoi) & (uoi - cand <= max_distance))
+
+    true_parent=d['true_parent_id'][rows].unsqueeze(1)
+    positive=valid & torch.where(col_is_self, true_parent == -1, cand == true_parent)
+
+    same_turn=torch.eq(*pair('utterance_of_interest_turn', 'candidate_turn')).long()
+    same_speaker=torch.eq(*pair('utterance_of_interest_speaker', 'candidate_speaker')).long()
+    logits=score_all_pairs(model, cj_cls[cols], lj_cls[cols], li_cls[rows], bucket_distances((uoi - cand).clamp(min=0)),
+                           same_turn, same_speaker, d['first_spoke'][rows])
+
+    has_positive=positive.any(1)
+    if not has_positive.any():
+        return logits.sum() * 0.
+    logits=logits[has_positive]
+    log_norm=torch.logsumexp(logits.masked_fill(~valid[has_positive], -float('inf')), 1)
+    log_positive=torch.logsumexp(logits.masked_fill(~positive[has_positive], -float('inf')), 1)
+    return (log_norm - log_positive).mean()
+
+class GroupedCDDataset(torch.utils.data.Dataset):
+    '''
+    one item per utterance of interest: the consecutive CDDataset items (self, true parent, negatives)
+    that share it
+    '''
+    def __init__(self, dataset):
+        self.groups=[]
+        last_key=None
+        for item in dataset.pool:
+            key=(item['filename_id'], item['utterance_of_interest_id'])
+            if key != last_key:
+                self.groups.append([])
+                last_key=key
+            self.groups[-1].append(item)
+
+    def __getitem__(self, idx):
+        return self.groups[idx]
+
+    def __len__(self):
+        return len(self.groups)
+
+def collate_fn_grouped(data):
+    '''
+    data: list of groups; pairs are flattened as in collate_fn_cd, but utterance_of_interest holds one
+    row per group and group_index maps every pair to its group (see models.encode_cls).
+    with context_lines every distinct line of the batch (utterances, candidates, context lines) is one
+    row of lines, parent_utterance_line / utterance_of_interest_line / context_line index into it (see models.encode_pair_cls);
+    concatenated contexts differ for every candidate, those are only encoded per pair
+    '''
+    items=[item for group in data for item in group]
+    collated_data=collate_fn_cd(items)
+    collated_data['utterance_of_interest'], _=merge([group[0]['utterance_of_interest'] for group in data])
+    collated_data['group_index']=torch.LongTensor([g for g, group in enumerate(data) for _ in group])
+
+    if isinstance(items[0]['context'], list):
+        rows={(): 0} # the empty line is the context padding, as the zero rows of merge_lines
+        line=lambda ids: rows.setdefault(tuple(ids.long().tolist()), len(rows))
+        collated_data['parent_utterance_line']=torch.LongTensor([line(item['parent_utterance']) for item in items])
+        collated_data['utterance_of_interest_line']=torch.LongTensor([line(group[0]['utterance_of_interest']) for group in data])
+        context_line=torch.zeros(collated_data['context'].shape[:2]).long()
+        for i, item in enumerate(items):
+            context_line[i, :len(item['context'])]=torch.LongTensor([line(ids) for ids in item['context']])
+        collated_data['context_line']=context_line
+        collated_data['lines'], _=merge([torch.LongTensor(ids) for ids in rows])
+    return collated_data
+
+def listwise_loss(logits, labels, group_index):
+    '''
+    softmax cross entropy over the candidates of each group; groups without a positive are skipped
+    '''
+    num_groups=int(group_index.max())+1
+    group_max=torch.full((num_groups,), -float('inf'), device=logits.device, dtype=logits.dtype)
+    group_max=group_max.scatter_reduce(0, group_index, logits.detach(), reduce='amax')
+    shifted=logits - group_max[group_index]
+    log_norm=torch.zeros(num_groups, device=logits.device, dtype=logits.dtype).index_add(0, group_index, shifted.exp()).log()
+    log_probs=shifted - log_norm[group_index]
+
+    labels=labels.to(logits.dtype)
+    num_positives=torch.zeros(num_groups, device=logits.device, dtype=logits.dtype).index_add(0, group_index, labels)
+    group_loss=-torch.zeros(num_groups, device=logits.device, dtype=logits.dtype).index_add(0, group_index, log_probs*labels)
+    group_loss=group_loss / num_positives.clamp(min=1)
+    if not (num_positives > 0).any():
+        return logits.sum() * 0.
+    return group_loss[num_positives > 0].mean()
+
+class SceneCDDataset(CDDataset):
+    '''
+    one item per scene window for models.SceneDialogueEncoder: the window's lines are tokenized
+    once into a single sequence, and every (utterance of interest, candidate) pair whose utterance
+    belongs to the window is listed with the fields produce_candidates gives it (self + up to
+    max_candidates previous D lines, in every mode)
+
+    scenes longer than max_length are split; a window starts with the lines holding the previous
+    window's last max_candidates D lines, re-read as candidates only
+    '''
+    def __init__(self, lines, filename_to_filename_id, scene_id2line_ids, line_id2line_text, line_id2turn_n, line_id2speaker, speaker2line_ids, tokenizer, mode, max_length=4096, max_line_length=128):
+        self.max_line_length=min(max_line_length, (max_length-1)//2) # so a line always fits after the re-read lines
+        super().__init__(lines, filename_to_filename_id, scene_id2line_ids, line_id2line_text, line_id2turn_n, line_id2speaker, speaker2line_ids, tokenizer, mode, max_length)
+
+    def produce_candidates(self):
+        return self.produce_windows()
+
+    def produce_negative_examples(self):
+        return self.produce_windows()
+
+    def split_scene(self, line_ids, line_tokens):
+        '''
+        returns (start, first_owned, end) line index triples
+        '''
+        windows=[]
+        start, owned=0, 0
+        while owned < len(line_ids):
+            size=1 + sum(len(tokens) for tokens in line_tokens[start:owned])
+            end=owned
+            while end < len(line_ids) and size+len(line_tokens[end]) <= self.max_length:
+                size+=len(line_tokens[end])
+                end+=1
+            windows.append((start, owned, end))
+
+            owned=start=end
+            num_dialogue, size=0, 0
+            while start > 0 and num_dialogue < self.max_candidates and size+len(line_tokens[start-1]) <= self.max_length//2:
+                start-=1
+                size+=len(line_tokens[start])
+                num_dialogue+=line_ids[start].startswith('D')
+        return windows
+
+    def produce_windows(self):
+        pool=[]
+        for filename_id, scenes in self.scene_id2line_ids[self.mode].items():
+            for scene_id, line_ids in scenes.items():
+                line_tokens=[self.tokenizer.convert_tokens_to_ids(self.tokenizer.tokenize(self.line_id2line_text[self.mode][filename_id][line_id]))[:self.max_line_length]
+                             for line_id in line_ids]
+                for start, owned, end in self.split_scene(line_ids, line_tokens):
+                    pool.append(self.produce_window(filename_id, scene_id, line_ids[start:end], line_tokens[start:end], owned-start))
+        return [item for item in pool if item['pairs']]
+
+    def produce_window(self, filename_id, scene_id, line_ids, line_tokens, first_owned):
+        tokens=[self.tokenizer.convert_tokens_to_ids(self.start_token)]
+        token_line=[-1]
+        for slot, ids in enumerate(line_tokens):
+            tokens.extend(ids)
+            token_line.extend([slot]*len(ids))
+
+        pairs=[]
+        for uoi_slot, utterance_of_interest_id in enumerate(line_ids):
+            if uoi_slot < first_owned or (filename_id, utterance_of_interest_id) not in self.lines[self.mode]:
+                continue
+            line_data=self.lines[self.mode][(filename_id, utterance_of_interest_id)]
+            true_parent_utterance_id=line_data['reply_to_id']
+            first_spoke=1 if line_data['scene_speaker_id']=='0' else 0
+
+            pair={'candidate_line_id': utterance_of_interest_id,
+                  'candidate_slot': -1, # [SELF]
+                  'utterance_of_interest_id': utterance_of_interest_id,
+                  'uoi_slot': uoi_slot,
+                  'utterances_distance': 0,
+                  'same_speaker': 1,
+                  'first_spoke': first_spoke,
+                  'same_turn': 1,
+                  'label': 1 if true_parent_utterance_id.startswith('T') else 0}
+            pairs.append(pair)
+
+            candidate_slots=[slot for slot in range(uoi_slot) if line_ids[slot].startswith('D')]
+            for candidate_slot in list(reversed(candidate_slots))[:self.max_candidates]:
+                candidate_line_id=line_ids[candidate_slot]
+                turn_a=self.line_id2turn_n[self.mode][filename_id][utterance_of_interest_id]
+                turn_b=self.line_id2turn_n[self.mode][filename_id][candidate_line_id]
+                speaker_a=self.line_id2speaker[self.mode][filename_id][utterance_of_interest_id]
+                speaker_b=self.line_id2speaker[self.mode][filename_id][candidate_line_id]
+
+                pair={'candidate_line_id': candidate_line_id,
+                      'candidate_slot': candidate_slot,
+                      'utterance_of_interest_id': utterance_of_interest_id,
+                      'uoi_slot': uoi_slot,
+                      'utterances_distance': int(utterance_of_interest_id[1:])-int(candidate_line_id[1:]),
+                      'same_speaker': 1 if speaker_a == speaker_b else 0,
+                      'first_spoke': first_spoke,
+                      'same_turn': 1 if turn_a == turn_b else 0,
+                      'label': 1 if candidate_line_id == true_parent_utterance_id else 0}
+                pairs.append(pair)
+
+        return {'filename_id': filename_id,
+                'scene_id': scene_id,
+                'scene_tokens': torch.Tensor(tokens),
+                'token_line': torch.Tensor(token_line),
+                'pairs': pairs,
+                'mode': self.mode_dict[self.mode]}
+
+def collate_fn_scene(data):
+    '''
+    data: list of scene windows; pairs are flattened with the collate_fn_cd keys the training and
+    eval loops read, plus scene_tokens, token_slot (line slot of every token, -1 for [CLS] and
+    padding) and the uoi / candidate slots (-1 for [SELF]) into the batch's line vectors
+    '''
+    scene_tokens, _=merge([d['scene_tokens'] for d in data])
+    token_line, _=merge([d['token_line'] for d in data], ignore_idx=-1)
+    num_slots=int(token_line.max())+1
+    offsets=torch.arange(len(data)).unsqueeze(1)*num_slots
+    token_slot=torch.where(token_line >= 0, token_line+offsets, token_line)
+
+    pairs=[(s, pair) for s, d in enumerate(data) for pair in d['pairs']]
+    collated_data={'filename_id': torch.LongTensor([data[s]['filename_id'] for s, _ in pairs]),
+                   'candidate_line_id': torch.LongTensor([int(pair['candidate_line_id'][1:]) for _, pair in pairs]),
+                   'utterance_of_interest_id': torch.LongTensor([int(pair['utterance_of_interest_id'][1:]) for _, pair in pairs]),
+                   'utterances_distance': torch.LongTensor([abs(get_distance_bucket(pair['utterances_distance'])) for _, pair in pairs]),
+                   'first_spoke': torch.LongTensor([pair['first_spoke'] for _, pair in pairs]),
+                   'same_speaker': torch.LongTensor([pair['same_speaker'] for _, pair in pairs]),
+                   'same_turn': torch.LongTensor([pair['same_turn'] for _, pair in pairs]),
+                   'mode': torch.LongTensor([data[s]['mode'] for s, _ in pairs]),
+                   'label': torch.tensor([pair['label'] for _, pair in pairs]),
+                   'scene_tokens': scene_tokens,
+                   'token_slot': token_slot,
+                   'uoi_slot': torch.LongTensor([s*num_slots+pair['uoi_slot'] for s, pair in pairs]),
+                   'candidate_slot': torch.LongTensor([s*num_slots+pair['candidate_slot'] if pair['candidate_slot'] >= 0 else -1 for s, pair in pairs])}
+    return collated_data
+
 def main_log(msg):
     global logger
     return logger.info(msg, main_process_only=True)
@@ -416,6 +760,87 @@ def gen_file_lines(file_path):
                 
             yield category, filename, title, turn_line_no, scene_id, line_no, speaker_label, anno, line_text
 
+def read_line_dicts(file_paths):
+    '''
+    file_paths: {mode: tsv path}; builds the lookups CDDataset is constructed from
+    '''
+    lines={'train': {}, 'dev': {}, 'test': {}}
+    scene_id2line_ids={'train': {}, 'dev': {}, 'test': {}}
+    line_id2line_text={'train': {}, 'dev': {}, 'test': {}}
+    line_id2turn_n={'train': {}, 'dev': {}, 'test': {}}
+    line_id2speaker={'train': {}, 'dev': {}, 'test': {}}
+    speaker2line_ids={'train': {}, 'dev': {}, 'test': {}}
+    speakers={'train': {}, 'dev': {}, 'test': {}}
+
+    filename_to_filename_id={}
+    last_scene_id=''
+    last_turn_line_no=''
+    scene_line_ids=[]
+
+    for mode, file_path in file_paths.items():
+        for line in gen_file_lines(file_path):
+            category, filename, title, turn_line_no, scene_id, line_no, speaker_label, anno, line_text=line
+            # main_log((category, filename, title, turn_line_no, scene_id, line_no, speaker_label, anno, line_text))
+            # sys.exit(1)
+
+            if filename not in speakers[mode]:
+                speakers[mode][filename]={}
+            if filename not in filename_to_filename_id:
+                filename_to_filename_id[filename]=len(filename_to_filename_id)        
+
+            filename_id=filename_to_filename_id[filename]
+
+            if filename_id not in speakers[mode]:
+                scene_speaker_id=speakers[mode][filename_id]={}
+
+            if (line_no.startswith('D')):  
+                speakers[mode][filename_id][speaker_label]=len(speakers[mode][filename_id])
+                scene_speaker_id=speakers[mode][filename_id][speaker_label]
+
+                if speaker_label:
+                    speaker_label=speaker_label.lower() + ' [SEP] ' # take care of action lines
+                lines[mode][(filename_id, line_no)]={
+                    'corpus': category,
+                    'filename_id': filename_id,
+                    'title': title,
+                    'scene_id': scene_id,
+                    'scene_speaker_id': scene_speaker_id,
+                    'turn_line_no': turn_line_no,
+                    'reply_to_id': anno
+                }
+                last_turn_line_no=turn_line_no
+
+            if filename_id not in line_id2line_text[mode]:
+                line_id2line_text[mode][filename_id]={}             
+            line_id2line_text[mode][filename_id][line_no]=f"{speaker_label}{line_text} [LINE]"
+
+            if filename_id not in scene_id2line_ids[mode]:
+                scene_id2line_ids[mode][filename_id]={}                         
+            if scene_id not in scene_id2line_ids[mode][filename_id]:
+                scene_id2line_ids[mode][filename_id][scene_id]=[]
+
+            if line_no.startswith('A') or line_no.startswith('D'):
+                scene_id2line_ids[mode][filename_id][scene_id].append(line_no)
+
+            if filename_id not in line_id2turn_n[mode]:
+                line_id2turn_n[mode][filename_id]={}   
+            if line_no.startswith('D'):
+                line_id2turn_n[mode][filename_id][line_no]=turn_line_no
+
+            if filename_id not in line_id2speaker[mode]:
+                line_id2speaker[mode][filename_id]={}   
+            if filename_id not in speaker2line_ids[mode]:
+                speaker2line_ids[mode][filename_id]={} 
+
+
+            if line_no.startswith('D'):
+                line_id2speaker[mode][filename_id][line_no]=scene_speaker_id
+                if scene_speaker_id not in speaker2line_ids[mode][filename_id]:
+                    speaker2line_ids[mode][filename_id][scene_speaker_id]=[]
+                speaker2line_ids[mode][filename_id][scene_speaker_id].append(line_no)
+
+    return lines, filename_to_filename_id, scene_id2line_ids, line_id2line_text, line_id2turn_n, line_id2speaker, speaker2line_ids
+
 if __name__=='__main__':
 
     arg_parser=argparse.ArgumentParser()
@@ -439,6 +864,71 @@ if __name__=='__main__':
 
     arg_parser.add_argument('--model_output', help='specify model_output')
     arg_parser.add_argument('--log_output', help='specify log_output')
+    arg_parser.add_argument('--feature_store', default=None, help='directory of precomputed CLS vectors; freezes the encoder and trains the head only')
+    arg_parser.add_argument('--listwise',
+                        default=None,
+                        choices=['softmax', 'bce'],
+                        help='train on candidate groups, encoding each utterance of interest once; --batch_size then counts groups')
+    arg_parser.add_argument("--in_batch_negatives",
+                        default=0.,
+                        type=float,
+                        help="weight of the in-batch negatives loss (0: off); batches are then drawn per scene")
+    arg_parser.add_argument("--head_rank",
+                        default=0,
+                        type=int,
+                        help=f"factorize the full_dim x full_dim fc through this rank (0: dense, {LORA_HEAD_RANK} with --lora_rank)")
+    arg_parser.add_argument("--late_interaction",
+                        default=0,
+                        type=int,
+                        help="pointer models: align parent and utterance on their first N token states (max-sim) instead of CLS vectors (0: off)")
+    arg_parser.add_argument("--context_lines",
+                        default=0,
+                        type=int,
+                        help="build the context from the CLS vectors of the previous N lines (GRU) instead of encoding them concatenated (0: off)")
+    arg_parser.add_argument("--freeze_layers",
+                        default=0,
+                        type=int,
+                        help="freeze the embeddings and the bottom k encoder layers and cache their output")
+    arg_parser.add_argument('--layer_cache', default='layer_cache.sqlite', help='sqlite file for the frozen layers output')
+    arg_parser.add_argument("--layer_cache_size",
+                        default=1000000,
+                        type=int,
+                        help="max cached sequences before least recently used ones are evicted")
+    arg_parser.add_argument('--init_checkpoint', default=None, help='start from a trained checkpoint of the same encoder_name (pruning: the model to prune)')
+    arg_parser.add_argument("--prune_heads",
+                        default=0.,
+                        type=float,
+                        help="fraction of the utterance encoder attention heads to remove, scored on dev (needs init_checkpoint); the epochs then are the recovery fine-tune")
+    arg_parser.add_argument("--prune_ffn",
+                        default=0.,
+                        type=float,
+                        help="fraction of the FFN neurons of every utterance encoder layer to remove")
+    arg_parser.add_argument("--importance_batches",
+                        default=0,
+                        type=int,
+                        help="dev batches to score heads and neurons on, 0 for all")
+    arg_parser.add_argument("--compile",
+                        default=0,
+                        type=int,
+                        help="torch.compile the encoder, one graph per shape bucket (shape_buckets.py)")
+    arg_parser.add_argument('--compile_cache', default='compile_cache', help='folder for the compiled graphs, reused across runs')
+    arg_parser.add_argument("--bf16",
+                        default=0,
+                        type=int,
+                        help="bfloat16 autocast (Accelerator mixed_precision), float32 weights; check a checkpoint with parity_4DD first")
+    arg_parser.add_argument("--lora_rank",
+                        default=0,
+                        type=int,
+                        help="LoRA on the encoder attention projections (lora.py), frozen encoder; the checkpoint is the adapter (0: off)")
+    arg_parser.add_argument("--lora_alpha",
+                        default=16,
+                        type=int,
+                        help="LoRA scaling, the update is alpha/rank * B A")
+    arg_parser.add_argument('--lora_targets', default=','.join(LORA_TARGETS), help='comma separated encoder Linear names that get a LoRA update')
+    arg_parser.add_argument("--lora_learning_rate",
+                        default=5e-4,
+                        type=float,
+                        help="learning rate with --lora_rank")
 
 
     args=vars(arg_parser.parse_args())
@@ -455,8 +945,12 @@ if __name__=='__main__':
     # args['model_name']='google/electra-base-discriminator' #'roberta-base'#='bert-base-cased'
     args["n_gpu"]=torch.cuda.device_count()
     args["learning_rate"]=5e-6
+    if args['lora_rank']:
+        args["learning_rate"]=args['lora_learning_rate']
+        if not args['head_rank']:
+            args['head_rank']=LORA_HEAD_RANK
     args['grad_clip']=1
-    args["fix_encoder"]=0
+    args["fix_encoder"]=1 if args['feature_store'] else 0
     args["output_dir"]=OUTPUT_PATH
     args["logs_dir"]=str(LOG_PATH)
 
@@ -465,8 +959,12 @@ if __name__=='__main__':
 
     ######
 
-    ddp_kwargs=DistributedDataParallelKwargs(find_unused_parameters=True)
-    accelerator=Accelerator(kwargs_handlers=[ddp_kwargs])
+    assert not (args['late_interaction'] and args['feature_store']), 'late interaction needs token states, the feature store only has CLS vectors'
+    assert not ((args['prune_heads'] or args['prune_ffn']) and (args['feature_store'] or not args['init_checkpoint'])), 'pruning scores a trained, trainable encoder'
+    assert not (args['lora_rank'] and (args['feature_store'] or args['init_checkpoint'])), 'LoRA adapters are saved against the pretrained encoder'
+
+    ddp_kwargs=DistributedDataParallelKwargs(find_unused_parameters=False, static_graph=True)
+    accelerator=Accelerator(kwargs_handlers=[ddp_kwargs], mixed_precision='bf16' if args['bf16'] else None)
 
     ######
     timestamp=datetime.datetime.now().strftime("%m%d%Y-%H%M%S")    
@@ -499,80 +997,7 @@ if __name__=='__main__':
         'dev': (DATA_PATH).joinpath(args['dev_file']),
         # 'test': (DATA_PATH).joinpath(args['test_file']),
     }
-    lines={'train': {}, 'dev': {}, 'test': {}}
-    scene_id2line_ids={'train': {}, 'dev': {}, 'test': {}}
-    line_id2line_text={'train': {}, 'dev': {}, 'test': {}}
-    line_id2turn_n={'train': {}, 'dev': {}, 'test': {}}
-    line_id2speaker={'train': {}, 'dev': {}, 'test': {}}
-    speaker2line_ids={'train': {}, 'dev': {}, 'test': {}}
-    speakers={'train': {}, 'dev': {}, 'test': {}}
-
-    filename_to_filename_id={}
-    last_scene_id=''
-    last_turn_line_no=''
-    scene_line_ids=[]
-
-    for mode, file_path in file_paths.items():
-        for line in gen_file_lines(file_path):
-            category, filename, title, turn_line_no, scene_id, line_no, speaker_label, anno, line_text=line
-            # main_log((category, filename, title, turn_line_no, scene_id, line_no, speaker_label, anno, line_text))
-            # sys.exit(1)
-
-            if filename not in speakers[mode]:
-                speakers[mode][filename]={}
-            if filename not in filename_to_filename_id:
-                filename_to_filename_id[filename]=len(filename_to_filename_id)        
-
-            filename_id=filename_to_filename_id[filename]
-
-            if filename_id not in speakers[mode]:
-                scene_speaker_id=speakers[mode][filename_id]={}
-
-            if (line_no.startswith('D')):  
-                speakers[mode][filename_id][speaker_label]=len(speakers[mode][filename_id])
-                scene_speaker_id=speakers[mode][filename_id][speaker_label]
-
-                if speaker_label:
-                    speaker_label=speaker_label.lower() + ' [SEP] ' # take care of action lines
-                lines[mode][(filename_id, line_no)]={
-                    'corpus': category,
-                    'filename_id': filename_id,
-                    'title': title,
-                    'scene_id': scene_id,
-                    'scene_speaker_id': scene_speaker_id,
-                    'turn_line_no': turn_line_no,
-                    'reply_to_id': anno
-                }
-                last_turn_line_no=turn_line_no
-
-            if filename_id not in line_id2line_text[mode]:
-                line_id2line_text[mode][filename_id]={}             
-            line_id2line_text[mode][filename_id][line_no]=f"{speaker_label}{line_text} [LINE]"
-
-            if filename_id not in scene_id2line_ids[mode]:
-                scene_id2line_ids[mode][filename_id]={}                         
-            if scene_id not in scene_id2line_ids[mode][filename_id]:
-                scene_id2line_ids[mode][filename_id][scene_id]=[]
-
-            if line_no.startswith('A') or line_no.startswith('D'):
-                scene_id2line_ids[mode][filename_id][scene_id].append(line_no)
-
-            if filename_id not in line_id2turn_n[mode]:
-                line_id2turn_n[mode][filename_id]={}   
-            if line_no.startswith('D'):
-                line_id2turn_n[mode][filename_id][line_no]=turn_line_no
-
-            if filename_id not in line_id2speaker[mode]:
-                line_id2speaker[mode][filename_id]={}   
-            if filename_id not in speaker2line_ids[mode]:
-                speaker2line_ids[mode][filename_id]={} 
-
-
-            if line_no.startswith('D'):
-                line_id2speaker[mode][filename_id][line_no]=scene_speaker_id
-                if scene_speaker_id not in speaker2line_ids[mode][filename_id]:
-                    speaker2line_ids[mode][filename_id][scene_speaker_id]=[]
-                speaker2line_ids[mode][filename_id][scene_speaker_id].append(line_no)
+    lines, filename_to_filename_id, scene_id2line_ids, line_id2line_text, line_id2turn_n, line_id2speaker, speaker2line_ids=read_line_dicts(file_paths)
 
     reversed_filename_to_filename_id={v: k for k, v in filename_to_filename_id.items()}
     
@@ -597,19 +1022,50 @@ if __name__=='__main__':
     HIDDEN_DIM=config.hidden_size
     SEQUENCE_MAX_LEN=tokenizer.model_max_length
 
-    dataset=CDDataset(lines, filename_to_filename_id, scene_id2line_ids, line_id2line_text, line_id2turn_n, line_id2speaker, speaker2line_ids, tokenizer, 'train', SEQUENCE_MAX_LEN, num_negative_examples)
-    data_loader=torch.utils.data.DataLoader(dataset=dataset,
-                                        batch_size=BATCH_SIZE,
-                                        collate_fn=collate_fn_cd,
-                                        shuffle=True, 
-                                        drop_last=True)
-
-    dev_dataset=CDDataset(lines, filename_to_filename_id, scene_id2line_ids, line_id2line_text, line_id2turn_n, line_id2speaker, speaker2line_ids, tokenizer, 'dev', SEQUENCE_MAX_LEN)
-    dev_data_loader=torch.utils.data.DataLoader(dataset=dev_dataset,
+    assert not (args['in_batch_negatives'] and args['encoder_name'] in ['MultitaskDialogueEncoderWithPointer', 'DialogueEncoderWithPointer']), \
+        'the pointer encoders return no CLS vectors to score in-batch negatives with'
+    if args['encoder_name'] == 'SceneDialogueEncoder':
+        assert not (args['feature_store'] or args['listwise'] or args['in_batch_negatives'] or args['freeze_layers']), \
+            'SceneDialogueEncoder already encodes each scene once, it does not take the per-pair options'
+        # --batch_size then counts scene windows, every pair of a window is scored
+        dataset=SceneCDDataset(lines, filename_to_filename_id, scene_id2line_ids, line_id2line_text, line_id2turn_n, line_id2speaker, speaker2line_ids, tokenizer, 'train', SEQUENCE_MAX_LEN)
+        data_loader=torch.utils.data.DataLoader(dataset=dataset,
+                                            batch_size=BATCH_SIZE,
+                                            collate_fn=collate_fn_scene,
+                                            shuffle=True)
+        dev_dataset=SceneCDDataset(lines, filename_to_filename_id, scene_id2line_ids, line_id2line_text, line_id2turn_n, line_id2speaker, speaker2line_ids, tokenizer, 'dev', SEQUENCE_MAX_LEN)
+        dev_data_loader=torch.utils.data.DataLoader(dataset=dev_dataset,
+                                                batch_size=BATCH_SIZE,
+                                                collate_fn=collate_fn_scene)
+    else:
+        dataset=CDDataset(lines, filename_to_filename_id, scene_id2line_ids, line_id2line_text, line_id2turn_n, line_id2speaker, speaker2line_ids, tokenizer, 'train', SEQUENCE_MAX_LEN, num_negative_examples, args['context_lines'])
+        data_loader=torch.utils.data.DataLoader(dataset=dataset,
                                             batch_size=BATCH_SIZE,
                                             collate_fn=collate_fn_cd,
+                                            shuffle=True, 
+                                            drop_last=True)
+
+        dev_dataset=CDDataset(lines, filename_to_filename_id, scene_id2line_ids, line_id2line_text, line_id2turn_n, line_id2speaker, speaker2line_ids, tokenizer, 'dev', SEQUENCE_MAX_LEN, context_lines=args['context_lines'])
+        dev_data_loader=torch.utils.data.DataLoader(dataset=dev_dataset,
+                                                batch_size=BATCH_SIZE,
+                                                collate_fn=collate_fn_cd,
+                                                drop_last=True)
+
+    assert not (args['context_lines'] and args['feature_store']), 'the feature store holds concatenated contexts, not per-line vectors'
+
+    if args['listwise']:
+        assert not args['feature_store'], '--listwise only saves encoder passes, it has nothing to do with a feature store'
+        data_loader=torch.utils.data.DataLoader(dataset=GroupedCDDataset(dataset),
+                                            batch_size=BATCH_SIZE,
+                                            collate_fn=collate_fn_grouped,
+                                            shuffle=True, 
                                             drop_last=True)
 
+    if args['in_batch_negatives'] and not args['listwise']:
+        data_loader=torch.utils.data.DataLoader(dataset=dataset,
+                                            batch_sampler=SceneBatchSampler(dataset, BATCH_SIZE),
+                                            collate_fn=collate_fn_cd)
+
     distances=[]
     for i in data_loader:
         distances.append(i['utterances_distance'].tolist())
@@ -657,7 +1113,74 @@ if __name__=='__main__':
     # model=LineDualEncoder(args)
     main_log(f"Enocder: {args['encoder_name']}")
     model=globals()[args['encoder_name']](args)
-    optimizer=optim.AdamW(model.parameters(), lr=args["learning_rate"])
+    if accelerator.is_main_process: # the output folder also works as --model_name for inference
+        model.utterance_encoder_config.save_pretrained(str(OUTPUT_PATH))
+        model.utterance_encoder_tokenizer.save_pretrained(str(OUTPUT_PATH))
+
+    if args['init_checkpoint']:
+        model.load_state_dict(drop_legacy_keys(read_state_dict(args['init_checkpoint']), model))
+        main_log(f"Initialized from {args['init_checkpoint']}")
+
+    pruning_plan=None
+    if args['prune_heads'] or args['prune_ffn']:
+        main_log('Scoring heads and FFN neurons on dev ...')
+        model=model.to(accelerator.device)
+        model.eval()
+        importance=None
+        for i, d in enumerate(dev_data_loader):
+            if args['importance_batches'] and i == args['importance_batches']:
+                break
+            d={key: to_cuda(val) for key, val in d.items()}
+            outputs=model(d)
+            nn.functional.binary_cross_entropy_with_logits(outputs['logits'], outputs['label'].float()).backward()
+            importance=accumulate_importance(model.utterance_encoder, importance)
+            model.zero_grad()
+        pruning_plan=select_pruning(importance, args['prune_heads'], args['prune_ffn'])
+        flops=encoder_flops(model.utterance_encoder)
+        prune_encoder(model.utterance_encoder, pruning_plan)
+        main_log(f"Heads kept per layer: {[len(kept) for kept in pruning_plan['heads'].values()]}")
+        main_log(f"FFN neurons kept per layer: {[len(kept) for kept in pruning_plan['ffn'].values()]}")
+        main_log(f"Encoder FLOPs: {encoder_flops(model.utterance_encoder)/flops*100:.0f}%")
+
+    if args['feature_store']:
+        main_log(f"Feature store: {args['feature_store']}")
+        model=model.to(accelerator.device)
+        if accelerator.is_main_process:
+            build_feature_store(model, [dataset, dev_dataset], args['feature_store'], BATCH_SIZE, use_tqdm)
+        accelerator.wait_for_everyone()
+        store=FeatureStore(args['feature_store'])
+        main_log(f"Feature store: {len(store)} sequences")
+
+        # same datasets and samplers, the collate adds the stored vectors
+        data_loader=torch.utils.data.DataLoader(dataset=data_loader.dataset,
+                                            batch_sampler=data_loader.batch_sampler,
+                                            collate_fn=FeatureStoreCollate(store, data_loader.collate_fn))
+        dev_data_loader=torch.utils.data.DataLoader(dataset=dev_data_loader.dataset,
+                                                batch_sampler=dev_data_loader.batch_sampler,
+                                                collate_fn=FeatureStoreCollate(store, dev_data_loader.collate_fn))
+
+    lora=None
+    if args['lora_rank']:
+        assert not args['freeze_layers'], 'LoRA trains every layer'
+        attach_lora(model.utterance_encoder, args['lora_rank'], args['lora_alpha'], targets=args['lora_targets'].split(','))
+        lora=lora_settings(args['lora_rank'], args['lora_alpha'], args['lora_targets'].split(','), args['model_name'], 'utterance_encoder.')
+        trainable, total, adapter_bytes, dense_bytes=lora_report(model, lora)
+        main_log(f"LoRA rank {args['lora_rank']} on {args['lora_targets']}: {trainable} of {total} parameters trainable ({trainable/total*100:.2f}%), "
+                 f"checkpoint {adapter_bytes/2**20:.1f}MB instead of {dense_bytes/2**20:.1f}MB")
+        if trainable > total*LORA_MAX_TRAINABLE:
+            main_log(f"WARNING: {trainable/total*100:.2f}% of the parameters trainable (the dense heads outside of the encoder, see --head_rank), "
+                     f"LoRA saves little optimizer memory, checkpoint size or gradient traffic")
+
+    if args['freeze_layers']:
+        attach_layer_cache(model, model.utterance_encoder, EmbeddingCache(args['layer_cache'], max_entries=args['layer_cache_size']), args['freeze_layers'])
+        main_log(f"Frozen bottom {args['freeze_layers']} layers, cache: {args['layer_cache']}")
+
+    if args['compile']:
+        assert not args['freeze_layers'], 'the frozen layers path runs the encoder layers itself'
+        attach_compiled_encoder(model.utterance_encoder, cache_dir=args['compile_cache'])
+        main_log(f"Compiled encoder, cache: {args['compile_cache']}")
+
+    optimizer=optim.AdamW([p for p in model.parameters() if p.requires_grad], lr=args["learning_rate"]) # LoRA: adapter and heads only
     criterion=nn.BCEWithLogitsLoss()
 
     model, optimizer, data_loader, dev_data_loader = accelerator.prepare(
@@ -687,7 +1210,12 @@ if __name__=='__main__':
             model.train()
             d={key: to_cuda(val) for key, val in d.items()}
             outputs=model(d)
-            loss=criterion(outputs['logits'], outputs['label'].float())
+            if args['listwise'] == 'softmax':
+                loss=listwise_loss(outputs['logits'], outputs['label'], d['group_index'])
+            else:
+                loss=criterion(outputs['logits'], outputs['label'].float())
+            if args['in_batch_negatives']:
+                loss=loss + args['in_batch_negatives']*in_batch_negatives_loss(accelerator.unwrap_model(model), outputs, d)
 
             # for name, param in model.named_parameters():
             #     if param.grad is None:
@@ -722,10 +1250,14 @@ if __name__=='__main__':
                     d={key: to_cuda(val) for key, val in d.items()} 
                     with torch.no_grad():        
                         outputs=model(d)
+                        # scene batches hold a varying number of pairs
+                        outputs=accelerator.pad_across_processes(outputs, pad_index=-1)
                         outputs=accelerator.gather(outputs)
 
                         for filename_id, utterance_of_interest_id, candidate_line_id, logit, label in \
                             zip(outputs['filename_id'], outputs['utterance_of_interest_id'], outputs['candidate_line_id'], outputs['logits'], outputs['label']):
+                            if filename_id < 0:
+                                continue
 
                             pred=1 if to_cpu(torch.sigmoid(logit))>0.5 else 0
                             label=int(to_cpu(label))
@@ -796,11 +1328,18 @@ if __name__=='__main__':
                     exact_match(gold, auto)
 
                     if eval_metric>best_eval_metric:
-                        best_model_path=f"pytorch_model-{timestamp}-epoch{epoch}.bin"
+                        best_model_path=f"pytorch_model-{timestamp}-epoch{epoch}.safetensors"
                         main_log(f"New best -- Model saved: {best_model_path}")
                         best_eval_metric=eval_metric
                         main_log(f"Pairwise_accuracy: {pairwise_accuracy*100:.2f}; p, r, f: {p*100:.2f}, {r*100:.2f}, {f*100:.2f}; ari: {ari:5.2f}; 1-vi: {vi:.2f}; shen: {shen:.2f}; oto: {oto:.2f}; em-f: {em_f:.2f}")
                         accelerator.wait_for_everyone()
                         unwrapped_model=accelerator.unwrap_model(model)
-                        accelerator.save(unwrapped_model.state_dict(), str(pathlib.Path(args["output_dir"].joinpath(best_model_path))))
-                # print('---------------------------------------------')
\ No newline at end of file
+                        if accelerator.is_main_process:
+                            save_checkpoint(unwrapped_model, args["output_dir"].joinpath(best_model_path), unwrapped_model.utterance_encoder_config, args, lora)
+                            if pruning_plan is not None:
+                                save_pruning_plan(pruning_plan, args["output_dir"].joinpath(best_model_path))
+                # print('---------------------------------------------')
+
+    if args['compile']:
+        for line in compile_report(accelerator.unwrap_model(model).utterance_encoder):
+            main_log(f"Compile: {line}")
@@ -60,12 +60,12 @@ def merge(sequences, ignore_idx=None):
 
 
 class CDDataset(torch.utils.data.Dataset):
-    def __init__(self, lines, filename_to_filename_id, scene_id2line_ids, line_id2line_text, line_id2turn_n, line_id2speaker, speaker2line_ids, tokenizer, mode, max_length=512, num_negative_examples=10):
+    def __init__(self, lines, filename_to_filename_id, scene_id2line_ids, line_id2line_text, line_id2turn_n, line_id2speaker, speaker2line_ids, tokenizer, mode, max_length=512, num_negative_examples=10, max_candidates=10):
         self.tokenizer=tokenizer
         self.max_length=max_length
         
         self.num_negative_examples=num_negative_examples
-        self.max_candidates=10
+        self.max_candidates=max_candidates
         self.max_distance=12
         
         self.filename_to_filename_id=filename_to_filename_id
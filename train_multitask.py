@@ -32,6 +32,10 @@ from accelerate.logging import get_logger
 
 from models import *
 from eval import *
+from feature_store import build_feature_store, FeatureStore, FeatureStoreCollate
+from shape_buckets import attach_compiled_encoder, compile_report
+from checkpoints import save_checkpoint
+from lora import LORA_TARGETS, LORA_HEAD_RANK, LORA_MAX_TRAINABLE, attach_lora, lora_settings, lora_report
 
 def set_seed(seed: int) -> None:
     np.random.seed(seed)
@@ -453,6 +457,46 @@ if __name__=='__main__':
                         help="specific batch_size.")
     arg_parser.add_argument('--model_output', help='specify model_output')
     arg_parser.add_argument('--log_output', help='specify log_output')
+    arg_parser.add_argument('--feature_store', default=None, help='directory of precomputed CLS vectors; freezes the encoder and trains the head only')
+    arg_parser.add_argument("--head_rank",
+                        default=0,
+                        type=int,
+                        help=f"factorize the full_dim x full_dim fc through this rank (0: dense, {LORA_HEAD_RANK} with --lora_rank)")
+    arg_parser.add_argument("--late_interaction",
+                        default=0,
+                        type=int,
+                        help="pointer models: align parent and utterance on their first N token states (max-sim) instead of CLS vectors (0: off)")
+    arg_parser.add_argument("--freeze_layers",
+                        default=0,
+                        type=int,
+                        help="freeze the embeddings and the bottom k encoder layers and cache their output")
+    arg_parser.add_argument('--layer_cache', default='layer_cache.sqlite', help='sqlite file for the frozen layers output')
+    arg_parser.add_argument("--layer_cache_size",
+                        default=1000000,
+                        type=int,
+                        help="max cached sequences before least recently used ones are evicted")
+    arg_parser.add_argument("--compile",
+                        default=0,
+                        type=int,
+                        help="torch.compile the encoder, one graph per shape bucket (shape_buckets.py)")
+    arg_parser.add_argument('--compile_cache', default='compile_cache', help='folder for the compiled graphs, reused across runs')
+    arg_parser.add_argument("--bf16",
+                        default=0,
+                        type=int,
+                        help="bfloat16 autocast (Accelerator mixed_precision), float32 weights; check a checkpoint with parity_4DD first")
+    arg_parser.add_argument("--lora_rank",
+                        default=0,
+                        type=int,
+                        help="LoRA on the encoder attention projections (lora.py), frozen encoder; the checkpoint is the adapter (0: off)")
+    arg_parser.add_argument("--lora_alpha",
+                        default=16,
+                        type=int,
+                        help="LoRA scaling, the update is alpha/rank * B A")
+    arg_parser.add_argument('--lora_targets', default=','.join(LORA_TARGETS), help='comma separated encoder Linear names that get a LoRA update')
+    arg_parser.add_argument("--lora_learning_rate",
+                        default=5e-4,
+                        type=float,
+                        help="learning rate with --lora_rank")
     
     args=vars(arg_parser.parse_args())
 
@@ -468,8 +512,12 @@ if __name__=='__main__':
     # args['model_name']='google/electra-base-discriminator' #'roberta-base'#='bert-base-cased'
     args["n_gpu"]=torch.cuda.device_count()
     args["learning_rate"]=5e-6
+    if args['lora_rank']:
+        args["learning_rate"]=args['lora_learning_rate']
+        if not args['head_rank']:
+            args['head_rank']=LORA_HEAD_RANK
     args['grad_clip']=1
-    args["fix_encoder"]=0
+    args["fix_encoder"]=1 if args['feature_store'] else 0
     args["output_dir"]=OUTPUT_PATH
     args["logs_dir"]=str(LOG_PATH)
 
@@ -478,8 +526,11 @@ if __name__=='__main__':
 
     ######
 
-    ddp_kwargs=DistributedDataParallelKwargs(find_unused_parameters=True)
-    accelerator=Accelerator(kwargs_handlers=[ddp_kwargs])
+    assert not (args['late_interaction'] and args['feature_store']), 'late interaction needs token states, the feature store only has CLS vectors'
+    assert not (args['lora_rank'] and args['feature_store']), 'LoRA trains the encoder, the feature store freezes it'
+
+    ddp_kwargs=DistributedDataParallelKwargs(find_unused_parameters=False, static_graph=True)
+    accelerator=Accelerator(kwargs_handlers=[ddp_kwargs], mixed_precision='bf16' if args['bf16'] else None)
 
     ######
     timestamp=datetime.datetime.now().strftime("%m%d%Y-%H%M%S")    
@@ -723,7 +774,49 @@ if __name__=='__main__':
     # model=LineDualEncoder(args)
     main_log(f"Enocder: {args['encoder_name']}")
     model=globals()[args['encoder_name']](args)
-    optimizer=optim.AdamW(model.parameters(), lr=args["learning_rate"])
+    if accelerator.is_main_process: # the output folder also works as --model_name for inference
+        model.utterance_encoder_config.save_pretrained(str(OUTPUT_PATH))
+        model.utterance_encoder_tokenizer.save_pretrained(str(OUTPUT_PATH))
+
+    if args['feature_store']:
+        main_log(f"Feature store: {args['feature_store']}")
+        model=model.to(accelerator.device)
+        if accelerator.is_main_process:
+            build_feature_store(model, [dataset, dev_dataset], args['feature_store'], BATCH_SIZE, use_tqdm)
+        accelerator.wait_for_everyone()
+        store=FeatureStore(args['feature_store'])
+        main_log(f"Feature store: {len(store)} sequences")
+
+        # same datasets and samplers, the collate adds the stored vectors
+        data_loader=torch.utils.data.DataLoader(dataset=data_loader.dataset,
+                                            batch_sampler=data_loader.batch_sampler,
+                                            collate_fn=FeatureStoreCollate(store, data_loader.collate_fn))
+        dev_data_loader=torch.utils.data.DataLoader(dataset=dev_data_loader.dataset,
+                                                batch_sampler=dev_data_loader.batch_sampler,
+                                                collate_fn=FeatureStoreCollate(store, dev_data_loader.collate_fn))
+
+    lora=None
+    if args['lora_rank']:
+        assert not args['freeze_layers'], 'LoRA trains every layer'
+        attach_lora(model.utterance_encoder, args['lora_rank'], args['lora_alpha'], targets=args['lora_targets'].split(','))
+        lora=lora_settings(args['lora_rank'], args['lora_alpha'], args['lora_targets'].split(','), args['model_name'], 'utterance_encoder.')
+        trainable, total, adapter_bytes, dense_bytes=lora_report(model, lora)
+        main_log(f"LoRA rank {args['lora_rank']} on {args['lora_targets']}: {trainable} of {total} parameters trainable ({trainable/total*100:.2f}%), "
+                 f"checkpoint {adapter_bytes/2**20:.1f}MB instead of {dense_bytes/2**20:.1f}MB")
+        if trainable > total*LORA_MAX_TRAINABLE:
+            main_log(f"WARNING: {trainable/total*100:.2f}% of the parameters trainable (the dense heads outside of the encoder, see --head_rank), "
+                     f"LoRA saves little optimizer memory, checkpoint size or gradient traffic")
+
+    if args['freeze_layers']:
+        attach_layer_cache(model, model.utterance_encoder, EmbeddingCache(args['layer_cache'], max_entries=args['layer_cache_size']), args['freeze_layers'])
+        main_log(f"Frozen bottom {args['freeze_layers']} layers, cache: {args['layer_cache']}")
+
+    if args['compile']:
+        assert not args['freeze_layers'], 'the frozen layers path runs the encoder layers itself'
+        attach_compiled_encoder(model.utterance_encoder, cache_dir=args['compile_cache'])
+        main_log(f"Compiled encoder, cache: {args['compile_cache']}")
+
+    optimizer=optim.AdamW([p for p in model.parameters() if p.requires_grad], lr=args["learning_rate"]) # LoRA: adapter and heads only
     criterion=nn.BCEWithLogitsLoss()
     thread_criterion=nn.BCEWithLogitsLoss()
 
@@ -888,7 +981,7 @@ if __name__=='__main__':
                     exact_match(gold, auto)
 
                     if eval_metric>best_eval_metric:
-                        best_model_path=f"pytorch_model-{timestamp}-epoch{epoch}.bin"
+                        best_model_path=f"pytorch_model-{timestamp}-epoch{epoch}.safetensors"
                         main_log(f"New best -- Model saved: {best_model_path}")
                         # main_log(pformat(preds_dict))
                         best_eval_metric=eval_metric
@@ -896,5 +989,10 @@ if __name__=='__main__':
                         # torch.save(model.state_dict(), best_model_path)
                         accelerator.wait_for_everyone()
                         unwrapped_model=accelerator.unwrap_model(model)
-                        accelerator.save(unwrapped_model.state_dict(), str(pathlib.Path(args["output_dir"].joinpath(best_model_path))))
-                # print('---------------------------------------------')
\ No newline at end of file
+                        if accelerator.is_main_process:
+                            save_checkpoint(unwrapped_model, args["output_dir"].joinpath(best_model_path), unwrapped_model.utterance_encoder_config, args, lora)
+                # print('---------------------------------------------')
+
+    if args['compile']:
+        for line in compile_report(accelerator.unwrap_model(model).utterance_encoder):
+            main_log(f"Compile: {line}")